@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class ConversationConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "ask_ai.conversation"
+
+    def ready(self):
+        from health_check.plugins import plugin_dir
+
+        from .health_checks import (
+            LLMSchedulerHealthCheck,
+            OpenAICircuitBreakerHealthCheck,
+            SensitivityCheckAnalyzerHealthCheck,
+        )
+
+        plugin_dir.register(OpenAICircuitBreakerHealthCheck)
+        plugin_dir.register(SensitivityCheckAnalyzerHealthCheck)
+        plugin_dir.register(LLMSchedulerHealthCheck)
@@ -0,0 +1,179 @@
+"""
+Async versions of the chat views, for running under ASGI.
+
+Input moderation (a call to the OpenAI API) and the sensitivity check (local Presidio analysis)
+don't depend on each other, so they run at the same time - a request waits for the slower of the two
+rather than both. Pages are rendered with the same code as the sync views.
+
+Streamed responses are sent from an async generator, as Django's ASGI handler reads a sync
+iterator to the end before sending any of it.
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseNotAllowed
+from django.shortcuts import redirect
+from django.urls import reverse
+
+from . import chat_gpt, constants, models, permissions, sensitivity_check, views
+
+
+def require_http_methods(request_method_list):
+    # `django.views.decorators.http.require_http_methods` only supports async views from Django 5.0
+    def decorator(func):
+        async def inner(request, *args, **kwargs):
+            if request.method not in request_method_list:
+                return HttpResponseNotAllowed(request_method_list)
+            return await func(request, *args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+async def ais_text_potentially_sensitive(input_text: str) -> bool:
+    # Presidio analysis is CPU bound, don't tie up the thread used for database access
+    return await sync_to_async(sensitivity_check.is_text_potentially_sensitive, thread_sensitive=False)(input_text)
+
+
+async def check_user_prompt(input_text: str) -> tuple[bool, bool]:
+    """
+    Run input moderation and the sensitivity check concurrently.
+    Returns whether the text is moderated, and whether it is potentially sensitive.
+    """
+    moderated, potentially_sensitive = await asyncio.gather(
+        chat_gpt.achat_gpt_moderated(input_text),
+        ais_text_potentially_sensitive(input_text),
+    )
+    return moderated, potentially_sensitive
+
+
+async def aget_chat(user, chat_id):
+    chat_created = False
+    if not chat_id:
+        chat = await models.Chat.objects.acreate(user=user)
+        chat_created = True
+    else:
+        chat = await models.Chat.objects.aget(id=chat_id)
+    return chat, chat_created
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET", "POST"])
+async def chat_view(request, chat_id=None, option=None):
+    if request.method != "POST":
+        return await sync_to_async(views.render_chat_page)(request, chat_id, option)
+    input_text = request.POST.dict().get("user_prompt")
+    # Counted once, for the length check and to save with the prompt, in a thread as encoding is CPU bound
+    tokens_user_prompt = await sync_to_async(chat_gpt.num_tokens_from_string, thread_sensitive=False)(
+        input_text, views.LLM_MODEL.label
+    )
+    # Check for length before saving - don't save if only prompt too long
+    if chat_gpt.is_token_count_over_limit(tokens_user_prompt, views.LLM_MODEL, buffer=constants.BUFFER_TOKENS):
+        errors = {"user_prompt": views.PROMPT_TOO_LONG_ERROR}
+        data = {"user_prompt": input_text}
+        return await sync_to_async(views.render_chat_page)(request, chat_id, option, errors, data)
+    chat, _ = await aget_chat(request.user, chat_id)
+    prompt = await models.Prompt.objects.acreate(
+        chat=chat,
+        llm_model=views.LLM_MODEL,
+        user_prompt=input_text,
+        tokens_user_prompt=tokens_user_prompt,
+    )
+    try:
+        moderated, potentially_sensitive = await check_user_prompt(input_text)
+        if moderated:
+            prompt.user_prompt_moderated = True
+            await prompt.asave()
+            return redirect(reverse("chat", args=(chat.id,)))
+        prompt.potentially_sensitive = potentially_sensitive
+        await prompt.asave()
+        if potentially_sensitive:
+            return redirect(reverse("chat-sensitivity-check", args=(chat.id,)))
+        if await sync_to_async(views.hand_off_response)(prompt):
+            return redirect(reverse("chat", args=(chat.id,)))
+        chat_gpt_inputs = await chat_gpt.aget_chat_gpt_inputs(chat, views.LLM_MODEL)
+        await chat_gpt.asubmit_valid_chat_to_chatgpt35(prompt, chat_gpt_inputs)
+        return redirect(reverse("chat", args=(chat.id,)))
+    except chat_gpt.OPEN_AI_API_ERRORS:
+        prompt.api_call_error = True
+        await prompt.asave()
+        return redirect(reverse("chat-option", args=(chat.id, views.POPULATE_TEXT_BOX)))
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET", "POST"])
+async def check_sensitivity_view(request, chat_id):
+    if request.method != "POST":
+        return await sync_to_async(views.render_sensitivity_check_page)(request, chat_id)
+    chat = await models.Chat.objects.aget(id=chat_id)
+    if "not-sensitive" not in request.POST.dict():
+        # populate text box for editing
+        return redirect(reverse("chat-option", args=(chat.id, views.POPULATE_TEXT_BOX)))
+    latest_prompt = await models.Prompt.objects.filter(chat=chat).order_by("created_at").alast()
+    latest_prompt.user_confirmed_not_sensitive = True
+    await latest_prompt.asave()
+    if await sync_to_async(views.hand_off_response)(latest_prompt):
+        return redirect(reverse("chat", args=(chat.id,)))
+    try:
+        chat_gpt_inputs = await chat_gpt.aget_chat_gpt_inputs(chat, views.LLM_MODEL)
+        await chat_gpt.asubmit_valid_chat_to_chatgpt35(latest_prompt, chat_gpt_inputs)
+    except chat_gpt.OPEN_AI_API_ERRORS:
+        latest_prompt.api_call_error = True
+        await latest_prompt.asave()
+    return redirect(reverse("chat", args=(chat.id,)))
+
+
+async def aget_chat_stream_events(prompt):
+    # As `views.get_chat_stream_events`
+    prompt.response_pending = False
+    prompt.response_claimed_at = None
+    llm_model = models.Prompt.LLMModels(prompt.llm_model)
+    released = False
+    refresh_interval = settings.STREAM_CHAT_CLAIM_TIMEOUT_SECONDS / 3
+    last_refreshed = time.monotonic()
+    try:
+        chat_gpt_inputs = await chat_gpt.aget_chat_gpt_inputs(prompt.chat, llm_model)
+        async for chunk in chat_gpt.astream_valid_chat_to_chatgpt35(prompt, chat_gpt_inputs):
+            if time.monotonic() - last_refreshed >= refresh_interval:
+                await sync_to_async(views.refresh_stream_claim)(prompt)
+                last_refreshed = time.monotonic()
+            yield views.format_server_sent_event(chunk)
+        released = True
+    except chat_gpt.OPEN_AI_API_ERRORS:
+        prompt.api_call_error = True
+        await prompt.asave()
+        released = True
+        yield views.format_server_sent_event("", event="api-error")
+        return
+    finally:
+        if not released:
+            # Stopped part way, eg the browser went away, so let the next request stream it
+            await models.Prompt.objects.filter(id=prompt.id).aupdate(response_pending=False, response_claimed_at=None)
+    yield views.format_server_sent_event("", event="done")
+
+
+async def aget_done_events():
+    yield views.format_server_sent_event("", event="done")
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET"])
+async def chat_stream_view(request, chat_id):
+    latest_prompt = (
+        await models.Prompt.objects.filter(chat__id=chat_id).select_related("chat").order_by("created_at").alast()
+    )
+    if (
+        latest_prompt
+        and latest_prompt.is_awaiting_response
+        and await sync_to_async(views.claim_prompt_for_streaming)(latest_prompt)
+    ):
+        events = aget_chat_stream_events(latest_prompt)
+    else:
+        events = aget_done_events()
+    return views.make_event_stream_response(events)
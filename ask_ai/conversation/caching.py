@@ -0,0 +1,84 @@
+"""
+Caching of results computed from text (eg moderation), keyed by a hash of the normalised text.
+
+Uses a Django cache alias, so results can be kept in process (LocMemCache, which evicts least
+recently used entries once full) or in a store shared between processes.
+"""
+import hashlib
+import threading
+import unicodedata
+
+from django.core.cache import caches
+
+
+def normalise_text(text: str) -> str:
+    # Differences in unicode form and whitespace don't change the result
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class HashedResultCache:
+    def __init__(self, name: str, alias: str, normalise: bool = True):
+        # Don't normalise if whitespace can change the result
+        self.name = name
+        self.alias = alias
+        self.normalise = normalise
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, text: str, version: str) -> str:
+        if self.normalise:
+            text = normalise_text(text)
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        return f"{self.name}:{version}:{text_hash}"
+
+    def _count(self, hits: int, misses: int) -> None:
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, text: str, version: str):
+        # Returns None if not cached
+        result = self.cache.get(self.make_key(text, version))
+        self._count(int(result is not None), int(result is None))
+        return result
+
+    async def aget(self, text: str, version: str):
+        result = await self.cache.aget(self.make_key(text, version))
+        self._count(int(result is not None), int(result is None))
+        return result
+
+    def get_many(self, texts: list[str], version: str) -> dict:
+        # Returns the cached results by text, leaving out texts not cached
+        keys = {text: self.make_key(text, version) for text in texts}
+        cached = self.cache.get_many(keys.values())
+        results = {text: cached[key] for text, key in keys.items() if key in cached}
+        self._count(len(results), len(keys) - len(results))
+        return results
+
+    def set(self, text: str, version: str, result) -> None:
+        self.cache.set(self.make_key(text, version), result)
+
+    async def aset(self, text: str, version: str, result) -> None:
+        await self.cache.aset(self.make_key(text, version), result)
+
+    def set_many(self, results: dict, version: str) -> None:
+        self.cache.set_many({self.make_key(text, version): result for text, result in results.items()})
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
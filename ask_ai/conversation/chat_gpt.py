@@ -5,14 +5,20 @@ At the moment we are using GPT3.5 turbo model.
 When we extend this, functions will need to be generalised and amended -
 inputs/outputs may be in different formats.
 """
+import contextlib
+import functools
+from collections.abc import AsyncIterator, Iterator
+
 import openai
 import tiktoken
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db.models import Q
 
 from ask_ai.conversation.constants import BUFFER_TOKENS, TOKEN_LIMITS
 from ask_ai.conversation.models import Chat, Prompt
 
-from . import constants, utils
+from . import caching, constants, encodings, llm_limiter, llm_scheduler, openai_client, utils
 
 openai.api_key = settings.OPENAI_KEY
 
@@ -25,10 +31,79 @@ OPEN_AI_API_ERRORS = (
     openai.error.ServiceUnavailableError,
 )
 
+MODELS_WITH_TOKEN_COUNTS = (
+    "gpt-3.5-turbo-0125",
+    "gpt-3.5-turbo-1106",
+    "gpt-3.5-turbo",
+    "gpt-3.5-turbo-0613",
+    "gpt-3.5-turbo-16k-0613",
+    "gpt-4",
+    "gpt-4-0314",
+    "gpt-4-32k-0314",
+    "gpt-4-0613",
+    "gpt-4-32k-0613",
+)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_REPLY_PRIMER = 3  # every reply is primed with <|start|>assistant<|message|>
+# Prompts read at a time when building the chat history, newest first
+HISTORY_BATCH_SIZE = 20
+
+# Users often resubmit the same text (eg after an API error), no need to moderate it again
+moderation_cache = caching.HashedResultCache("moderation", settings.MODERATION_CACHE_ALIAS)
+# Most texts sent to the moderation endpoint in one call
+MODERATION_BATCH_SIZE = 32
+
 
 def chat_gpt_moderated(input_text: str) -> bool:
-    response = openai.Moderation.create(input=input_text)
-    return response["results"][0]["flagged"]
+    model = settings.OPENAI_MODERATION_MODEL
+    flagged = moderation_cache.get(input_text, model)
+    if flagged is None:
+        response = openai_client.create_moderation(input_text)
+        flagged = response["results"][0]["flagged"]
+        moderation_cache.set(input_text, model, flagged)
+    return flagged
+
+
+def chat_gpt_moderated_batch(input_texts: list[str], use_cache: bool = True) -> list[bool]:
+    """
+    Moderate several texts, sending those not already cached to the API
+    in batches of `MODERATION_BATCH_SIZE`.
+    With `use_cache` False, all texts are sent, and the fresh results replace those cached.
+    Returns whether each text is flagged, in the same order as the texts.
+    """
+    model = settings.OPENAI_MODERATION_MODEL
+    flagged_by_text = moderation_cache.get_many(input_texts, model) if use_cache else {}
+    # dict rather than set to keep the order, and send each text once
+    texts_to_moderate = list(dict.fromkeys(text for text in input_texts if text not in flagged_by_text))
+    for start in range(0, len(texts_to_moderate), MODERATION_BATCH_SIZE):
+        batch = texts_to_moderate[start : start + MODERATION_BATCH_SIZE]
+        response = openai_client.create_moderation(batch)
+        batch_flagged = {text: result["flagged"] for text, result in zip(batch, response["results"])}
+        moderation_cache.set_many(batch_flagged, model)
+        flagged_by_text.update(batch_flagged)
+    return [flagged_by_text[text] for text in input_texts]
+
+
+async def achat_gpt_moderated(input_text: str) -> bool:
+    model = settings.OPENAI_MODERATION_MODEL
+    flagged = await moderation_cache.aget(input_text, model)
+    if flagged is None:
+        response = await openai_client.acreate_moderation(input_text)
+        flagged = response["results"][0]["flagged"]
+        await moderation_cache.aset(input_text, model, flagged)
+    return flagged
+
+
+def get_messages_for_prompt(prompt: Prompt) -> list[tuple[dict, int | None]]:
+    """
+    Get the user/assistant messages for a prompt, each paired with the
+    stored token count of its content (None if not yet counted).
+    """
+    messages = [({"role": "user", "content": prompt.user_prompt}, prompt.tokens_user_prompt)]
+    if prompt.ai_response:
+        messages.append(({"role": "assistant", "content": prompt.ai_response}, prompt.tokens_ai_response))
+    return messages
 
 
 def get_valid_messages_for_chat(chat: type[Chat], latest_query: str | None = None) -> list[dict]:
@@ -39,12 +114,7 @@ def get_valid_messages_for_chat(chat: type[Chat], latest_query: str | None = Non
     all_valid_chat_prompts = utils.get_all_valid_prompts_from_chat(chat)
     messages = []
     for prompt in all_valid_chat_prompts:
-        user_prompt = {"role": "user", "content": prompt.user_prompt}
-        messages.append(user_prompt)
-        content = prompt.ai_response
-        if content:
-            ai_response = {"role": "assistant", "content": content}
-            messages.append(ai_response)
+        messages.extend(message for message, _ in get_messages_for_prompt(prompt))
     if latest_query:
         latest_prompt = {"role": "user", "content": latest_query}
         messages.append(latest_prompt)
@@ -56,18 +126,20 @@ def get_text_from_gpt35_turbo_response(response: dict) -> str:
     return content
 
 
-def get_gpt35_turbo_response(raw_inputs: dict) -> dict:
-    response = openai.ChatCompletion.create(request_timeout=30, **raw_inputs)
+def get_costs_dollars(model_name: str, tokens_input: int, tokens_output: int) -> tuple[float, float]:
+    input_costs = tokens_input * constants.OPENAI_TOKEN_COSTS[model_name]["INPUT_TOKEN_COST_DOLLARS"]
+    output_costs = tokens_output * constants.OPENAI_TOKEN_COSTS[model_name]["OUTPUT_TOKEN_COST_DOLLARS"]
+    return input_costs, output_costs
+
+
+def get_outputs_from_gpt35_turbo_response(response: dict, model_name: str, ai_response_moderated: bool) -> dict:
     raw_ai_response = dict(response)
-    response_content = get_text_from_gpt35_turbo_response(response)
-    outputs_moderated = chat_gpt_moderated(response_content)
     tokens_input = raw_ai_response["usage"]["prompt_tokens"]
     tokens_output = raw_ai_response["usage"]["completion_tokens"]
-    input_costs = tokens_input * constants.OPENAI_TOKEN_COSTS[raw_inputs["model"]]["INPUT_TOKEN_COST_DOLLARS"]
-    output_costs = tokens_output * constants.OPENAI_TOKEN_COSTS[raw_inputs["model"]]["OUTPUT_TOKEN_COST_DOLLARS"]
+    input_costs, output_costs = get_costs_dollars(model_name, tokens_input, tokens_output)
     outputs = {
-        "ai_response": response_content,
-        "ai_response_moderated": outputs_moderated,
+        "ai_response": get_text_from_gpt35_turbo_response(response),
+        "ai_response_moderated": ai_response_moderated,
         "tokens_input": tokens_input,
         "tokens_output": tokens_output,
         "cost_input_dollars": input_costs,
@@ -76,45 +148,107 @@ def get_gpt35_turbo_response(raw_inputs: dict) -> dict:
     return outputs
 
 
+def estimate_request_tokens(raw_inputs: dict) -> int:
+    # As OpenAI counts tokens towards rate limits: max_tokens plus about one token per 4 characters of the messages
+    characters = sum(len(message["content"]) for message in raw_inputs["messages"])
+    return raw_inputs.get("max_tokens", 0) + characters // 4
+
+
+def get_attempt_limit(limit_chat_completion, raw_inputs: dict):
+    # A slot and tokens are taken for each attempt at the call, so they aren't held while waiting to retry
+    return functools.partial(limit_chat_completion, estimate_request_tokens(raw_inputs))
+
+
+def get_gpt35_turbo_response(raw_inputs: dict) -> dict:
+    response = openai_client.create_chat_completion(
+        attempt_limit=get_attempt_limit(llm_limiter.limit_chat_completion, raw_inputs), **raw_inputs
+    )
+    response_content = get_text_from_gpt35_turbo_response(response)
+    outputs_moderated = chat_gpt_moderated(response_content)
+    return get_outputs_from_gpt35_turbo_response(response, raw_inputs["model"], outputs_moderated)
+
+
+async def aget_gpt35_turbo_response(raw_inputs: dict) -> dict:
+    response = await openai_client.acreate_chat_completion(
+        attempt_limit=get_attempt_limit(llm_limiter.alimit_chat_completion, raw_inputs), **raw_inputs
+    )
+    response_content = get_text_from_gpt35_turbo_response(response)
+    outputs_moderated = await achat_gpt_moderated(response_content)
+    return get_outputs_from_gpt35_turbo_response(response, raw_inputs["model"], outputs_moderated)
+
+
+def stream_gpt35_turbo_response(raw_inputs: dict) -> Iterator[str]:
+    """
+    Yield the text of the response as chunks arrive from the API.
+    Timeout is for the gap between chunks, not the whole response.
+    """
+    response = openai_client.create_chat_completion(
+        stream=True, attempt_limit=get_attempt_limit(llm_limiter.limit_chat_completion, raw_inputs), **raw_inputs
+    )
+    # The limit is held until the stream has been read, or closed if this stops part way
+    with contextlib.closing(response):
+        for chunk in response:
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                yield content
+
+
+async def astream_gpt35_turbo_response(raw_inputs: dict) -> AsyncIterator[str]:
+    # As for sync, the timeout is for the gap between chunks, with a longer limit on the whole response
+    response = await openai_client.acreate_chat_completion(
+        stream=True, attempt_limit=get_attempt_limit(llm_limiter.alimit_chat_completion, raw_inputs), **raw_inputs
+    )
+    async with contextlib.aclosing(response):
+        async for chunk in response:
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                yield content
+
+
 def num_tokens_from_string(string: str, model_name: str) -> int:
-    encoding = tiktoken.encoding_for_model(model_name)
+    encoding = encodings.get_encoding_for_model(model_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
+def is_token_count_over_limit(length: int, model: Prompt.LLMModels, buffer: int = 0) -> bool:
+    return length > (TOKEN_LIMITS[model] - buffer)
+
+
 def is_prompt_over_token_limit(prompt_str: str, model: Prompt.LLMModels, buffer: int = 0) -> bool:
     model_name = model.label
     length = num_tokens_from_string(prompt_str, model_name)
-    over_limit = length > (TOKEN_LIMITS[model] - buffer)
-    return over_limit
+    return is_token_count_over_limit(length, model, buffer)
 
 
-def get_number_tokens_for_messages(messages: list[dict], model_name: str) -> int:
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    if model_name not in (
-        "gpt-3.5-turbo-0125",
-        "gpt-3.5-turbo-1106",
-        "gpt-3.5-turbo",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-    ):
+def get_encoding_for_model(model_name: str) -> tiktoken.Encoding:
+    if model_name not in MODELS_WITH_TOKEN_COUNTS:
         raise NotImplementedError(f"Number of tokens is not implemented for model {model_name}.")
-    tokens_per_message = 3
-    tokens_per_name = 1
-    encoding = tiktoken.encoding_for_model(model_name)
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
+    return encodings.get_encoding_for_model(model_name)
+
+
+def warm_up_encodings_in_background():
+    return encodings.warm_up_encodings_in_background(MODELS_WITH_TOKEN_COUNTS)
+
+
+def get_number_tokens_for_message(message: dict, encoding: tiktoken.Encoding, content_tokens: int | None = None) -> int:
+    # content_tokens - token count of the message content if already known, to avoid re-encoding it
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        if key == "content" and content_tokens is not None:
+            num_tokens += content_tokens
+        else:
             num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        if key == "name":
+            num_tokens += TOKENS_PER_NAME
+    return num_tokens
+
+
+def get_number_tokens_for_messages(messages: list[dict], model_name: str) -> int:
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    encoding = get_encoding_for_model(model_name)
+    num_tokens = sum(get_number_tokens_for_message(message, encoding) for message in messages)
+    num_tokens += TOKENS_REPLY_PRIMER
     return num_tokens
 
 
@@ -127,31 +261,143 @@ def length_messages_over_token_limit(messages: list[dict], model: Prompt.LLMMode
 
 
 def get_latest_messages_to_token_limit(
-    messages: list[dict], model: Prompt.LLMModels, buffer: int
+    messages: list[dict], model: Prompt.LLMModels, buffer: int, message_tokens: list[int] | None = None
 ) -> tuple[int, list[dict]]:
-    output_messages = messages.copy()  # don't alter the original list
-    num_tokens, over_limit = length_messages_over_token_limit(output_messages, model, buffer)
-    while over_limit:
-        output_messages.pop(0)
-        num_tokens, over_limit = length_messages_over_token_limit(output_messages, model, buffer)
-    return num_tokens, output_messages
+    # message_tokens - number of tokens each message adds, counted here if not given
+    # Single pass back from the newest message, keeping the longest run that fits under the limit
+    if message_tokens is None:
+        encoding = get_encoding_for_model(model.label)
+        message_tokens = [get_number_tokens_for_message(message, encoding) for message in messages]
+    token_limit = TOKEN_LIMITS[model] - buffer
+    num_tokens = TOKENS_REPLY_PRIMER
+    first_kept = len(messages)
+    while first_kept > 0 and (num_tokens + message_tokens[first_kept - 1]) < token_limit:
+        first_kept -= 1
+        num_tokens += message_tokens[first_kept]
+    return num_tokens, messages[first_kept:]  # don't alter the original list
+
+
+def get_latest_valid_messages_to_token_limit(
+    chat: type[Chat], model: Prompt.LLMModels, buffer: int
+) -> tuple[int, list[dict]]:
+    """
+    Get the newest valid messages for chat that fit under the token limit, like `get_latest_messages_to_token_limit`.
+    Reads prompts newest first, `HISTORY_BATCH_SIZE` at a time, and stops at the first message that doesn't fit,
+    so long chats don't read and count prompts that would be dropped.
+    Uses the token counts stored on each prompt, only encoding text that hasn't been counted.
+    """
+    encoding = get_encoding_for_model(model.label)
+    token_limit = TOKEN_LIMITS[model] - buffer
+    num_tokens = TOKENS_REPLY_PRIMER
+    messages = []  # newest first
+    prompts = (
+        utils.get_all_valid_prompts_from_chat(chat)
+        .only("created_at", "user_prompt", "ai_response", "tokens_user_prompt", "tokens_ai_response")
+        .order_by("-created_at", "-id")
+    )
+    last_prompt = None
+    while True:
+        batch_queryset = prompts
+        if last_prompt:
+            batch_queryset = prompts.filter(
+                Q(created_at__lt=last_prompt.created_at) | Q(created_at=last_prompt.created_at, id__lt=last_prompt.id)
+            )
+        batch = list(batch_queryset[:HISTORY_BATCH_SIZE])
+        for prompt in batch:
+            for message, content_tokens in reversed(get_messages_for_prompt(prompt)):
+                message_tokens = get_number_tokens_for_message(message, encoding, content_tokens)
+                if num_tokens + message_tokens >= token_limit:
+                    return num_tokens, messages[::-1]
+                num_tokens += message_tokens
+                messages.append(message)
+        if len(batch) < HISTORY_BATCH_SIZE:
+            return num_tokens, messages[::-1]
+        last_prompt = batch[-1]
 
 
 def get_chat_gpt_inputs(chat: type[Chat], model: Prompt.LLMModels) -> dict:
-    messages = get_valid_messages_for_chat(chat)
-    num_tokens, truncated_messages = get_latest_messages_to_token_limit(messages, model=model, buffer=BUFFER_TOKENS)
+    num_tokens, truncated_messages = get_latest_valid_messages_to_token_limit(chat, model=model, buffer=BUFFER_TOKENS)
     max_tokens = TOKEN_LIMITS[model] - num_tokens  # how many tokens can be in the response
     chat_gpt_inputs = {"model": model.label, "messages": truncated_messages, "max_tokens": max_tokens}
     return chat_gpt_inputs
 
 
-def submit_valid_chat_to_chatgpt35(latest_prompt, chat_gpt_inputs):
-    outputs = get_gpt35_turbo_response(chat_gpt_inputs)
+# Reads history from the database and counts tokens, so run in a thread
+aget_chat_gpt_inputs = sync_to_async(get_chat_gpt_inputs)
+
+
+def update_prompt_with_outputs(latest_prompt: Prompt, outputs: dict, model_name: str) -> None:
     latest_prompt.ai_response = outputs.get("ai_response")
     latest_prompt.ai_response_moderated = outputs.get("ai_response_moderated")
     latest_prompt.tokens_input = outputs.get("tokens_input")
     latest_prompt.tokens_output = outputs.get("tokens_output")
+    latest_prompt.tokens_ai_response = num_tokens_from_string(latest_prompt.ai_response, model_name)
     latest_prompt.cost_input_dollars = outputs.get("cost_input_dollars")
     latest_prompt.cost_output_dollars = outputs.get("cost_output_dollars")
+
+
+def update_prompt_with_streamed_response(
+    latest_prompt: Prompt, response_content: str, ai_response_moderated: bool, chat_gpt_inputs: dict
+) -> None:
+    model_name = chat_gpt_inputs["model"]
+    # Usage isn't returned for streamed responses, so count the tokens ourselves
+    tokens_input = get_number_tokens_for_messages(chat_gpt_inputs["messages"], model_name)
+    tokens_output = num_tokens_from_string(response_content, model_name)
+    input_costs, output_costs = get_costs_dollars(model_name, tokens_input, tokens_output)
+    latest_prompt.ai_response = response_content
+    latest_prompt.ai_response_moderated = ai_response_moderated
+    latest_prompt.tokens_input = tokens_input
+    latest_prompt.tokens_output = tokens_output
+    latest_prompt.tokens_ai_response = tokens_output
+    latest_prompt.cost_input_dollars = input_costs
+    latest_prompt.cost_output_dollars = output_costs
+
+
+def submit_valid_chat_to_chatgpt35(latest_prompt, chat_gpt_inputs):
+    with llm_scheduler.user_turn(latest_prompt.chat.user_id):
+        outputs = get_gpt35_turbo_response(chat_gpt_inputs)
+    update_prompt_with_outputs(latest_prompt, outputs, chat_gpt_inputs["model"])
     latest_prompt.save()
     return latest_prompt
+
+
+async def asubmit_valid_chat_to_chatgpt35(latest_prompt, chat_gpt_inputs):
+    user_id = await Chat.objects.filter(id=latest_prompt.chat_id).values_list("user_id", flat=True).aget()
+    async with llm_scheduler.auser_turn(user_id):
+        outputs = await aget_gpt35_turbo_response(chat_gpt_inputs)
+    update_prompt_with_outputs(latest_prompt, outputs, chat_gpt_inputs["model"])
+    await latest_prompt.asave()
+    return latest_prompt
+
+
+def stream_valid_chat_to_chatgpt35(latest_prompt: Prompt, chat_gpt_inputs: dict) -> Iterator[str]:
+    """
+    Yield the AI response as it is streamed from the API.
+    Once finished, the full response is moderated before being saved to the prompt.
+    """
+    chunks = []
+    with llm_scheduler.user_turn(latest_prompt.chat.user_id):
+        for chunk in stream_gpt35_turbo_response(chat_gpt_inputs):
+            chunks.append(chunk)
+            yield chunk
+    response_content = "".join(chunks)
+    ai_response_moderated = chat_gpt_moderated(response_content)
+    update_prompt_with_streamed_response(latest_prompt, response_content, ai_response_moderated, chat_gpt_inputs)
+    latest_prompt.save()
+
+
+async def astream_valid_chat_to_chatgpt35(latest_prompt: Prompt, chat_gpt_inputs: dict) -> AsyncIterator[str]:
+    # As `stream_valid_chat_to_chatgpt35`, for the async views
+    user_id = await Chat.objects.filter(id=latest_prompt.chat_id).values_list("user_id", flat=True).aget()
+    chunks = []
+    async with llm_scheduler.auser_turn(user_id):
+        async for chunk in astream_gpt35_turbo_response(chat_gpt_inputs):
+            chunks.append(chunk)
+            yield chunk
+    response_content = "".join(chunks)
+    ai_response_moderated = await achat_gpt_moderated(response_content)
+    # Counting tokens is CPU bound, keep it off the event loop
+    await sync_to_async(update_prompt_with_streamed_response, thread_sensitive=False)(
+        latest_prompt, response_content, ai_response_moderated, chat_gpt_inputs
+    )
+    await latest_prompt.asave()
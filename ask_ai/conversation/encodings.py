@@ -0,0 +1,46 @@
+"""
+tiktoken encodings, for counting tokens.
+
+tiktoken downloads the BPE file for an encoding the first time it is used, and caches it in
+`TIKTOKEN_CACHE_DIR`. Seed the cache when building (`manage.py seed_tiktoken_cache`), so servers
+don't need to reach the internet. Encoders are loaded once per process and kept, and servers
+load them at startup so the first request doesn't wait for them.
+"""
+import logging
+import threading
+import time
+
+import tiktoken
+
+logger = logging.getLogger("application")
+
+_encodings: dict[str, tiktoken.Encoding] = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding_for_model(model_name: str) -> tiktoken.Encoding:
+    encoding = _encodings.get(model_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model_name)
+            if encoding is None:
+                encoding = tiktoken.encoding_for_model(model_name)
+                _encodings[model_name] = encoding
+    return encoding
+
+
+def warm_up_encodings(model_names) -> None:
+    start = time.monotonic()
+    try:
+        for model_name in model_names:
+            get_encoding_for_model(model_name)
+    except Exception:
+        logger.exception("Failed to load tiktoken encodings, is TIKTOKEN_CACHE_DIR seeded?")
+        return
+    logger.info("Loaded tiktoken encodings in %.1f seconds", time.monotonic() - start)
+
+
+def warm_up_encodings_in_background(model_names) -> threading.Thread:
+    thread = threading.Thread(target=warm_up_encodings, args=(model_names,), name="tiktoken-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,47 @@
+from health_check.backends import BaseHealthCheckBackend
+from health_check.exceptions import ServiceUnavailable, ServiceWarning
+
+from . import llm_scheduler, openai_client, sensitivity_check
+
+
+class OpenAICircuitBreakerHealthCheck(BaseHealthCheckBackend):
+    # The site still works without OpenAI, so don't fail the health check
+    critical_service = False
+
+    def check_status(self):
+        status = openai_client.circuit_breaker.get_status()
+        if status["state"] != openai_client.CircuitBreaker.CLOSED:
+            self.add_error(ServiceUnavailable(f"OpenAI circuit breaker {status['state']}"))
+
+    def identifier(self):
+        return "OpenAICircuitBreaker"
+
+
+class SensitivityCheckAnalyzerHealthCheck(BaseHealthCheckBackend):
+    # Prompts are still checked while the analyzer loads, the first just takes longer
+    critical_service = False
+
+    def check_status(self):
+        if sensitivity_check.warm_up_error:
+            self.add_error(ServiceUnavailable(f"Analyzer failed to load: {sensitivity_check.warm_up_error}"))
+        elif not sensitivity_check.is_analyzer_engine_ready():
+            self.add_error(ServiceWarning("Analyzer not loaded yet"))
+
+    def identifier(self):
+        return "SensitivityCheckAnalyzer"
+
+
+class LLMSchedulerHealthCheck(BaseHealthCheckBackend):
+    # Calls waiting their turn are still answered, within `LLM_SCHEDULER_MAX_WAIT_SECONDS`
+    critical_service = False
+
+    def check_status(self):
+        # Of the process answering the health check, without the user ids
+        queue_lengths = sorted(llm_scheduler.get_queue_lengths().values(), reverse=True)
+        if queue_lengths:
+            self.add_error(
+                ServiceWarning(f"{sum(queue_lengths)} LLM calls waiting, by user: {', '.join(map(str, queue_lengths))}")
+            )
+
+    def identifier(self):
+        return "LLMScheduler"
@@ -0,0 +1,194 @@
+"""
+A job queue in Postgres for getting responses from ChatGPT outside the web request.
+
+Web requests add a `ChatCompletionJob` and mark the prompt as pending. Worker processes
+(`manage.py run_chat_completion_worker`) claim jobs with `SELECT ... FOR UPDATE SKIP LOCKED`,
+so several workers can share the queue without taking the same job.
+The next job claimed is the oldest from the users with fewest jobs running, so one user
+with many prompts doesn't hold up everyone else.
+Workers refresh the lock of the job they are running, and jobs left running by a worker that crashed
+are put back in the queue once their lock times out. A worker only saves its result while it still
+holds the lock, so a job that was put back isn't answered twice.
+"""
+import contextlib
+import datetime
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import chat_gpt, llm_scheduler, models
+
+logger = logging.getLogger("application")
+
+Status = models.ChatCompletionJob.Status
+
+
+def enqueue_chat_completion(prompt: models.Prompt) -> models.ChatCompletionJob:
+    with transaction.atomic():
+        prompt.response_pending = True
+        prompt.save()
+        job = models.ChatCompletionJob.objects.create(prompt=prompt)
+    return job
+
+
+def count_jobs_by_user(status: str) -> dict:
+    # {user id: number of jobs with the status}
+    jobs_by_user = (
+        models.ChatCompletionJob.objects.filter(status=status)
+        .values("prompt__chat__user_id")
+        .annotate(jobs=Count("id"))
+        .order_by()
+    )
+    return {row["prompt__chat__user_id"]: row["jobs"] for row in jobs_by_user}
+
+
+def claim_next_job(worker_id: str) -> models.ChatCompletionJob | None:
+    running_for_user = (
+        models.ChatCompletionJob.objects.filter(
+            status=Status.RUNNING, prompt__chat__user_id=OuterRef("prompt__chat__user_id")
+        )
+        .values("prompt__chat__user_id")
+        .annotate(jobs=Count("id"))
+        .order_by()
+        .values("jobs")
+    )
+    with transaction.atomic():
+        job = (
+            models.ChatCompletionJob.objects.select_for_update(skip_locked=True, of=("self",))
+            .filter(status=Status.PENDING)
+            .annotate(running_for_user=Coalesce(Subquery(running_for_user), 0))
+            .order_by("running_for_user", "created_at")
+            .first()
+        )
+        if not job:
+            return None
+        job.status = Status.RUNNING
+        job.attempts += 1
+        job.locked_at = timezone.now()
+        job.locked_by = worker_id
+        job.save()
+    return job
+
+
+def refresh_lock(job: models.ChatCompletionJob) -> bool:
+    # Returns whether the job is still running with this worker's lock
+    return bool(
+        models.ChatCompletionJob.objects.filter(id=job.id, locked_by=job.locked_by, status=Status.RUNNING).update(
+            locked_at=timezone.now()
+        )
+    )
+
+
+@contextlib.contextmanager
+def keep_lock(job: models.ChatCompletionJob):
+    """
+    Refresh the job's lock in a background thread while the block runs,
+    so a call to the API taking longer than the lock timeout isn't taken for an abandoned job.
+    """
+    stop_event = threading.Event()
+    refresh_interval = settings.LLM_JOB_LOCK_TIMEOUT_SECONDS / 3
+
+    def refresh():
+        try:
+            while not stop_event.wait(refresh_interval):
+                if not refresh_lock(job):
+                    break
+        except Exception:
+            logger.exception("Couldn't refresh lock of chat completion job %s", job.id)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=refresh, name=f"{threading.current_thread().name}-lock", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def run_job(job: models.ChatCompletionJob) -> None:
+    prompt = job.prompt
+    prompt.response_pending = False
+    try:
+        llm_model = models.Prompt.LLMModels(prompt.llm_model)
+        chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(prompt.chat, llm_model)
+        with keep_lock(job), llm_scheduler.user_turn(prompt.chat.user_id):
+            outputs = chat_gpt.get_gpt35_turbo_response(chat_gpt_inputs)
+        chat_gpt.update_prompt_with_outputs(prompt, outputs, chat_gpt_inputs["model"])
+        status = Status.DONE
+    except chat_gpt.OPEN_AI_API_ERRORS:
+        prompt.api_call_error = True
+        status = Status.FAILED
+    except Exception:
+        logger.exception("Chat completion job %s failed", job.id)
+        prompt.api_call_error = True
+        status = Status.FAILED
+    with transaction.atomic():
+        # Only if the job wasn't put back in the queue while it ran, otherwise another worker answers it
+        finished = models.ChatCompletionJob.objects.filter(
+            id=job.id, locked_by=job.locked_by, status=Status.RUNNING
+        ).update(status=status, modified_at=timezone.now())
+        if not finished:
+            logger.warning("Chat completion job %s was taken from %s, dropping its result", job.id, job.locked_by)
+            return
+        prompt.save()
+    job.status = status
+
+
+def process_next_job(worker_id: str) -> bool:
+    # Returns whether there was a job to run
+    job = claim_next_job(worker_id)
+    if not job:
+        return False
+    run_job(job)
+    return True
+
+
+def recover_abandoned_jobs() -> int:
+    """
+    Put jobs whose worker has stopped (lock timed out) back in the queue,
+    or fail them if they have used up their attempts.
+    """
+    locked_before = timezone.now() - datetime.timedelta(seconds=settings.LLM_JOB_LOCK_TIMEOUT_SECONDS)
+    recovered = 0
+    with transaction.atomic():
+        abandoned_jobs = models.ChatCompletionJob.objects.select_for_update(skip_locked=True).filter(
+            status=Status.RUNNING, locked_at__lt=locked_before
+        )
+        for job in abandoned_jobs.select_related("prompt"):
+            logger.warning("Recovering chat completion job %s abandoned by %s", job.id, job.locked_by)
+            if job.attempts < settings.LLM_JOB_MAX_ATTEMPTS:
+                job.status = Status.PENDING
+            else:
+                job.status = Status.FAILED
+                job.prompt.response_pending = False
+                job.prompt.api_call_error = True
+                job.prompt.save()
+            job.locked_at = None
+            job.locked_by = ""
+            job.save()
+            recovered += 1
+    return recovered
+
+
+def run_worker(worker_id: str, stop_event: threading.Event, poll_interval: float) -> None:
+    try:
+        while not stop_event.is_set():
+            # As in a request, don't carry on with a connection that has broken or reached its max age
+            close_old_connections()
+            try:
+                found_job = process_next_job(worker_id)
+            except Exception:
+                logger.exception("Chat completion worker %s error", worker_id)
+                close_old_connections()
+                found_job = False
+            if not found_job:
+                stop_event.wait(poll_interval)
+    finally:
+        connection.close()
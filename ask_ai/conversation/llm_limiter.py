@@ -0,0 +1,229 @@
+"""
+Limits on calls to ChatGPT shared by all processes (web servers and job queue workers).
+
+At most `LLM_LIMITER_MAX_IN_FLIGHT` completions run at once: each call holds a Postgres advisory lock
+on one of that many slots, released when the call ends (or when the connection closes, if the process dies).
+Advisory locks belong to a database session, so this needs direct connections to Postgres
+rather than a pooler in transaction mode.
+
+Tokens sent per minute are counted in a shared cache (`LLM_LIMITER_CACHE_URL`).
+Calls over either limit wait their turn for up to `LLM_LIMITER_MAX_WAIT_SECONDS`, then fail with
+`LimiterTimeoutError`, which is handled like the API being unavailable.
+"""
+import asyncio
+import contextlib
+import logging
+import random
+import threading
+import time
+
+import openai
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+logger = logging.getLogger("application")
+
+# First key of our advisory locks, to keep them apart from any others
+ADVISORY_LOCK_NAMESPACE = 7245
+QUEUE_DEPTH_KEY = "llm-limiter:waiting"
+MIN_POLL_SECONDS = 0.05
+MAX_POLL_SECONDS = 1
+
+
+class LimiterTimeoutError(openai.error.ServiceUnavailableError):
+    pass
+
+
+class LimiterStats:
+    # Waits in this process
+    def __init__(self):
+        self.calls = 0
+        self.waited_calls = 0
+        self.timed_out_calls = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait_seconds: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self.calls += 1
+            self.waited_calls += int(wait_seconds > 0)
+            self.timed_out_calls += int(timed_out)
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "waited_calls": self.waited_calls,
+                "timed_out_calls": self.timed_out_calls,
+                "mean_wait_seconds": self.total_wait_seconds / self.calls if self.calls else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+stats = LimiterStats()
+
+
+def get_cache():
+    return caches[settings.LLM_LIMITER_CACHE_ALIAS]
+
+
+def get_queue_depth() -> int:
+    # Calls waiting in all processes sharing the cache
+    return get_cache().get(QUEUE_DEPTH_KEY, 0)
+
+
+def get_stats() -> dict:
+    return {"queue_depth": get_queue_depth(), **stats.as_dict()}
+
+
+def _change_queue_depth(delta: int) -> None:
+    cache = get_cache()
+    cache.add(QUEUE_DEPTH_KEY, 0, timeout=None)
+    try:
+        cache.incr(QUEUE_DEPTH_KEY, delta)
+    except ValueError:
+        # Key evicted from the cache, only affects reporting
+        pass
+
+
+def try_acquire_slot() -> int | None:
+    # Returns the slot locked, or None if all are in use. Start at a random slot to spread contention.
+    max_in_flight = settings.LLM_LIMITER_MAX_IN_FLIGHT
+    first_slot = random.randrange(max_in_flight)
+    with connection.cursor() as cursor:
+        for i in range(max_in_flight):
+            slot = (first_slot + i) % max_in_flight
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [ADVISORY_LOCK_NAMESPACE, slot])
+            if cursor.fetchone()[0]:
+                return slot
+    return None
+
+
+def release_slot(slot: int) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [ADVISORY_LOCK_NAMESPACE, slot])
+
+
+def _get_tokens_key() -> str:
+    return f"llm-limiter:tokens:{int(time.time() // 60)}"
+
+
+def try_reserve_tokens(tokens: int) -> str | None:
+    """
+    Fixed one minute windows. A call on its own is always allowed, even if over the limit.
+    Returns the key of the window the tokens are reserved in, or None if over the limit.
+    """
+    cache = get_cache()
+    key = _get_tokens_key()
+    cache.add(key, 0, timeout=120)
+    try:
+        tokens_used = cache.incr(key, tokens)
+    except ValueError:
+        return key
+    if tokens_used > settings.LLM_LIMITER_TOKENS_PER_MINUTE and tokens_used != tokens:
+        cache.decr(key, tokens)
+        return None
+    return key
+
+
+def _try_acquire(tokens: int, tokens_key: str | None) -> tuple[str | None, int | None]:
+    # One go at getting through both limits, returns the key the tokens are reserved in and the slot locked.
+    # A reservation in a past window no longer counts, so reserve again in this one.
+    if tokens_key != _get_tokens_key():
+        tokens_key = try_reserve_tokens(tokens)
+    slot = try_acquire_slot() if tokens_key else None
+    return tokens_key, slot
+
+
+def _give_up(tokens: int, tokens_key: str | None, wait_seconds: float) -> LimiterTimeoutError:
+    if tokens_key:
+        try:
+            get_cache().decr(tokens_key, tokens)
+        except ValueError:
+            # Window expired or evicted, nothing to give back
+            pass
+    stats.record(wait_seconds, timed_out=True)
+    logger.warning("Gave up waiting for LLM capacity after %.1f seconds (%s)", wait_seconds, get_stats())
+    return LimiterTimeoutError("Too many requests to the LLM, try again later")
+
+
+def _record_acquired(wait_seconds: float) -> None:
+    stats.record(wait_seconds)
+    if wait_seconds:
+        logger.info("Waited %.2f seconds for LLM capacity", wait_seconds)
+
+
+def acquire(tokens: int) -> int:
+    start = time.monotonic()
+    tokens_key, slot = _try_acquire(tokens, None)
+    if slot is not None:
+        _record_acquired(0)
+        return slot
+    _change_queue_depth(1)
+    try:
+        poll_seconds = MIN_POLL_SECONDS
+        while True:
+            wait_seconds = time.monotonic() - start
+            if wait_seconds >= settings.LLM_LIMITER_MAX_WAIT_SECONDS:
+                raise _give_up(tokens, tokens_key, wait_seconds)
+            time.sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, MAX_POLL_SECONDS)
+            tokens_key, slot = _try_acquire(tokens, tokens_key)
+            if slot is not None:
+                _record_acquired(time.monotonic() - start)
+                return slot
+    finally:
+        _change_queue_depth(-1)
+
+
+async def aacquire(tokens: int) -> int:
+    # Database calls run in the thread for this request, so the lock is released on the same connection
+    start = time.monotonic()
+    tokens_key, slot = await sync_to_async(_try_acquire)(tokens, None)
+    if slot is not None:
+        _record_acquired(0)
+        return slot
+    await sync_to_async(_change_queue_depth)(1)
+    try:
+        poll_seconds = MIN_POLL_SECONDS
+        while True:
+            wait_seconds = time.monotonic() - start
+            if wait_seconds >= settings.LLM_LIMITER_MAX_WAIT_SECONDS:
+                raise await sync_to_async(_give_up)(tokens, tokens_key, wait_seconds)
+            await asyncio.sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, MAX_POLL_SECONDS)
+            tokens_key, slot = await sync_to_async(_try_acquire)(tokens, tokens_key)
+            if slot is not None:
+                _record_acquired(time.monotonic() - start)
+                return slot
+    finally:
+        await sync_to_async(_change_queue_depth)(-1)
+
+
+@contextlib.contextmanager
+def limit_chat_completion(tokens: int):
+    if not settings.LLM_LIMITER_ENABLED:
+        yield
+        return
+    slot = acquire(tokens)
+    try:
+        yield
+    finally:
+        release_slot(slot)
+
+
+@contextlib.asynccontextmanager
+async def alimit_chat_completion(tokens: int):
+    if not settings.LLM_LIMITER_ENABLED:
+        yield
+        return
+    slot = await aacquire(tokens)
+    try:
+        yield
+    finally:
+        await sync_to_async(release_slot)(slot)
@@ -0,0 +1,146 @@
+"""
+Fair sharing of ChatGPT calls between users within a process.
+
+Each process runs at most `LLM_SCHEDULER_CONCURRENCY` calls at once - the limit isn't shared between processes,
+so the most calls at once overall is that times the number of web server and worker processes.
+When all are in use, waiting calls
+get the next free slot round-robin between users, so a user with several requests (eg in several tabs)
+waits behind one request from each other waiting user, rather than everyone queueing in arrival order.
+Calls that wait longer than `LLM_SCHEDULER_MAX_WAIT_SECONDS` fail with `SchedulerTimeoutError`,
+which is handled like the API being unavailable. The health check shows how many calls each user has waiting.
+
+Job queue workers share their capacity fairly when claiming jobs (see `job_queue.claim_next_job`).
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+
+import openai
+from django.conf import settings
+
+logger = logging.getLogger("application")
+
+
+class SchedulerTimeoutError(openai.error.ServiceUnavailableError):
+    pass
+
+
+class Waiter:
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+
+
+def _set_granted(granted: asyncio.Future) -> None:
+    # The wait may have timed out, cancelling the future, just as the slot was granted
+    if not granted.done():
+        granted.set_result(None)
+
+
+class FairScheduler:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        # Waiters for each user, users in the order they get their next turn
+        self._queues = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _try_acquire_or_wait(self, user_id, waiter: Waiter) -> bool:
+        # Returns True if a slot was free, otherwise queues the waiter
+        with self._lock:
+            if self.running < self.concurrency and not self._queues:
+                self.running += 1
+                return True
+            self._queues.setdefault(user_id, collections.deque()).append(waiter)
+            queue_lengths = self._get_queue_lengths()
+        logger.info("Waiting for LLM capacity, queue lengths by user: %s", queue_lengths)
+        return False
+
+    def _give_up(self, user_id, waiter: Waiter) -> bool:
+        # Returns True if the slot was granted just as the wait ended
+        with self._lock:
+            if waiter.granted:
+                return True
+            queue = self._queues[user_id]
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[user_id]
+            return False
+
+    def acquire(self, user_id, timeout: float | None = None) -> None:
+        event = threading.Event()
+        waiter = Waiter(event.set)
+        if self._try_acquire_or_wait(user_id, waiter):
+            return
+        if not event.wait(timeout) and not self._give_up(user_id, waiter):
+            raise SchedulerTimeoutError("Too many requests to the LLM, try again later")
+
+    async def aacquire(self, user_id, timeout: float | None = None) -> None:
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        waiter = Waiter(lambda: loop.call_soon_threadsafe(_set_granted, granted))
+        if self._try_acquire_or_wait(user_id, waiter):
+            return
+        try:
+            await asyncio.wait_for(granted, timeout)
+        except asyncio.TimeoutError:
+            if not self._give_up(user_id, waiter):
+                raise SchedulerTimeoutError("Too many requests to the LLM, try again later")
+        except asyncio.CancelledError:
+            # eg the user went away, pass on the slot if it was granted
+            if self._give_up(user_id, waiter):
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._queues:
+                self.running -= 1
+                return
+            # Hand the slot to the next user in turn, who then goes to the back
+            user_id, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                self._queues[user_id] = queue
+            waiter.granted = True
+        waiter.notify()
+
+    def _get_queue_lengths(self) -> dict:
+        return {user_id: len(queue) for user_id, queue in self._queues.items()}
+
+    def get_queue_lengths(self) -> dict:
+        with self._lock:
+            return self._get_queue_lengths()
+
+
+scheduler = FairScheduler(settings.LLM_SCHEDULER_CONCURRENCY)
+
+
+def get_queue_lengths() -> dict:
+    return scheduler.get_queue_lengths()
+
+
+@contextlib.contextmanager
+def user_turn(user_id):
+    if not settings.LLM_SCHEDULER_ENABLED:
+        yield
+        return
+    scheduler.acquire(user_id, settings.LLM_SCHEDULER_MAX_WAIT_SECONDS)
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+@contextlib.asynccontextmanager
+async def auser_turn(user_id):
+    if not settings.LLM_SCHEDULER_ENABLED:
+        yield
+        return
+    await scheduler.aacquire(user_id, settings.LLM_SCHEDULER_MAX_WAIT_SECONDS)
+    try:
+        yield
+    finally:
+        scheduler.release()
@@ -0,0 +1,52 @@
+"""
+Fill in the token counts of prompts saved before they were stored on `Prompt`.
+
+Works through the prompts in batches ordered by id, so it can be stopped and re-run.
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ask_ai.conversation import chat_gpt, models
+
+# Prompts saved before the model was recorded
+DEFAULT_LLM_MODEL = models.Prompt.LLMModels.GPT35_TURBO
+
+
+def get_model_name_for_prompt(prompt: models.Prompt) -> str:
+    if not prompt.llm_model:
+        return DEFAULT_LLM_MODEL.label
+    return models.Prompt.LLMModels(prompt.llm_model).label
+
+
+class Command(BaseCommand):
+    help = "Store token counts for prompts and AI responses that have not been counted yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        prompts_to_count = (
+            models.Prompt.objects.filter(Q(tokens_user_prompt__isnull=True) | Q(tokens_ai_response__isnull=True))
+            .only("id", "llm_model", "user_prompt", "ai_response", "tokens_user_prompt", "tokens_ai_response")
+            .order_by("id")
+        )
+        total_updated = 0
+        last_id = None
+        while True:
+            batch_queryset = prompts_to_count if last_id is None else prompts_to_count.filter(id__gt=last_id)
+            batch = list(batch_queryset[:batch_size])
+            if not batch:
+                break
+            for prompt in batch:
+                model_name = get_model_name_for_prompt(prompt)
+                if prompt.tokens_user_prompt is None:
+                    prompt.tokens_user_prompt = chat_gpt.num_tokens_from_string(prompt.user_prompt, model_name)
+                if prompt.tokens_ai_response is None:
+                    prompt.tokens_ai_response = chat_gpt.num_tokens_from_string(prompt.ai_response, model_name)
+            # bulk_update doesn't touch `modified_at`
+            models.Prompt.objects.bulk_update(batch, ["tokens_user_prompt", "tokens_ai_response"])
+            total_updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Updated token counts for {total_updated} prompts")
+        self.stdout.write(self.style.SUCCESS(f"Finished, updated {total_updated} prompts"))
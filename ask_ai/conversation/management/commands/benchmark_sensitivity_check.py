@@ -0,0 +1,130 @@
+"""
+Compare the latency of the tiered sensitivity check with running every prompt through the full analyzer,
+and with verdicts cached, and check that all give the same verdicts.
+
+Uses some sample prompts, or prompts from a file (one per line).
+Also reports the memory used by loading the analyzer - to compare the full and trimmed spaCy pipelines,
+run it with `SENSITIVITY_CHECK_TRIMMED_PIPELINE` set to False and True.
+"""
+import gc
+import os
+import resource
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ask_ai.conversation import sensitivity_check
+
+SAMPLE_PROMPTS = [
+    "Can you explain what a linear regression is?",
+    "Write a short summary of the benefits of agile delivery for a government team.",
+    "What are the main differences between Python lists and tuples?",
+    "Draft an email inviting colleagues to a workshop on user research next week.",
+    "Can you please tell me about this top secret document?",
+    "This is OFFICIAL-SENSITIVE, please summarise the key points.",
+    "I want to know more about my friend who lives at 70 Whitehall, SW1A 2AS",
+    "Call me on 07777 888888 to discuss the project plan.",
+    "Our office landline is 0131 887449 if you need to reach the team.",
+    "Can you tell me about Winston Churchill?",
+    "Rishi Sunak is the Prime Minister in 2023",
+    "Please reply to mr@example.com with the meeting notes.",
+]
+
+
+def get_rss_mb() -> float:
+    # Current resident memory of this process, or the peak where /proc isn't available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def is_text_potentially_sensitive_uncached(input_text: str) -> bool:
+    if sensitivity_check.has_fast_check_match(input_text):
+        return True
+    return sensitivity_check.is_text_potentially_sensitive_by_analyzer_tier(input_text)
+
+
+def get_timings_ms(check, prompts: list[str], repeat: int) -> tuple[list[float], list[bool]]:
+    timings = []
+    verdicts = []
+    for _ in range(repeat):
+        verdicts = []
+        for prompt in prompts:
+            start = time.perf_counter()
+            verdicts.append(check(prompt))
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings, verdicts
+
+
+def format_timings(name: str, timings: list[float]) -> str:
+    percentiles = statistics.quantiles(timings, n=100)
+    return (
+        f"{name:<10} mean {statistics.mean(timings):8.2f} ms   p50 {percentiles[49]:8.2f} ms   "
+        f"p95 {percentiles[94]:8.2f} ms"
+    )
+
+
+class Command(BaseCommand):
+    help = "Benchmark the tiered sensitivity check against the full analyzer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", help="File of prompts to check, one per line")
+        parser.add_argument("--repeat", type=int, default=20, help="Times to check each prompt")
+
+    def handle(self, *args, **options):
+        if options["file"]:
+            with open(options["file"]) as prompts_file:
+                prompts = [line.strip() for line in prompts_file if line.strip()]
+        else:
+            prompts = SAMPLE_PROMPTS
+        if not prompts:
+            raise CommandError("No prompts to check")
+        # Load the analyzer first, so loading isn't timed
+        already_loaded = sensitivity_check.is_analyzer_engine_ready()
+        rss_before_load = get_rss_mb()
+        start = time.monotonic()
+        analyzer_engine = sensitivity_check.get_ask_ai_analyzer_engine()
+        load_seconds = time.monotonic() - start
+        gc.collect()
+        rss_after_load = get_rss_mb()
+        analyzer_timings, analyzer_verdicts = get_timings_ms(
+            sensitivity_check.is_text_potentially_sensitive_by_analyzer, prompts, options["repeat"]
+        )
+        tiered_timings, tiered_verdicts = get_timings_ms(
+            is_text_potentially_sensitive_uncached, prompts, options["repeat"]
+        )
+        sensitivity_check.verdict_cache.reset_stats()
+        cached_timings, cached_verdicts = get_timings_ms(
+            sensitivity_check.is_text_potentially_sensitive, prompts, options["repeat"]
+        )
+        fast_matches = sum(sensitivity_check.has_fast_check_match(prompt) for prompt in prompts)
+        self.stdout.write(f"{len(prompts)} prompts, each checked {options['repeat']} times")
+        pipeline = "trimmed" if settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE else "full"
+        pipe_names = analyzer_engine.nlp_engine.nlp["en"].pipe_names
+        self.stdout.write(f"spaCy pipeline ({pipeline}): {', '.join(pipe_names)}")
+        if already_loaded:
+            self.stdout.write(f"Analyzer already loaded, memory {rss_after_load:.0f} MB")
+        else:
+            self.stdout.write(
+                f"Analyzer loaded in {load_seconds:.1f} s, memory {rss_after_load:.0f} MB "
+                f"({rss_after_load - rss_before_load:.0f} MB for the analyzer)"
+            )
+        self.stdout.write(f"{fast_matches} prompts flagged by the regex scan without the analyzer")
+        self.stdout.write(format_timings("Analyzer", analyzer_timings))
+        self.stdout.write(format_timings("Tiered", tiered_timings))
+        self.stdout.write(format_timings("Cached", cached_timings))
+        cache_stats = sensitivity_check.get_verdict_cache_stats()
+        self.stdout.write(f"Verdict cache hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['hits']} hits)")
+        differences = [
+            prompt
+            for prompt, analyzer, tiered, cached in zip(prompts, analyzer_verdicts, tiered_verdicts, cached_verdicts)
+            if not analyzer == tiered == cached
+        ]
+        for prompt in differences:
+            self.stdout.write(self.style.ERROR(f"Verdicts differ for: {prompt}"))
+        if not differences:
+            self.stdout.write(self.style.SUCCESS("Verdicts are the same"))
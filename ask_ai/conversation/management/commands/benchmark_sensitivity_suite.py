@@ -0,0 +1,172 @@
+"""
+Benchmark the sensitivity check on a synthetic corpus of prompts of different lengths (in tokens, as counted for
+the chat model) and numbers of entities.
+
+Times `analyze_text`, `get_analyser_results_above_thresholds` and `is_text_potentially_sensitive`
+(with an empty verdict cache) for each length and entity density, and reports p50/p95 latency,
+throughput and the peak memory of the process.
+
+Save the results as a baseline with `--save-baseline`. Later runs compare against the baseline,
+listing cases whose p95 latency is more than `--tolerance` slower, and fail if there are any.
+Timings only compare on the same machine, so no baseline is kept in the repo - save one before a change,
+then compare after it on the same machine.
+"""
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ask_ai.conversation import encodings, models, sensitivity_check
+
+# Prompt lengths are counted in tokens of the model prompts are sent to
+TOKEN_MODEL = models.Prompt.LLMModels.GPT35_TURBO_0125.label
+DEFAULT_LENGTHS = [10, 100, 500, 1000, 4000]
+# Entities per 100 tokens
+DENSITIES = {"none": 0, "few": 1, "many": 10}
+FILLER_WORDS = (
+    "the a of and to in for on with project team service policy data report user research meeting summary "
+    "please explain draft review update plan budget delivery agile government department guidance"
+).split()
+ENTITIES = [
+    "Winston Churchill",
+    "Ada Lovelace",
+    "mr@example.com",
+    "jane.doe@example.org",
+    "07777 888888",
+    "0131 887449",
+    "SW1A 2AS",
+    "BL9 3TF",
+    "OFFICIAL-SENSITIVE",
+]
+
+
+def generate_prompt(generator: random.Random, encoding, length: int, density: int) -> str:
+    # At least `length` tokens (ending with the word that reaches it), with `density` entities per 100 tokens
+    entity_offsets = sorted(generator.sample(range(length), length * density // 100), reverse=True)
+    words = []
+    tokens = 0
+    while tokens < length:
+        if entity_offsets and entity_offsets[-1] <= tokens:
+            entity_offsets.pop()
+            word = generator.choice(ENTITIES)
+        else:
+            word = generator.choice(FILLER_WORDS)
+        words.append(word)
+        # Each word after the first is preceded by a space, which the tokenizer includes in the word's tokens
+        tokens += len(encoding.encode(f" {word}" if len(words) > 1 else word))
+    return " ".join(words)
+
+
+def generate_corpus(lengths: list[int], prompts_per_case: int, seed: int = 0) -> dict:
+    generator = random.Random(seed)
+    encoding = encodings.get_encoding_for_model(TOKEN_MODEL)
+    return {
+        (length, density_name): [generate_prompt(generator, encoding, length, density) for _ in range(prompts_per_case)]
+        for length in lengths
+        for density_name, density in DENSITIES.items()
+    }
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def time_calls(check, inputs: list, repeat: int, before_each=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        for check_input in inputs:
+            if before_each:
+                before_each()
+            start = time.perf_counter()
+            check(check_input)
+            timings.append(time.perf_counter() - start)
+    percentiles = statistics.quantiles(timings, n=100)
+    return {
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "per_second": len(timings) / sum(timings) if sum(timings) else 0.0,
+    }
+
+
+def clear_verdict_cache() -> None:
+    sensitivity_check.verdict_cache.cache.clear()
+
+
+def run_benchmarks(corpus: dict, repeat: int) -> dict:
+    results = {}
+    for (length, density_name), prompts in corpus.items():
+        analyser_results = [sensitivity_check.analyze_text(prompt) for prompt in prompts]
+        cases = {
+            "analyze_text": time_calls(sensitivity_check.analyze_text, prompts, repeat),
+            "get_analyser_results_above_thresholds": time_calls(
+                sensitivity_check.get_analyser_results_above_thresholds, analyser_results, repeat
+            ),
+            "is_text_potentially_sensitive": time_calls(
+                sensitivity_check.is_text_potentially_sensitive, prompts, repeat, before_each=clear_verdict_cache
+            ),
+        }
+        for function_name, timings in cases.items():
+            results[f"{function_name}/{length}/{density_name}"] = timings
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for case, timings in results.items():
+        baseline_timings = baseline["cases"].get(case)
+        if baseline_timings and timings["p95_ms"] > baseline_timings["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{case}: p95 {timings['p95_ms']:.2f} ms, was {baseline_timings['p95_ms']:.2f} ms")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "Benchmark the sensitivity check across prompt lengths and entity densities"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lengths", type=int, nargs="+", default=DEFAULT_LENGTHS, help="Prompt lengths in tokens")
+        parser.add_argument("--prompts", type=int, default=5, help="Prompts for each length and density")
+        parser.add_argument("--repeat", type=int, default=3, help="Times to check each prompt")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--baseline", default="sensitivity_benchmark_baseline.json")
+        parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction slower that counts as worse")
+
+    def handle(self, *args, **options):
+        if options["prompts"] * options["repeat"] < 2:
+            raise CommandError("Need at least two timings for each case")
+        corpus = generate_corpus(options["lengths"], options["prompts"], options["seed"])
+        # Load the analyzer first, so loading isn't timed
+        sensitivity_check.get_ask_ai_analyzer_engine()
+        results = run_benchmarks(corpus, options["repeat"])
+        peak_rss_mb = get_peak_rss_mb()
+        for case, timings in results.items():
+            self.stdout.write(
+                f"{case:<60} p50 {timings['p50_ms']:9.2f} ms   p95 {timings['p95_ms']:9.2f} ms   "
+                f"{timings['per_second']:9.1f} / s"
+            )
+        self.stdout.write(f"Peak memory {peak_rss_mb:.0f} MB")
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as baseline_file:
+                json.dump({"cases": results, "peak_rss_mb": peak_rss_mb}, baseline_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {options['baseline']}"))
+            return
+        if not os.path.exists(options["baseline"]):
+            self.stdout.write(f"No baseline at {options['baseline']} to compare with")
+            return
+        with open(options["baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, options["tolerance"])
+        for regression in regressions:
+            self.stdout.write(self.style.ERROR(regression))
+        if regressions:
+            raise CommandError(f"{len(regressions)} cases slower than the baseline")
+        self.stdout.write(
+            self.style.SUCCESS(f"No cases slower than the baseline (peak memory was {baseline['peak_rss_mb']:.0f} MB)")
+        )
@@ -0,0 +1,159 @@
+"""
+Show the query plans of the busiest conversation queries, to check they use the indexes on `Chat` and `Prompt`.
+
+Run against a copy of the production database, or seed one with `--seed-users`: 20000 users with 20 chats
+of 10 prompts each is 4 million prompts. With `--compare`, also shows the plans with the indexes as they were
+before migration 0024 - in a transaction that is rolled back, but that locks the tables while it runs,
+so not on a live database.
+
+Postgres only.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from ask_ai.conversation import models, utils
+
+# Added in migration 0024, replacing the foreign key indexes
+NEW_INDEXES = ["chat_user_last_activity_idx", "prompt_chat_created_at_idx", "prompt_valid_history_idx"]
+FOREIGN_KEY_INDEXES = [(models.Chat, "user_id"), (models.Prompt, "chat_id")]
+SEED_EMAIL_DOMAIN = "seed.example.com"
+USER_BATCH_SIZE = 1000
+
+
+def get_insert_sql(model, expressions: dict[str, str]) -> tuple[str, str, list]:
+    # Columns and values to insert, from the SQL expressions given or the fields' defaults
+    columns = []
+    values = []
+    params = []
+    for field in model._meta.concrete_fields:
+        columns.append(connection.ops.quote_name(field.column))
+        if field.column in expressions:
+            values.append(expressions[field.column])
+        else:
+            values.append("%s")
+            params.append(field.get_db_prep_save(field.get_default(), connection))
+    return ", ".join(columns), ", ".join(values), params
+
+
+def seed(users: int, chats_per_user: int, prompts_per_chat: int) -> None:
+    user_ids = []
+    for start in range(0, users, USER_BATCH_SIZE):
+        batch = [
+            models.User(email=f"{uuid.uuid4()}@{SEED_EMAIL_DOMAIN}")
+            for _ in range(start, min(start + USER_BATCH_SIZE, users))
+        ]
+        user_ids.extend(user.id for user in models.User.objects.bulk_create(batch))
+    # A chat a day going back from now, with a prompt a minute, some of which aren't valid history
+    chat_columns, chat_values, chat_params = get_insert_sql(
+        models.Chat,
+        {
+            "id": "gen_random_uuid()",
+            "created_at": "started_at",
+            "modified_at": "started_at",
+            "user_id": "user_id",
+            "title": "'Seeded chat ' || n",
+            "last_activity_at": f"started_at + interval '{prompts_per_chat} minutes'",
+            "prompt_count": str(prompts_per_chat),
+        },
+    )
+    prompt_columns, prompt_values, prompt_params = get_insert_sql(
+        models.Prompt,
+        {
+            "id": "gen_random_uuid()",
+            "created_at": "chat.created_at + n * interval '1 minute'",
+            "modified_at": "chat.created_at + n * interval '1 minute'",
+            "chat_id": "chat.id",
+            "user_prompt": "'Seeded prompt ' || n",
+            "ai_response": "'Seeded response ' || n",
+            "potentially_sensitive": "mod(n, 10) = 0",
+            "api_call_error": "mod(n, 50) = 0",
+        },
+    )
+    chat_table = connection.ops.quote_name(models.Chat._meta.db_table)
+    prompt_table = connection.ops.quote_name(models.Prompt._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {chat_table} ({chat_columns}) SELECT {chat_values} FROM ("  # nosec B608
+            "SELECT user_id, n, now() - n * interval '1 day' AS started_at "
+            "FROM unnest(%s) AS user_id, generate_series(1, %s) AS n) AS chat",
+            chat_params + [user_ids, chats_per_user],
+        )
+        cursor.execute(
+            f"INSERT INTO {prompt_table} ({prompt_columns}) SELECT {prompt_values} "  # nosec B608
+            f"FROM {chat_table} AS chat, generate_series(1, %s) AS n WHERE chat.user_id = ANY(%s)",
+            prompt_params + [prompts_per_chat, user_ids],
+        )
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {chat_table}")
+        cursor.execute(f"ANALYZE {prompt_table}")
+
+
+def get_queries(chat: models.Chat) -> dict:
+    start_of_today = utils.get_start_of_today()
+    return {
+        "Chat prompts (chat page)": models.Prompt.objects.filter(chat=chat).order_by("created_at"),
+        "Chat history (ChatGPT inputs)": utils.get_all_valid_prompts_from_chat(chat),
+        "Today's and recent chats (sidebar)": utils.get_recent_chats(
+            chat.user, start_of_today, settings.PAST_CHATS_PAGE_SIZE
+        ),
+        "Next page of older chats (sidebar)": utils.filter_chats_before(
+            utils.get_chats_for_user(chat.user), chat.last_activity_at, chat.id
+        )[: settings.PAST_CHATS_PAGE_SIZE + 1],
+    }
+
+
+def use_old_indexes() -> None:
+    # Within a transaction, to be rolled back. Foreign keys are checked first, as tables with
+    # deferred checks pending (seeded in the same transaction) can't be indexed
+    with connection.cursor() as cursor:
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        for index_name in NEW_INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {connection.ops.quote_name(index_name)}")
+        for model, column in FOREIGN_KEY_INDEXES:
+            table = connection.ops.quote_name(model._meta.db_table)
+            cursor.execute(f"CREATE INDEX ON {table} ({connection.ops.quote_name(column)})")
+
+
+class Command(BaseCommand):
+    help = "Show the query plans of the chat page and sidebar queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed-users", type=int, default=0, help="Add this many users with chats first")
+        parser.add_argument("--chats-per-user", type=int, default=20)
+        parser.add_argument("--prompts-per-chat", type=int, default=10)
+        parser.add_argument("--compare", action="store_true", help="Also show the plans without the new indexes")
+
+    def write_plans(self, chat: models.Chat) -> None:
+        for name, queryset in get_queries(chat).items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(queryset.explain(analyze=True, buffers=True))
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Query plans are only shown for Postgres")
+        if options["seed_users"]:
+            seed(options["seed_users"], options["chats_per_user"], options["prompts_per_chat"])
+            self.stdout.write(f"Seeded {options['seed_users']} users")
+        # The chat with the most prompts, of the user with the most chats
+        busiest_user = models.Chat.objects.values("user").annotate(chats=Count("id")).order_by("-chats")[:1]
+        chat = (
+            models.Chat.objects.select_related("user")
+            .filter(user__in=busiest_user.values("user"))
+            .order_by("-prompt_count")
+            .first()
+        )
+        if not chat:
+            raise CommandError("No chats to query, seed some with --seed-users")
+        self.stdout.write(f"{models.Prompt.objects.count()} prompts in {models.Chat.objects.count()} chats")
+        if options["compare"]:
+            self.stdout.write(self.style.SUCCESS("Before - foreign key indexes only"))
+            with transaction.atomic():
+                use_old_indexes()
+                self.write_plans(chat)
+                transaction.set_rollback(True)
+            self.stdout.write(self.style.SUCCESS("After"))
+        self.write_plans(chat)
@@ -0,0 +1,24 @@
+"""
+Show how many chat completion jobs each user has waiting and running, to see who is using the LLM capacity.
+Covers all workers, as the job queue is in the database. Calls waiting in a web server process's scheduler
+(`llm_scheduler`) are kept in that process, so are shown by its health check instead.
+"""
+from django.core.management.base import BaseCommand
+
+from ask_ai.conversation import job_queue, models
+
+
+class Command(BaseCommand):
+    help = "Show chat completion jobs pending and running for each user"
+
+    def handle(self, *args, **options):
+        pending = job_queue.count_jobs_by_user(job_queue.Status.PENDING)
+        running = job_queue.count_jobs_by_user(job_queue.Status.RUNNING)
+        user_ids = sorted(set(pending) | set(running), key=lambda user_id: -pending.get(user_id, 0))
+        emails = dict(models.User.objects.filter(id__in=user_ids).values_list("id", "email"))
+        self.stdout.write(f"{'User':<50} {'Pending':>8} {'Running':>8}")
+        for user_id in user_ids:
+            self.stdout.write(
+                f"{emails.get(user_id, user_id):<50} {pending.get(user_id, 0):>8} {running.get(user_id, 0):>8}"
+            )
+        self.stdout.write(f"{'Total':<50} {sum(pending.values()):>8} {sum(running.values()):>8}")
@@ -0,0 +1,63 @@
+"""
+Moderate saved prompts and AI responses again, eg after the moderation model has changed.
+
+Texts are sent to the moderation endpoint in batches rather than one call each.
+Only reports changes unless run with `--update`. Works through the prompts in batches ordered by id,
+and prints the last id done, so it can be restarted with `--after-id`.
+Results cached by the web app are used unless run with `--no-cache`, eg when the endpoint's model
+has changed without its name changing.
+"""
+from django.core.management.base import BaseCommand
+
+from ask_ai.conversation import chat_gpt, models
+
+
+class Command(BaseCommand):
+    help = "Run moderation again on saved prompts and AI responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--after-id", help="Start after the prompt with this id")
+        parser.add_argument("--update", action="store_true", help="Save changed moderation flags")
+        parser.add_argument(
+            "--no-cache",
+            action="store_false",
+            dest="use_cache",
+            help="Send every text to the moderation endpoint, replacing cached results",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        prompts_to_check = models.Prompt.objects.only(
+            "id", "user_prompt", "ai_response", "user_prompt_moderated", "ai_response_moderated"
+        ).order_by("id")
+        total_checked = 0
+        total_changed = 0
+        last_id = options["after_id"]
+        while True:
+            batch_queryset = prompts_to_check if last_id is None else prompts_to_check.filter(id__gt=last_id)
+            batch = list(batch_queryset[:batch_size])
+            if not batch:
+                break
+            texts = []
+            for prompt in batch:
+                texts.append(prompt.user_prompt)
+                if prompt.ai_response:
+                    texts.append(prompt.ai_response)
+            flagged_by_text = dict(zip(texts, chat_gpt.chat_gpt_moderated_batch(texts, options["use_cache"])))
+            changed_prompts = []
+            for prompt in batch:
+                old_flags = (prompt.user_prompt_moderated, prompt.ai_response_moderated)
+                prompt.user_prompt_moderated = flagged_by_text[prompt.user_prompt]
+                prompt.ai_response_moderated = bool(prompt.ai_response) and flagged_by_text[prompt.ai_response]
+                if (prompt.user_prompt_moderated, prompt.ai_response_moderated) != old_flags:
+                    changed_prompts.append(prompt)
+            if options["update"]:
+                # bulk_update doesn't touch `modified_at`
+                models.Prompt.objects.bulk_update(changed_prompts, ["user_prompt_moderated", "ai_response_moderated"])
+            total_checked += len(batch)
+            total_changed += len(changed_prompts)
+            last_id = batch[-1].id
+            self.stdout.write(f"Checked {total_checked} prompts, {total_changed} changed (last id {last_id})")
+        action = "updated" if options["update"] else "would change"
+        self.stdout.write(self.style.SUCCESS(f"Finished, checked {total_checked} prompts, {action} {total_changed}"))
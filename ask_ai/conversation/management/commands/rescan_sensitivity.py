@@ -0,0 +1,116 @@
+"""
+Check saved prompts for sensitivity again, eg to see the effect of changing `SCORE_THRESHOLDS` or the recognizers.
+
+Prompts are analysed in batches, with spaCy run over many texts at once,
+optionally in several processes (`--processes`). Writes a CSV report of each prompt's old and new verdicts,
+and the entity types found above their thresholds - prompts flagged that users confirmed weren't sensitive
+are likely false positives. Only updates `potentially_sensitive` when run with `--update`.
+
+The report is written after each batch, once any changes are saved. Run with `--resume` to carry on
+after the last prompt in the report.
+"""
+import csv
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ask_ai.conversation import models, sensitivity_check
+
+REPORT_FIELDNAMES = [
+    "prompt_id",
+    "was_potentially_sensitive",
+    "potentially_sensitive",
+    "user_confirmed_not_sensitive",
+    "entity_types",
+]
+# Longer than a row of the report, which has no line breaks in its values
+REPORT_TAIL_BYTES = 4096
+
+
+def get_last_reported_id(report_path: str) -> str | None:
+    # Only the end of the report is read, for its last line
+    with open(report_path, "rb") as report_file:
+        report_file.seek(0, os.SEEK_END)
+        report_file.seek(max(report_file.tell() - REPORT_TAIL_BYTES, 0))
+        last_lines = report_file.read().decode(errors="replace").splitlines()[-1:]
+    last_row = next(csv.reader(last_lines), None)
+    if not last_row or last_row == REPORT_FIELDNAMES:
+        return None
+    return dict(zip(REPORT_FIELDNAMES, last_row))["prompt_id"]
+
+
+class Command(BaseCommand):
+    help = "Run the sensitivity check again on saved prompts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--processes", type=int, default=1, help="Processes for spaCy to use")
+        parser.add_argument("--report", default="sensitivity_rescan.csv", help="CSV file to write the results to")
+        parser.add_argument("--resume", action="store_true", help="Start after the last prompt in the report")
+        parser.add_argument("--update", action="store_true", help="Save changed verdicts")
+
+    def handle(self, *args, **options):
+        report_path = options["report"]
+        report_exists = os.path.exists(report_path) and os.path.getsize(report_path) > 0
+        last_id = None
+        if options["resume"]:
+            if not report_exists:
+                raise CommandError(f"No report to resume from at {report_path}")
+            last_id = get_last_reported_id(report_path)
+        elif report_exists:
+            raise CommandError(f"Report {report_path} already exists, use --resume to carry on")
+        prompts_to_check = models.Prompt.objects.only(
+            "id", "user_prompt", "potentially_sensitive", "user_confirmed_not_sensitive"
+        ).order_by("id")
+        totals = {"checked": 0, "flagged": 0, "changed": 0, "confirmed_not_sensitive": 0}
+        with open(report_path, "a", newline="") as report_file:
+            writer = csv.DictWriter(report_file, fieldnames=REPORT_FIELDNAMES)
+            if not report_exists:
+                writer.writeheader()
+            while True:
+                batch_queryset = prompts_to_check if last_id is None else prompts_to_check.filter(id__gt=last_id)
+                batch = list(batch_queryset[: options["batch_size"]])
+                if not batch:
+                    break
+                analyser_results = sensitivity_check.analyze_texts(
+                    [prompt.user_prompt for prompt in batch], n_process=options["processes"]
+                )
+                rows = []
+                changed_prompts = []
+                for prompt, results in zip(batch, analyser_results):
+                    sensitive_results = sensitivity_check.get_analyser_results_above_thresholds(results)
+                    potentially_sensitive = bool(sensitive_results)
+                    rows.append(
+                        {
+                            "prompt_id": prompt.id,
+                            "was_potentially_sensitive": prompt.potentially_sensitive,
+                            "potentially_sensitive": potentially_sensitive,
+                            "user_confirmed_not_sensitive": prompt.user_confirmed_not_sensitive,
+                            "entity_types": " ".join(sorted({result.entity_type for result in sensitive_results})),
+                        }
+                    )
+                    totals["flagged"] += potentially_sensitive
+                    totals["confirmed_not_sensitive"] += potentially_sensitive and prompt.user_confirmed_not_sensitive
+                    if potentially_sensitive != prompt.potentially_sensitive:
+                        prompt.potentially_sensitive = potentially_sensitive
+                        changed_prompts.append(prompt)
+                if options["update"]:
+                    # bulk_update doesn't touch `modified_at`
+                    models.Prompt.objects.bulk_update(changed_prompts, ["potentially_sensitive"])
+                # Only once saved, so `--resume` doesn't skip prompts that weren't updated
+                writer.writerows(rows)
+                report_file.flush()
+                totals["checked"] += len(batch)
+                totals["changed"] += len(changed_prompts)
+                last_id = batch[-1].id
+                self.stdout.write(
+                    f"Checked {totals['checked']} prompts, {totals['changed']} changed (last id {last_id})"
+                )
+        action = "updated" if options["update"] else "would change"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Finished, checked {totals['checked']} prompts, {action} {totals['changed']}. "
+                f"{totals['flagged']} flagged, of which {totals['confirmed_not_sensitive']} "
+                "were confirmed not sensitive by the user"
+            )
+        )
@@ -0,0 +1,64 @@
+"""
+Worker process for the chat completion job queue (see `ask_ai.conversation.job_queue`).
+
+Runs `--concurrency` threads taking jobs from the queue, and periodically puts back jobs
+abandoned by workers that crashed. Stops after finishing current jobs on SIGTERM or SIGINT.
+"""
+import logging
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ask_ai.conversation import chat_gpt, encodings, job_queue
+
+logger = logging.getLogger("application")
+
+
+class Command(BaseCommand):
+    help = "Get responses from ChatGPT for prompts in the job queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.LLM_JOB_WORKER_CONCURRENCY)
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when queue is empty")
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        encodings.warm_up_encodings(chat_gpt.MODELS_WITH_TOKEN_COUNTS)
+        worker_name = f"{socket.gethostname()}-{os.getpid()}"
+        threads = [
+            threading.Thread(
+                target=job_queue.run_worker,
+                args=(f"{worker_name}-{i}", stop_event, options["poll_interval"]),
+                name=f"chat-completion-worker-{i}",
+            )
+            for i in range(options["concurrency"])
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            self.stdout.write(f"Started {len(threads)} chat completion workers ({worker_name})")
+            recovery_interval = max(settings.LLM_JOB_LOCK_TIMEOUT_SECONDS / 2, 1)
+            while not stop_event.is_set():
+                close_old_connections()
+                try:
+                    recovered = job_queue.recover_abandoned_jobs()
+                except Exception:
+                    logger.exception("Couldn't recover abandoned chat completion jobs")
+                    recovered = 0
+                if recovered:
+                    self.stdout.write(f"Recovered {recovered} abandoned jobs")
+                stop_event.wait(recovery_interval)
+        finally:
+            # Let the workers finish their current jobs, whatever stopped the recovery loop
+            stop_event.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+        self.stdout.write("Chat completion workers stopped")
@@ -0,0 +1,37 @@
+"""
+Production web server - loads the application once, then forks workers that share its memory
+(see `ask_ai.prefork`). Send SIGHUP for a graceful restart, SIGUSR1 to log each worker's memory.
+"""
+import socket
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+
+from ask_ai import prefork
+
+
+class Command(BaseCommand):
+    help = "Run the pre-forking production web server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")  # nosec B104 - runs in a container
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument("--workers", type=int, default=settings.WEB_SERVER_WORKERS)
+        parser.add_argument("--threads", type=int, default=settings.WEB_SERVER_THREADS)
+
+    def handle(self, *args, **options):
+        application = get_wsgi_application()
+        prefork.preload()
+        sock = socket.create_server((options["host"], options["port"]))
+        self.stdout.write(f"Listening on {options['host']}:{sock.getsockname()[1]}")
+        server = prefork.PreforkServer(
+            application,
+            sock,
+            workers=options["workers"],
+            threads=options["threads"],
+            memory_log_interval=settings.WEB_SERVER_MEMORY_LOG_INTERVAL_SECONDS,
+            graceful_timeout=settings.WEB_SERVER_GRACEFUL_TIMEOUT_SECONDS,
+        )
+        server.run()
+        self.stdout.write("Web server stopped")
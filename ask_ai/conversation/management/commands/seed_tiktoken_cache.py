@@ -0,0 +1,24 @@
+"""
+Download the tiktoken encodings for the models we count tokens for into `TIKTOKEN_CACHE_DIR`,
+eg when building the image, so servers can load them without network access.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ask_ai.conversation import chat_gpt, encodings
+
+
+class Command(BaseCommand):
+    help = "Download tiktoken encodings into the tiktoken cache directory"
+
+    def handle(self, *args, **options):
+        encoding_names = set()
+        for model_name in chat_gpt.MODELS_WITH_TOKEN_COUNTS:
+            try:
+                encoding = encodings.get_encoding_for_model(model_name)
+            except Exception as error:
+                raise CommandError(f"Couldn't load the encoding for {model_name}: {error}") from error
+            encoding_names.add(encoding.name)
+        self.stdout.write(
+            self.style.SUCCESS(f"Cached encodings {', '.join(sorted(encoding_names))} in {settings.TIKTOKEN_CACHE_DIR}")
+        )
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.8 on 2024-02-12 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("conversation", "0019_alter_prompt_llm_model"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="prompt",
+            name="tokens_user_prompt",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="prompt",
+            name="tokens_ai_response",
+            field=models.PositiveIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("conversation", "0020_prompt_tokens_user_prompt_prompt_tokens_ai_response"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="prompt",
+            name="response_pending",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="ChatCompletionJob",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("modified_at", models.DateTimeField(auto_now=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "Pending"),
+                            ("RUNNING", "Running"),
+                            ("DONE", "Done"),
+                            ("FAILED", "Failed"),
+                        ],
+                        default="PENDING",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("locked_at", models.DateTimeField(null=True)),
+                ("locked_by", models.CharField(blank=True, default="", max_length=128)),
+                ("prompt", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="conversation.prompt")),
+            ],
+            options={
+                "ordering": ["created_at"],
+                "abstract": False,
+                "indexes": [models.Index(fields=["status", "created_at"], name="conversatio_status_dadb3e_idx")],
+            },
+        ),
+    ]
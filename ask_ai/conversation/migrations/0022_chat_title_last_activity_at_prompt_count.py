@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:22
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("conversation", "0021_chatcompletionjob_prompt_response_pending"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="last_activity_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="prompt_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="title",
+            field=models.CharField(blank=True, default="", max_length=100),
+        ),
+    ]
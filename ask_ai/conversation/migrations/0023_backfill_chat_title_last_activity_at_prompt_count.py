@@ -0,0 +1,43 @@
+# Fill in the title, last activity and prompt count of existing chats from their prompts.
+# In batches, each committed separately, so the chat table isn't locked for the whole backfill.
+
+from django.db import migrations
+from django.db.models import Count, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Left
+
+BATCH_SIZE = 1000
+TITLE_LENGTH = 100
+
+
+def backfill_chats(apps, schema_editor):
+    Chat = apps.get_model("conversation", "Chat")
+    Prompt = apps.get_model("conversation", "Prompt")
+    prompts = Prompt.objects.filter(chat=OuterRef("pk")).order_by().values("chat")
+    first_prompts = Prompt.objects.filter(chat=OuterRef("pk")).order_by("created_at").values("user_prompt")[:1]
+    last_chat_id = None
+    while True:
+        chats = Chat.objects.order_by("id")
+        if last_chat_id:
+            chats = chats.filter(id__gt=last_chat_id)
+        chat_ids = list(chats.values_list("id", flat=True)[:BATCH_SIZE])
+        if not chat_ids:
+            break
+        Chat.objects.filter(id__in=chat_ids).update(
+            title=Coalesce(Left(Subquery(first_prompts), TITLE_LENGTH), Value("")),
+            last_activity_at=Coalesce(
+                Subquery(prompts.annotate(last_created_at=Max("created_at")).values("last_created_at")),
+                F("created_at"),
+            ),
+            prompt_count=Coalesce(Subquery(prompts.annotate(count=Count("id")).values("count")), 0),
+        )
+        last_chat_id = chat_ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("conversation", "0022_chat_title_last_activity_at_prompt_count"),
+    ]
+
+    operations = [migrations.RunPython(backfill_chats, migrations.RunPython.noop)]
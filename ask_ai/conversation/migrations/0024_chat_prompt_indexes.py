@@ -0,0 +1,54 @@
+# Indexes for listing a user's chats and a chat's prompts.
+# Built concurrently, so prompts can still be saved while they're built on a large table.
+# The foreign key indexes are dropped afterwards, the new indexes start with the same column.
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("conversation", "0023_backfill_chat_title_last_activity_at_prompt_count"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="chat",
+            index=models.Index(fields=["user", "last_activity_at", "id"], name="chat_user_last_activity_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="prompt",
+            index=models.Index(fields=["chat", "created_at"], name="prompt_chat_created_at_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="prompt",
+            index=models.Index(
+                condition=models.Q(
+                    models.Q(("potentially_sensitive", True), ("user_confirmed_not_sensitive", False), _negated=True),
+                    models.Q(("user_prompt_moderated", True), _negated=True),
+                    models.Q(("ai_response_moderated", True), _negated=True),
+                    models.Q(("api_call_error", True), _negated=True),
+                ),
+                fields=["chat", "created_at"],
+                name="prompt_valid_history_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="chat",
+            name="user",
+            field=models.ForeignKey(
+                db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AlterField(
+            model_name="prompt",
+            name="chat",
+            field=models.ForeignKey(
+                db_index=False, on_delete=django.db.models.deletion.CASCADE, to="conversation.chat"
+            ),
+        ),
+    ]
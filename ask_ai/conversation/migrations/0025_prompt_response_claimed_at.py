@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("conversation", "0024_chat_prompt_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="prompt",
+            name="response_claimed_at",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
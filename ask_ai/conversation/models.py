@@ -2,8 +2,10 @@ import uuid
 
 from automatilib.core.models import IDotAiUser
 from django.contrib.auth.models import Group
-from django.db import models
+from django.db import models, transaction
 from django.db.models.enums import TextChoices
+from django.db.models.functions import Greatest
+from django.utils import timezone
 
 
 FEATURES_TO_GROUP_MAP = {"data-download": "Data download"}
@@ -49,7 +51,28 @@ class User(IDotAiUser):
 
 
 class Chat(TimeStampedModel):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    TITLE_LENGTH = 100
+
+    # Indexed by `chat_user_last_activity_idx`
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    # Kept up to date as prompts are added (see Prompt.save), so chats can be listed without their prompts
+    # Start of the first prompt
+    title = models.CharField(max_length=TITLE_LENGTH, blank=True, default="")
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    prompt_count = models.PositiveIntegerField(default=0)
+
+    class Meta(TimeStampedModel.Meta):
+        # The sidebar, see `utils.PAST_CHATS_ORDERING`
+        indexes = [models.Index(fields=["user", "last_activity_at", "id"], name="chat_user_last_activity_idx")]
+
+
+# Prompts that go in the chat history: not sensitive (unless the user confirmed they aren't), moderated or failed
+VALID_HISTORY = (
+    ~models.Q(potentially_sensitive=True, user_confirmed_not_sensitive=False)
+    & ~models.Q(user_prompt_moderated=True)
+    & ~models.Q(ai_response_moderated=True)
+    & ~models.Q(api_call_error=True)
+)
 
 
 class Prompt(TimeStampedModel):
@@ -58,7 +81,8 @@ class Prompt(TimeStampedModel):
         GPT35_TURBO_1106 = "GPT35_TURBO_1106", "gpt-3.5-turbo-1106"
         GPT35_TURBO_0125 = "GPT35_TURBO_0125", "gpt-3.5-turbo-0125"
 
-    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    # Indexed by `prompt_chat_created_at_idx`
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, db_index=False)
     llm_model = models.CharField(max_length=32, choices=LLMModels.choices, blank=True, default="")
     user_prompt = models.TextField(blank=True, default="")
     ai_response = models.TextField(blank=True, default="")
@@ -71,12 +95,71 @@ class Prompt(TimeStampedModel):
     cost_output_dollars = models.FloatField(default=0)
     tokens_input = models.PositiveSmallIntegerField(null=True)
     tokens_output = models.PositiveSmallIntegerField(null=True)
+    # Token counts of the stored text, so history can be truncated without re-encoding it every turn
+    tokens_user_prompt = models.PositiveIntegerField(null=True)
+    tokens_ai_response = models.PositiveIntegerField(null=True)
+    # Waiting for a worker (see job_queue) or a stream request to get the response from ChatGPT
+    response_pending = models.BooleanField(default=False)
+    # When a stream request claimed the response, so a claim left by a process that stopped part way can be taken
+    response_claimed_at = models.DateTimeField(null=True)
+
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            models.Index(fields=["chat", "created_at"], name="prompt_chat_created_at_idx"),
+            # Only the prompts sent to ChatGPT as chat history, see `utils.get_all_valid_prompts_from_chat`
+            models.Index(fields=["chat", "created_at"], name="prompt_valid_history_idx", condition=VALID_HISTORY),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # In the database, so prompts added at the same time are all counted
+            Chat.objects.filter(id=self.chat_id).update(
+                title=models.Case(
+                    models.When(prompt_count=0, then=models.Value(self.user_prompt[: Chat.TITLE_LENGTH])),
+                    default=models.F("title"),
+                ),
+                # Never moves back, eg if a prompt created earlier is saved after another
+                last_activity_at=Greatest(models.F("last_activity_at"), models.Value(self.created_at)),
+                prompt_count=models.F("prompt_count") + 1,
+            )
+        if Prompt.chat.is_cached(self):
+            # Match the database, for callers still holding the chat
+            if not self.chat.prompt_count:
+                self.chat.title = self.user_prompt[: Chat.TITLE_LENGTH]
+            self.chat.last_activity_at = max(self.chat.last_activity_at, self.created_at)
+            self.chat.prompt_count += 1
 
     @property
     def is_sensitive(self):
         # Assume sensitive unless specifically confirmed by user
         return self.potentially_sensitive and not self.user_confirmed_not_sensitive
 
+    @property
+    def is_awaiting_response(self):
+        # Passed the checks, but no response from ChatGPT yet
+        return not (self.ai_response or self.is_sensitive or self.user_prompt_moderated or self.api_call_error)
+
+
+class ChatCompletionJob(TimeStampedModel):
+    class Status(TextChoices):
+        PENDING = "PENDING", "Pending"
+        RUNNING = "RUNNING", "Running"
+        DONE = "DONE", "Done"
+        FAILED = "FAILED", "Failed"
+
+    prompt = models.ForeignKey(Prompt, on_delete=models.CASCADE)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    locked_at = models.DateTimeField(null=True)
+    locked_by = models.CharField(max_length=128, blank=True, default="")
+
+    class Meta(TimeStampedModel.Meta):
+        indexes = [models.Index(fields=["status", "created_at"])]
+
 
 class Feedback(TimeStampedModel, UUIDPrimaryKeyBase):
     class Satisfaction(TextChoices):
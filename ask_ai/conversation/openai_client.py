@@ -0,0 +1,486 @@
+"""
+Shared HTTP connections for calls to the OpenAI API.
+
+By default the `openai` library gives each thread its own `requests` session (replaced every few minutes)
+and opens a new aiohttp session for every async call, so calls often pay for a new TLS handshake.
+Here all calls in a process share one pool of keep-alive connections (one pool per event loop for async calls,
+closed when the loop shuts down), with a configurable size and connect/read timeouts. The read timeout is the longest wait for data, so for
+streamed responses the longest gap between chunks. Async calls also have a longer limit on the whole call.
+
+The pool counts requests in flight. Requests that start when every pooled connection is busy get a
+connection that isn't kept afterwards - these are counted as saturated, and mean the pool is too small.
+
+Calls that fail with an error worth retrying are retried with jittered exponential backoff, waiting
+as long as the API asks in Retry-After. A circuit breaker counts these failures: once too many recent
+calls have failed, calls fail straight away with `CircuitOpenError` until a cool-down has passed.
+A limit on calls (eg `llm_limiter.limit_chat_completion`) can be held for each attempt, so that it is
+given up while waiting to retry rather than held asleep.
+"""
+import asyncio
+import collections
+import contextlib
+import email.utils
+import inspect
+import logging
+import random
+import threading
+import time
+import weakref
+
+import aiohttp
+import openai
+import requests
+from django.conf import settings
+from openai.api_requestor import MAX_CONNECTION_RETRIES
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("application")
+
+
+class PoolStats:
+    def __init__(self, pool_size: int, log_interval_seconds: int):
+        self.pool_size = pool_size
+        self.log_interval_seconds = log_interval_seconds
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_requests = 0
+        self.saturated_requests = 0
+        self._last_logged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def request_started(self) -> None:
+        with self._lock:
+            self.total_requests += 1
+            if self.in_flight >= self.pool_size:
+                self.saturated_requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def request_finished(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            log_due = self.log_interval_seconds and now - self._last_logged >= self.log_interval_seconds
+            if log_due:
+                self._last_logged = now
+        if log_due:
+            logger.info("OpenAI connection pool: %s", self.as_dict())
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "total_requests": self.total_requests,
+                "saturated_requests": self.saturated_requests,
+            }
+
+
+pool_stats = PoolStats(settings.OPENAI_POOL_SIZE, settings.OPENAI_POOL_STATS_LOG_INTERVAL_SECONDS)
+
+
+class MeteredHTTPAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        # Streamed responses are counted until the headers arrive, not until the body is read
+        pool_stats.request_started()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            pool_stats.request_finished()
+
+
+class SharedSession(requests.Session):
+    def close(self):
+        # `openai` closes each thread's session every few minutes, but this one is shared by all threads
+        pass
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = SharedSession()
+            adapter = MeteredHTTPAdapter(
+                pool_connections=1, pool_maxsize=settings.OPENAI_POOL_SIZE, max_retries=MAX_CONNECTION_RETRIES
+            )
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+async def _on_request_start(session, trace_config_ctx, params):
+    pool_stats.request_started()
+
+
+async def _on_request_end(session, trace_config_ctx, params):
+    pool_stats.request_finished()
+
+
+def _make_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_end)
+    return trace_config
+
+
+def get_aio_timeout() -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(
+        total=settings.OPENAI_ASYNC_TOTAL_TIMEOUT_SECONDS,
+        connect=settings.OPENAI_CONNECT_TIMEOUT_SECONDS,
+        sock_read=settings.OPENAI_READ_TIMEOUT_SECONDS,
+    )
+
+
+class TimedAioSession:
+    """
+    The aiohttp session for an event loop, as used by `openai` - which only calls `request`.
+
+    `openai` gives each async call a timeout with the second value of `request_timeout` as the total,
+    which would cut off a streamed response that long after it started. Calls use the session's
+    timeout (`get_aio_timeout`) instead, which limits each read as for sync calls.
+    """
+
+    def __init__(self):
+        connector = aiohttp.TCPConnector(limit=settings.OPENAI_POOL_SIZE)
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=get_aio_timeout(), trace_configs=[_make_trace_config()]
+        )
+        # Under WSGI each async view runs in a new event loop, so the session mustn't outlive it.
+        # Tasks still running when a loop shuts down are cancelled (by asyncio.run, and asgiref under WSGI)
+        self._close_task = asyncio.get_running_loop().create_task(self._close_at_loop_shutdown())
+
+    async def _close_at_loop_shutdown(self) -> None:
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await self.session.close()
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    def request(self, method: str, url: str, *, timeout=None, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+
+class SharedAioSession:
+    """
+    Stands in for the `openai.aiosession` context variable, giving every async call
+    the same aiohttp session for the running event loop.
+    """
+
+    def __init__(self):
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def get(self) -> TimedAioSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = TimedAioSession()
+            self._sessions[loop] = session
+        return session
+
+
+openai.requestssession = get_session
+openai.aiosession = SharedAioSession()
+
+
+# Errors from calls that might work if tried again
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.RateLimitError,
+)
+
+
+class CircuitOpenError(openai.error.ServiceUnavailableError):
+    # Subclass so it is handled like the API being unavailable
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_rate_threshold: float, minimum_calls: int, window_size: int, cooldown_seconds: float):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.cooldown_seconds = cooldown_seconds
+        # True for each recent call that failed
+        self._outcomes = collections.deque(maxlen=window_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.opened_at = None
+            self._trial_call_running = False
+            self._outcomes.clear()
+
+    def before_call(self) -> None:
+        """
+        Raise `CircuitOpenError` if the call shouldn't go ahead.
+        After the cool-down one trial call is let through, which closes the circuit if it succeeds.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                    raise CircuitOpenError("OpenAI circuit breaker is open")
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._trial_call_running:
+                    raise CircuitOpenError("OpenAI circuit breaker is waiting for a trial call")
+                self._trial_call_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                logger.info("OpenAI circuit breaker closed")
+                self.state = self.CLOSED
+                self._trial_call_running = False
+            self._outcomes.append(False)
+
+    def record_abandoned(self) -> None:
+        # The call stopped without an outcome (eg cancelled), so let another trial call through
+        with self._lock:
+            self._trial_call_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._outcomes.append(True)
+            failure_rate = sum(self._outcomes) / len(self._outcomes)
+            too_many_failures = (
+                len(self._outcomes) >= self.minimum_calls and failure_rate >= self.failure_rate_threshold
+            )
+            if self.state == self.HALF_OPEN or too_many_failures:
+                logger.warning("OpenAI circuit breaker opened for %s seconds", self.cooldown_seconds)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_call_running = False
+                self._outcomes.clear()
+
+    def get_status(self) -> dict:
+        with self._lock:
+            failures = sum(self._outcomes)
+            return {
+                "state": self.state,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": failures,
+                "seconds_until_trial": (
+                    max(self.cooldown_seconds - (time.monotonic() - self.opened_at), 0)
+                    if self.state == self.OPEN
+                    else None
+                ),
+            }
+
+
+circuit_breaker = CircuitBreaker(
+    failure_rate_threshold=settings.OPENAI_CIRCUIT_FAILURE_RATE,
+    minimum_calls=settings.OPENAI_CIRCUIT_MINIMUM_CALLS,
+    window_size=settings.OPENAI_CIRCUIT_WINDOW_SIZE,
+    cooldown_seconds=settings.OPENAI_CIRCUIT_COOLDOWN_SECONDS,
+)
+
+
+def get_retry_after_seconds(error: openai.error.OpenAIError) -> float | None:
+    headers = error.headers
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        # Can also be an HTTP date
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(retry_at.timestamp() - time.time(), 0)
+
+
+def get_retry_delay(error: openai.error.OpenAIError, attempt: int) -> float | None:
+    """
+    How long to wait before trying again after `attempt` (counting from 0) failed,
+    or None to give up.
+    """
+    if attempt >= settings.OPENAI_MAX_RETRIES:
+        return None
+    try:
+        retry_after = get_retry_after_seconds(error)
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        return retry_after if retry_after <= settings.OPENAI_RETRY_MAX_DELAY_SECONDS else None
+    backoff = min(settings.OPENAI_RETRY_BASE_DELAY_SECONDS * 2**attempt, settings.OPENAI_RETRY_MAX_DELAY_SECONDS)
+    # Jitter so that calls failing together don't all retry together
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class HeldStream:
+    # A streamed response, holding the limit of the attempt that got it until it has been read or closed
+    def __init__(self, response, attempt_stack: contextlib.ExitStack):
+        self._response = response
+        self._attempt_stack = attempt_stack
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._response)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        try:
+            self._response.close()
+        finally:
+            self._attempt_stack.close()
+
+
+class AsyncHeldStream:
+    # As `HeldStream`, for async calls
+    def __init__(self, response, attempt_stack: contextlib.AsyncExitStack):
+        self._response = response
+        self._attempt_stack = attempt_stack
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._response.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self) -> None:
+        try:
+            await self._response.aclose()
+        finally:
+            await self._attempt_stack.aclose()
+
+
+def call_with_retries(func, attempt_limit=contextlib.nullcontext, **kwargs):
+    """
+    attempt_limit - returns a context manager held for each attempt, and given up before waiting to retry.
+    A streamed response holds it until the stream has been read.
+    """
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        with contextlib.ExitStack() as attempt_stack:
+            try:
+                attempt_stack.enter_context(attempt_limit())
+            except BaseException:
+                # eg timed out waiting for the limit, without calling the API
+                circuit_breaker.record_abandoned()
+                raise
+            try:
+                response = func(**kwargs)
+            except RETRYABLE_ERRORS as error:
+                circuit_breaker.record_failure()
+                delay = get_retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                logger.warning("OpenAI call failed (%r), retrying in %.1f seconds", error, delay)
+            except Exception:
+                # Other errors don't mean the API is unavailable
+                circuit_breaker.record_success()
+                raise
+            except BaseException:
+                # eg interrupted, which says nothing about the API
+                circuit_breaker.record_abandoned()
+                raise
+            else:
+                circuit_breaker.record_success()
+                if inspect.isgenerator(response):
+                    response = HeldStream(response, attempt_stack.pop_all())
+                return response
+        # The attempt's limit has been given up, so others can call the API while this waits
+        time.sleep(delay)
+        attempt += 1
+
+
+async def acall_with_retries(func, attempt_limit=contextlib.nullcontext, **kwargs):
+    # attempt_limit - returns an async context manager, as for `call_with_retries`
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        async with contextlib.AsyncExitStack() as attempt_stack:
+            try:
+                await attempt_stack.enter_async_context(attempt_limit())
+            except BaseException:
+                circuit_breaker.record_abandoned()
+                raise
+            try:
+                response = await func(**kwargs)
+            except RETRYABLE_ERRORS as error:
+                circuit_breaker.record_failure()
+                delay = get_retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                logger.warning("OpenAI call failed (%r), retrying in %.1f seconds", error, delay)
+            except Exception:
+                circuit_breaker.record_success()
+                raise
+            except BaseException:
+                # eg cancelled when the user went away
+                circuit_breaker.record_abandoned()
+                raise
+            else:
+                circuit_breaker.record_success()
+                if inspect.isasyncgen(response):
+                    response = AsyncHeldStream(response, attempt_stack.pop_all())
+                return response
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def get_request_timeout() -> tuple[float, float]:
+    # Only used by sync calls - async calls use the session's timeout (see `TimedAioSession`)
+    return settings.OPENAI_CONNECT_TIMEOUT_SECONDS, settings.OPENAI_READ_TIMEOUT_SECONDS
+
+
+def get_pool_stats() -> dict:
+    return pool_stats.as_dict()
+
+
+def create_moderation(input_text: str | list[str]) -> dict:
+    return call_with_retries(
+        openai.Moderation.create,
+        input=input_text,
+        model=settings.OPENAI_MODERATION_MODEL,
+        request_timeout=get_request_timeout(),
+    )
+
+
+async def acreate_moderation(input_text: str) -> dict:
+    return await acall_with_retries(
+        openai.Moderation.acreate,
+        input=input_text,
+        model=settings.OPENAI_MODERATION_MODEL,
+        request_timeout=get_request_timeout(),
+    )
+
+
+def create_chat_completion(attempt_limit=contextlib.nullcontext, **inputs):
+    return call_with_retries(
+        openai.ChatCompletion.create, attempt_limit=attempt_limit, request_timeout=get_request_timeout(), **inputs
+    )
+
+
+async def acreate_chat_completion(attempt_limit=contextlib.nullcontext, **inputs):
+    return await acall_with_retries(
+        openai.ChatCompletion.acreate, attempt_limit=attempt_limit, request_timeout=get_request_timeout(), **inputs
+    )
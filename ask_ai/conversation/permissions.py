@@ -1,3 +1,6 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
 from django.http import Http404
 from django.shortcuts import redirect, render
 from django.urls import reverse
@@ -5,38 +8,59 @@ from django.urls import reverse
 from . import models
 
 
-def check_chat_permission(func):
-    def wrapper(request, *args, **kwargs):
-        chat_id = kwargs.get("chat_id")
-        if chat_id:
-            try:
-                chat = models.Chat.objects.get(pk=chat_id)
-            except models.Chat.DoesNotExist:
-                return render(request, "generic-error.html", {"errors": ["Chat could not be found."]})
-            if not (request.user == chat.user):
-                return render(request, "generic-error.html", {"errors": ["Chat could not be found."]})
-        return func(request, *args, **kwargs)
+def view_check(check):
+    """
+    Make a decorator from `check(request, *args, **kwargs)`, which returns a response
+    to use instead of calling the view (or None to carry on).
+    Works for both sync and async views - for async views the check runs in a thread,
+    as it may need the database (eg loading `request.user`).
+    """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            async def async_wrapper(request, *args, **kwargs):
+                response = await sync_to_async(check)(request, *args, **kwargs)
+                if response is not None:
+                    return response
+                return await func(request, *args, **kwargs)
+
+            return async_wrapper
+
+        def wrapper(request, *args, **kwargs):
+            response = check(request, *args, **kwargs)
+            if response is not None:
+                return response
+            return func(request, *args, **kwargs)
+
+        return wrapper
 
-    return wrapper
+    return decorator
 
 
-def login_required_and_force_declaration(func):
-    def wrapper(request, *args, **kwargs):
-        if not request.user.is_authenticated:
-            return redirect(reverse("login"))
-        elif not request.user.completed_declaration:
-            return redirect(reverse("declaration"))
-        return func(request, *args, **kwargs)
+@view_check
+def check_chat_permission(request, *args, **kwargs):
+    chat_id = kwargs.get("chat_id")
+    if chat_id:
+        try:
+            chat = models.Chat.objects.get(pk=chat_id)
+        except models.Chat.DoesNotExist:
+            return render(request, "generic-error.html", {"errors": ["Chat could not be found."]})
+        if not (request.user == chat.user):
+            return render(request, "generic-error.html", {"errors": ["Chat could not be found."]})
 
-    return wrapper
 
+@view_check
+def login_required_and_force_declaration(request, *args, **kwargs):
+    if not request.user.is_authenticated:
+        return redirect(reverse("login"))
+    elif not request.user.completed_declaration:
+        return redirect(reverse("declaration"))
 
-def check_user_in_data_download_group(func):
-    def wrapper(request, *args, **kwargs):
-        user = request.user
-        user_in_data_download = user.groups.filter(name="Data download").exists()
-        if not user_in_data_download:
-            raise Http404("Page not found")
-        return func(request, *args, **kwargs)
 
-    return wrapper
+@view_check
+def check_user_in_data_download_group(request, *args, **kwargs):
+    user = request.user
+    user_in_data_download = user.groups.filter(name="Data download").exists()
+    if not user_in_data_download:
+        raise Http404("Page not found")
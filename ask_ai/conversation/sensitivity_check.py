@@ -3,12 +3,53 @@ Check if input text is sensitive - at the moment testing for potentially persona
 
 To start - chosen a small spaCy model and some fairly generic settings.
 To improve the results - may change the settings for the analyzer engine.
+
+Text is checked in two tiers. First a single regex scan for our own patterns (sensitivity markings,
+postcodes, UK phone numbers) - these always score 1.0, so any match is enough to flag the text.
+Only if there is no match does the text go through the full analyzer, which is needed for names
+(spaCy NER), and for emails and other phone numbers, whose scores depend on validation and nearby words.
+
+The analyzer engine (and spaCy) is only loaded when first needed, so processes that don't
+check text (eg management commands) don't load it. Web servers load it in the background
+at startup (`SENSITIVITY_CHECK_WARM_UP`), and the health check reports when it is ready.
+
+With `SENSITIVITY_CHECK_TRIMMED_PIPELINE` the spaCy components presidio doesn't use are removed after loading.
+Presidio uses the named entities, and the lemmas for context words that raise scores (eg "phone" near a number),
+so the tagger and attribute ruler that the lemmatizer needs stay. Only the dependency parser
+(and the sentence recognizer, loaded but disabled) go, so verdicts are the same.
+
+Long text is analysed in overlapping chunks of `SENSITIVITY_CHECK_CHUNK_CHARS`, one at a time,
+stopping at the first chunk with a result above its threshold. Chunks overlap by at least
+`SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS`, so an entity crossing the end of one chunk is all in the next.
+
+spaCy holds the GIL while it runs, so a long prompt stalls other threads in the worker.
+With `SENSITIVITY_CHECK_PROCESS_POOL_SIZE` the analyzer runs in a pool of separate processes instead,
+each loading its own analyzer, and the chunks of a long text are analysed in parallel.
+Checks that take longer than `SENSITIVITY_CHECK_TIMEOUT_SECONDS`, or fail in their pool process, fail closed -
+the text is treated as potentially sensitive.
+Pool processes are replaced after `SENSITIVITY_CHECK_MAX_TASKS_PER_CHILD` checks.
+
+Verdicts from the analyzer are cached by a hash of the exact text (whitespace can change a verdict),
+versioned by everything else that can change one - thresholds, patterns, package and model versions
+and settings - so changing any of those stops old verdicts being used. Failed checks aren't cached.
 """
 
+import concurrent.futures
+import functools
+import hashlib
+import importlib.metadata
+import logging
+import multiprocessing
 import re
+import threading
+import time
+from collections.abc import Iterator
+
+from django.conf import settings
 
-from presidio_analyzer import AnalyzerEngine, Pattern, PatternRecognizer
-from presidio_analyzer.nlp_engine import NlpEngineProvider
+from ask_ai.conversation import caching
+
+logger = logging.getLogger("application")
 
 # https://microsoft.github.io/presidio/supported_entities/
 UK_POSTAL_CODE_REGEX = r"[A-Z]{1,2}[0-9R][0-9A-Z]? ?[0-9][ABD-HJLNP-UW-Z]{2}"
@@ -24,15 +65,58 @@ SCORE_THRESHOLDS = {
     "UK_MOBILE_PHONE_REGEX": 1.0,
     "UK_LANDLINE_REGEX": 1.0,
 }  # All the entities to include
+# presidio's default flags for PatternRecognizer
+DEFAULT_RECOGNIZER_REGEX_FLAGS = re.DOTALL | re.MULTILINE | re.IGNORECASE
+INLINE_REGEX_FLAGS = {re.IGNORECASE: "i", re.MULTILINE: "m", re.DOTALL: "s"}
+
+
+def get_deny_list_regex(deny_list: list[str]) -> str:
+    # As presidio's PatternRecognizer makes a regex from a deny list
+    escaped_deny_list = [re.escape(element) for element in deny_list]
+    return r"(?:^|(?<=\W))(?:" + "|".join(escaped_deny_list) + r")(?:(?=\W)|$)"
+
+
+def get_scoped_regex(regex: str, flags: int) -> str:
+    # Apply flags to just this regex, so it can be combined with others that use different flags
+    inline_flags = "".join(letter for flag, letter in INLINE_REGEX_FLAGS.items() if flags & flag)
+    return f"(?{inline_flags}:{regex})"
+
+
+# Regexes and flags of the recognizers added in `get_analyzer_engine`
+FAST_CHECK_REGEXES = [
+    (get_deny_list_regex(SENSITIVITY_MARKINGS), re.IGNORECASE),
+    (UK_POSTAL_CODE_REGEX, re.IGNORECASE),
+    (UK_MOBILE_PHONE_REGEX, DEFAULT_RECOGNIZER_REGEX_FLAGS),
+    (UK_LANDLINE_REGEX, DEFAULT_RECOGNIZER_REGEX_FLAGS),
+]
+fast_check_regex = re.compile("|".join(get_scoped_regex(regex, flags) for regex, flags in FAST_CHECK_REGEXES))
+
+SPACY_MODEL_NAME = "en_core_web_sm"
+# spaCy components of the model that presidio doesn't use
+UNUSED_PIPELINE_COMPONENTS = ["parser", "senter"]
+
+
+def trim_pipeline(nlp) -> None:
+    for name in UNUSED_PIPELINE_COMPONENTS:
+        if name in nlp.component_names:
+            nlp.remove_pipe(name)
 
 
-def get_analyzer_engine():
+def get_analyzer_engine(trimmed_pipeline: bool | None = None):
+    # Importing presidio imports spaCy, so only do it when the engine is needed
+    from presidio_analyzer import AnalyzerEngine, Pattern, PatternRecognizer
+    from presidio_analyzer.nlp_engine import NlpEngineProvider
+
     configuration = {
         "nlp_engine_name": "spacy",
-        "models": [{"lang_code": "en", "model_name": "en_core_web_sm"}],
+        "models": [{"lang_code": "en", "model_name": SPACY_MODEL_NAME}],
     }
     provider = NlpEngineProvider(nlp_configuration=configuration)
     nlp_eng_spacy_engine = provider.create_engine()
+    if trimmed_pipeline is None:
+        trimmed_pipeline = settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE
+    if trimmed_pipeline:
+        trim_pipeline(nlp_eng_spacy_engine.nlp["en"])
     analyzer_engine = AnalyzerEngine(nlp_engine=nlp_eng_spacy_engine, supported_languages=["en"])
     # Add some regex patterns
     sensitivity_markings_recognizer = PatternRecognizer(
@@ -44,9 +128,17 @@ def get_analyzer_engine():
     )
     # More patterns for UK phone numbers (not exhaustive, should cover most personal numbers)
     uk_mobile_pattern = Pattern(name="uk_mobile_pattern", regex=UK_MOBILE_PHONE_REGEX, score=1.0)
-    uk_mobile_recognizer = PatternRecognizer(supported_entity="UK_MOBILE_PHONE_REGEX", patterns=[uk_mobile_pattern])
+    uk_mobile_recognizer = PatternRecognizer(
+        supported_entity="UK_MOBILE_PHONE_REGEX",
+        patterns=[uk_mobile_pattern],
+        global_regex_flags=DEFAULT_RECOGNIZER_REGEX_FLAGS,
+    )
     uk_landline_pattern = Pattern(name="uk_landline_pattern", regex=UK_LANDLINE_REGEX, score=1.0)
-    uk_landline_recognizer = PatternRecognizer(supported_entity="UK_LANDLINE_REGEX", patterns=[uk_landline_pattern])
+    uk_landline_recognizer = PatternRecognizer(
+        supported_entity="UK_LANDLINE_REGEX",
+        patterns=[uk_landline_pattern],
+        global_regex_flags=DEFAULT_RECOGNIZER_REGEX_FLAGS,
+    )
     # Add all regex patterns to analyser engine (on top of names & defaults)
     analyzer_engine.registry.add_recognizer(sensitivity_markings_recognizer)
     analyzer_engine.registry.add_recognizer(uk_postcode_recognizer)
@@ -55,20 +147,252 @@ def get_analyzer_engine():
     return analyzer_engine
 
 
-ask_ai_analyzer_engine = get_analyzer_engine()
+_analyzer_engine = None
+_analyzer_engine_lock = threading.Lock()
+warm_up_error = None
+
+
+def get_ask_ai_analyzer_engine():
+    # Loaded once per process, the first time it is needed
+    global _analyzer_engine
+    if _analyzer_engine is None:
+        with _analyzer_engine_lock:
+            if _analyzer_engine is None:
+                _analyzer_engine = get_analyzer_engine()
+    return _analyzer_engine
+
+
+def is_analyzer_engine_ready() -> bool:
+    return _analyzer_engine is not None or _process_pool_ready
+
+
+def warm_up_analyzer_engine() -> None:
+    global warm_up_error
+    start = time.monotonic()
+    try:
+        if settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE:
+            warm_up_process_pool()
+        else:
+            get_ask_ai_analyzer_engine()
+    except Exception as error:
+        warm_up_error = error
+        logger.exception("Failed to load the sensitivity check analyzer")
+        return
+    logger.info("Loaded the sensitivity check analyzer in %.1f seconds", time.monotonic() - start)
+
+
+def warm_up_analyzer_engine_in_background() -> threading.Thread | None:
+    if not settings.SENSITIVITY_CHECK_WARM_UP:
+        return None
+    thread = threading.Thread(target=warm_up_analyzer_engine, name="sensitivity-check-warm-up", daemon=True)
+    thread.start()
+    return thread
 
 
 def analyze_text(input_text: str) -> list:
-    analyser_results = ask_ai_analyzer_engine.analyze(text=input_text, language="en", entities=SCORE_THRESHOLDS.keys())
+    analyser_results = get_ask_ai_analyzer_engine().analyze(
+        text=input_text, language="en", entities=SCORE_THRESHOLDS.keys()
+    )
     return analyser_results
 
 
+def analyze_texts(input_texts: list[str], n_process: int = 1, batch_size: int = 50) -> list[list]:
+    # For many texts at once (eg re-checking saved prompts) - spaCy works through them in batches,
+    # in `n_process` processes, then the recognizers run on each text with its spaCy results.
+    # Not presidio's BatchAnalyzerEngine, which doesn't pass the batch size or processes on to spaCy
+    analyzer_engine = get_ask_ai_analyzer_engine()
+    nlp_engine = analyzer_engine.nlp_engine
+    docs = nlp_engine.nlp["en"].pipe(input_texts, batch_size=batch_size, n_process=n_process)
+    return [
+        analyzer_engine.analyze(
+            text=input_text,
+            language="en",
+            entities=list(SCORE_THRESHOLDS),
+            nlp_artifacts=nlp_engine._doc_to_nlp_artifact(doc, "en"),
+        )
+        for input_text, doc in zip(input_texts, docs)
+    ]
+
+
 def get_analyser_results_above_thresholds(analyser_results: list) -> list:
     sensitive_results = [result for result in analyser_results if result.score >= SCORE_THRESHOLDS[result.entity_type]]
     return sensitive_results
 
 
-def is_text_potentially_sensitive(input_text: str) -> bool:
+def has_fast_check_match(input_text: str) -> bool:
+    return fast_check_regex.search(input_text) is not None
+
+
+def is_text_potentially_sensitive_by_analyzer(input_text: str) -> bool:
     analyser_results = analyze_text(input_text)
     sensitive_results = get_analyser_results_above_thresholds(analyser_results)
     return len(sensitive_results) > 0
+
+
+def get_text_chunks(input_text: str, chunk_size: int, overlap: int) -> Iterator[str]:
+    # Each chunk starts at least `overlap` characters before the end of the last, so anything
+    # that long or shorter is all in one chunk. Chunks end and start between words where possible.
+    # Each chunk starts after the last one did, as the overlap is shorter than a chunk.
+    if not 0 <= overlap < chunk_size:
+        raise ValueError(f"Chunk overlap {overlap} must be at least 0 and less than the chunk size {chunk_size}")
+    start = 0
+    while start + chunk_size < len(input_text):
+        end = start + chunk_size
+        space = input_text.rfind(" ", start + overlap + 1, end)
+        if space != -1:
+            end = space
+        yield input_text[start:end]
+        next_start = end - overlap
+        space = input_text.rfind(" ", start + 1, next_start)
+        start = space + 1 if space != -1 else next_start
+    yield input_text[start:]
+
+
+def get_chunks_to_analyze(input_text: str) -> Iterator[str]:
+    return get_text_chunks(
+        input_text, settings.SENSITIVITY_CHECK_CHUNK_CHARS, settings.SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS
+    )
+
+
+def is_text_potentially_sensitive_by_chunks(input_text: str) -> bool:
+    # Chunks are only analysed until one is sensitive
+    return any(is_text_potentially_sensitive_by_analyzer(chunk) for chunk in get_chunks_to_analyze(input_text))
+
+
+class SensitivityCheckFailedError(Exception):
+    pass
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+_process_pool_ready = False
+
+
+def load_analyzer_engine_in_worker(trimmed_pipeline: bool) -> None:
+    # Runs in each new pool process. Importing this module there reads the Django settings, which works
+    # as the spawned process inherits DJANGO_SETTINGS_MODULE. The pipeline setting is passed from the parent
+    global _analyzer_engine
+    _analyzer_engine = get_analyzer_engine(trimmed_pipeline)
+
+
+def get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Spawn rather than fork, so pool processes don't inherit the web server's threads and connections
+            _process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_analyzer_engine_in_worker,
+                initargs=(settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE,),
+                max_tasks_per_child=settings.SENSITIVITY_CHECK_MAX_TASKS_PER_CHILD or None,
+            )
+        return _process_pool
+
+
+def discard_process_pool(process_pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    # A new pool is started for the next check
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is process_pool:
+            _process_pool = None
+    process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def warm_up_process_pool() -> None:
+    # Pool processes start as checks are submitted, and load the analyzer when they start
+    global _process_pool_ready
+    process_pool = get_process_pool()
+    futures = [
+        process_pool.submit(is_text_potentially_sensitive_by_analyzer, "")
+        for _ in range(settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE)
+    ]
+    for future in futures:
+        future.result()
+    _process_pool_ready = True
+
+
+def is_text_potentially_sensitive_in_process_pool(input_text: str) -> bool:
+    global _process_pool_ready
+    process_pool = get_process_pool()
+    start = time.monotonic()
+    futures = []
+    try:
+        for chunk in get_chunks_to_analyze(input_text):
+            futures.append(process_pool.submit(is_text_potentially_sensitive_by_analyzer, chunk))
+        for future in concurrent.futures.as_completed(futures, timeout=settings.SENSITIVITY_CHECK_TIMEOUT_SECONDS):
+            potentially_sensitive = future.result()
+            _process_pool_ready = True
+            if potentially_sensitive:
+                return True
+    except concurrent.futures.TimeoutError:
+        logger.warning(
+            "Sensitivity check timed out after %.1f seconds, treating text as potentially sensitive",
+            time.monotonic() - start,
+        )
+        raise SensitivityCheckFailedError("Timed out")
+    except concurrent.futures.process.BrokenProcessPool as error:
+        logger.exception("Sensitivity check process pool broken, treating text as potentially sensitive")
+        discard_process_pool(process_pool)
+        raise SensitivityCheckFailedError("Process pool broken") from error
+    except Exception as error:
+        # eg the analyzer failed in the pool process
+        logger.exception("Sensitivity check failed, treating text as potentially sensitive")
+        raise SensitivityCheckFailedError("Check failed") from error
+    finally:
+        # Chunks not started yet are no longer needed
+        for future in futures:
+            future.cancel()
+    return False
+
+
+def is_text_potentially_sensitive_by_analyzer_tier(input_text: str) -> bool:
+    # Raises SensitivityCheckFailedError if the check couldn't be done
+    if settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE:
+        return is_text_potentially_sensitive_in_process_pool(input_text)
+    return is_text_potentially_sensitive_by_chunks(input_text)
+
+
+@functools.cache
+def get_package_version(name: str) -> str:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return "not installed"
+
+
+def get_verdict_cache_version() -> str:
+    configuration = [
+        sorted(SCORE_THRESHOLDS.items()),
+        FAST_CHECK_REGEXES,
+        SPACY_MODEL_NAME,
+        get_package_version(SPACY_MODEL_NAME),
+        get_package_version("spacy"),
+        get_package_version("presidio-analyzer"),
+        settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE,
+        settings.SENSITIVITY_CHECK_CHUNK_CHARS,
+        settings.SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS,
+    ]
+    return hashlib.sha256(repr(configuration).encode()).hexdigest()[:16]
+
+
+verdict_cache = caching.HashedResultCache("sensitivity-check", settings.SENSITIVITY_CHECK_CACHE_ALIAS, normalise=False)
+
+
+def get_verdict_cache_stats() -> dict:
+    return verdict_cache.get_stats()
+
+
+def is_text_potentially_sensitive(input_text: str) -> bool:
+    if has_fast_check_match(input_text):
+        return True
+    version = get_verdict_cache_version()
+    potentially_sensitive = verdict_cache.get(input_text, version)
+    if potentially_sensitive is None:
+        try:
+            potentially_sensitive = is_text_potentially_sensitive_by_analyzer_tier(input_text)
+        except SensitivityCheckFailedError:
+            # Fail closed, and check again next time
+            return True
+        verdict_cache.set(input_text, version, potentially_sensitive)
+    return potentially_sensitive
@@ -1,52 +1,64 @@
 import datetime
 from typing import Optional
 
+from django.db.models import Q
+from django.utils import timezone
+
 from . import models
 
 UNNAMED_CHAT_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+CHAT_NAME_LENGTH = 40
+# Most recently used first, with the id to order chats used at the same time, for keyset pagination
+PAST_CHATS_ORDERING = ("-last_activity_at", "-id")
+
+
+def get_chats_for_user(user: type[models.User]):
+    return models.Chat.objects.filter(user=user).order_by(*PAST_CHATS_ORDERING)
+
+
+def get_start_of_today() -> datetime.datetime:
+    return timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def filter_chats_before(chats, last_activity_at: datetime.datetime, chat_id=None):
+    # Chats after (last_activity_at, chat_id) in PAST_CHATS_ORDERING, or used before last_activity_at if no chat_id
+    if chat_id is None:
+        return chats.filter(last_activity_at__lt=last_activity_at)
+    return chats.filter(Q(last_activity_at__lt=last_activity_at) | Q(last_activity_at=last_activity_at, id__lt=chat_id))
+
+
+def get_recent_chats(user: type[models.User], start_of_today: datetime.datetime, page_size: int):
+    # Chats used today and one more than a page of older ones, to tell if there's another page
+    chats = get_chats_for_user(user)
+    older_chat_ids = filter_chats_before(chats, start_of_today).values("id")[: page_size + 1]
+    return chats.filter(Q(last_activity_at__gte=start_of_today) | Q(id__in=older_chat_ids))
 
 
 def format_chat_name(chat):
-    length_to_truncate = 40
-    chat_created_str = chat.created_at.strftime(UNNAMED_CHAT_DATE_FORMAT)
-    first_prompt = chat.prompt_set.order_by("created_at").first()
-    if not first_prompt:
-        return chat_created_str
-    name = first_prompt.user_prompt
-    if not name:
-        name = chat_created_str
-    elif len(name) > length_to_truncate:
-        name = f"{name[:length_to_truncate]}..."
-    return name
+    if not chat.title:
+        return chat.created_at.strftime(UNNAMED_CHAT_DATE_FORMAT)
+    if len(chat.title) > CHAT_NAME_LENGTH:
+        return f"{chat.title[:CHAT_NAME_LENGTH]}..."
+    return chat.title
 
 
 def get_chats_for_user_created_between(
     user: type[models.User], start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None
 ) -> list:
     # start and end inclusive
-    chats_for_user = models.Chat.objects.filter(user=user).prefetch_related("prompt_set")
+    chats_for_user = get_chats_for_user(user)
     if start_date:
-        chats_for_user = chats_for_user.filter(modified_at__date__gte=start_date)
+        chats_for_user = chats_for_user.filter(last_activity_at__date__gte=start_date)
     if end_date:
-        chats_for_user = chats_for_user.filter(modified_at__date__lte=end_date)
-    chats_for_user.order_by("-created_at")
+        chats_for_user = chats_for_user.filter(last_activity_at__date__lte=end_date)
     chats = [{"name": format_chat_name(chat), "id": chat.id} for chat in chats_for_user]
     return chats
 
 
 def get_all_valid_prompts_from_chat(chat):
-    all_prompts_for_chat = models.Prompt.objects.filter(chat=chat)
-    all_valid_chat_prompts = (
-        # Assume chat is sensitive if flagged as sensitive
-        # unless explicitly marked not sensitive by user
-        # First condition corresponds to `is_sensitve` (can't use properties in querysets)
-        all_prompts_for_chat.exclude(potentially_sensitive=True, user_confirmed_not_sensitive=False)
-        .exclude(user_prompt_moderated=True)
-        .exclude(ai_response_moderated=True)
-        .exclude(api_call_error=True)
-        .order_by("created_at")
-    )
-    return all_valid_chat_prompts
+    # Assume chat is sensitive if flagged as sensitive unless explicitly marked not sensitive by user.
+    # Matches the condition of the partial index on prompts, so it can be used.
+    return models.Prompt.objects.filter(models.VALID_HISTORY, chat=chat).order_by("created_at")
 
 
 def get_form_errors_as_strings(form_errors):
@@ -1,13 +1,21 @@
 import datetime
+import json
+import time
+import uuid
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
+from django.utils import timezone
 from django.views.decorators.http import require_http_methods
 
 import ask_ai.conversation.constants
 
-from . import chat_gpt, forms, models, permissions, sensitivity_check, utils
+from . import chat_gpt, forms, job_queue, models, permissions, sensitivity_check, utils
 
 ACCEPT_OPTIONS = (
     {
@@ -29,6 +37,8 @@ ACCEPT_OPTIONS = (
 )
 
 POPULATE_TEXT_BOX = "populate-text-box"
+PROMPT_TOO_LONG_ERROR = "This query is too long for ChatGPT, please shorten your query or submit two separate queries"
+LLM_MODEL = models.Prompt.LLMModels.GPT35_TURBO_0125
 
 
 @permissions.login_required_and_force_declaration
@@ -70,48 +80,127 @@ def get_chat(user, chat_id):
     return chat, chat_created
 
 
+def get_past_chats_page(chats: list, page_size: int) -> dict:
+    # chats has up to one more than the page size, to tell if there's another page
+    page = chats[:page_size]
+    next_page_url = None
+    if len(chats) > page_size:
+        last_chat = page[-1]
+        cursor = {"before": last_chat.last_activity_at.isoformat(), "before_id": last_chat.id}
+        next_page_url = f"{reverse('past-chats')}?{urlencode(cursor)}"
+    return {
+        "previous": [{"name": utils.format_chat_name(chat), "id": chat.id} for chat in page],
+        "next_page_url": next_page_url,
+    }
+
+
 def get_past_chats_for_user(user):
-    today = datetime.date.today()
-    today_chats = utils.get_chats_for_user_created_between(user, start_date=today)
-    previous_chats = utils.get_chats_for_user_created_between(
-        user,
-        start_date=None,
-        end_date=(today - datetime.timedelta(days=1)),
-    )
-    past_chats = {"today": today_chats, "previous": previous_chats}
-    return past_chats
+    # Today's chats and the first page of older ones, in one query
+    start_of_today = utils.get_start_of_today()
+    page_size = settings.PAST_CHATS_PAGE_SIZE
+    today_chats = []
+    older_chats = []
+    for chat in utils.get_recent_chats(user, start_of_today, page_size):
+        (today_chats if chat.last_activity_at >= start_of_today else older_chats).append(chat)
+    return {
+        "today": [{"name": utils.format_chat_name(chat), "id": chat.id} for chat in today_chats],
+        **get_past_chats_page(older_chats, page_size),
+    }
 
 
 @permissions.login_required_and_force_declaration
-@permissions.check_chat_permission
-@require_http_methods(["GET", "POST"])
-def chat_view(request, chat_id=None, option=None):
+@require_http_methods(["GET"])
+def past_chats_view(request):
+    # The next page of older chats for the sidebar, as list items, loaded as the user scrolls
+    before = request.GET.get("before")
+    before_id = request.GET.get("before_id")
+    chats = utils.get_chats_for_user(request.user)
+    if before:
+        try:
+            last_activity_at = datetime.datetime.fromisoformat(before)
+            chat_id = uuid.UUID(before_id)
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest("Invalid page")
+        chats = utils.filter_chats_before(chats, last_activity_at, chat_id)
+    else:
+        chats = utils.filter_chats_before(chats, utils.get_start_of_today())
+    page_size = settings.PAST_CHATS_PAGE_SIZE
+    chats = list(chats[: page_size + 1])
+    return render(request, template_name="past-chats.html", context=get_past_chats_page(chats, page_size))
+
+
+def hand_off_response(prompt) -> bool:
+    """
+    Get the response from ChatGPT outside this request, if configured to.
+    Returns whether it has been handed off - streamed to the chat page or queued for a worker.
+    """
+    if settings.STREAM_CHAT_RESPONSES:
+        return True
+    if settings.LLM_JOB_QUEUE_ENABLED:
+        job_queue.enqueue_chat_completion(prompt)
+        return True
+    return False
+
+
+def render_chat_page(request, chat_id=None, option=None, errors=None, data=None):
     # Possible options: POPULATE_TEXT_BOX
     # In some cases, populate the text box with previous prompt to enable editing
-    errors = {}
-    data = {}
+    errors = errors or {}
+    data = data or {}
     past_chats = get_past_chats_for_user(request.user)
-    llm_model = models.Prompt.LLMModels.GPT35_TURBO_0125
+    stream_url = None
     if chat_id:
         prompts_list = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at")
-        api_error = prompts_list.last().api_call_error
-        if option == POPULATE_TEXT_BOX:  # only do this when there is a chat
-            latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+        latest_prompt = prompts_list.last()
+        api_error = latest_prompt.api_call_error
+        if (
+            settings.STREAM_CHAT_RESPONSES
+            and latest_prompt.is_awaiting_response
+            and not is_response_pending(latest_prompt)
+        ):
+            stream_url = reverse("chat-stream", args=(chat_id,))
+        if option == POPULATE_TEXT_BOX and not data:  # only do this when there is a chat
             data = {"user_prompt": latest_prompt.user_prompt}
     else:
         prompts_list = models.Prompt.objects.none()
         api_error = False
+    return render(
+        request,
+        template_name="chat.html",
+        context={
+            "prompts": prompts_list,
+            "errors": errors,
+            "past_chats": past_chats,
+            "api_error": api_error,
+            "data": data,
+            "stream_url": stream_url,
+        },
+    )
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET", "POST"])
+def chat_view(request, chat_id=None, option=None):
+    errors = {}
+    data = {}
     if request.POST:
         input_text = request.POST.dict().get("user_prompt")
+        tokens_user_prompt = chat_gpt.num_tokens_from_string(input_text, LLM_MODEL.label)
         # Check for length before saving - don't save if only prompt too long
-        prompt_too_long = chat_gpt.is_prompt_over_token_limit(
-            input_text, llm_model, buffer=ask_ai.conversation.constants.BUFFER_TOKENS
+        prompt_too_long = chat_gpt.is_token_count_over_limit(
+            tokens_user_prompt, LLM_MODEL, buffer=ask_ai.conversation.constants.BUFFER_TOKENS
         )
         if not prompt_too_long:
             try:
                 chat, _ = get_chat(request.user, chat_id)
                 chat_id = chat.id
-                prompt = models.Prompt(chat=chat, llm_model=llm_model, user_prompt=input_text)
+                prompt = models.Prompt(
+                    chat=chat,
+                    llm_model=LLM_MODEL,
+                    user_prompt=input_text,
+                    tokens_user_prompt=tokens_user_prompt,
+                )
                 prompt.save()
                 input_text = prompt.user_prompt
                 moderated = chat_gpt.chat_gpt_moderated(input_text)
@@ -125,7 +214,9 @@ def chat_view(request, chat_id=None, option=None):
                     prompt.save()
                     if potentially_sensitive:
                         return redirect(reverse("chat-sensitivity-check", args=(chat_id,)))
-                    chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(prompt.chat, llm_model)
+                    if hand_off_response(prompt):
+                        return redirect(reverse("chat", args=(chat_id,)))
+                    chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(prompt.chat, LLM_MODEL)
                     prompt = chat_gpt.submit_valid_chat_to_chatgpt35(prompt, chat_gpt_inputs)
                     return redirect(reverse("chat", args=(chat_id,)))
             except chat_gpt.OPEN_AI_API_ERRORS:
@@ -133,19 +224,129 @@ def chat_view(request, chat_id=None, option=None):
                 prompt.save()
                 return redirect(reverse("chat-option", args=(chat_id, POPULATE_TEXT_BOX)))
         else:
-            errors[
-                "user_prompt"
-            ] = "This query is too long for ChatGPT, please shorten your query or submit two separate queries"
+            errors["user_prompt"] = PROMPT_TOO_LONG_ERROR
             data = {"user_prompt": input_text}
+    return render_chat_page(request, chat_id, option, errors, data)
+
+
+def format_server_sent_event(data, event: str | None = None) -> str:
+    # https://html.spec.whatwg.org/multipage/server-sent-events.html
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+
+def get_stale_stream_claim_cutoff() -> datetime.datetime:
+    # Claims not refreshed since then were left by a stream request that stopped part way (eg its process was killed)
+    return timezone.now() - datetime.timedelta(seconds=settings.STREAM_CHAT_CLAIM_TIMEOUT_SECONDS)
+
+
+def get_stale_stream_claims() -> Q:
+    return Q(response_pending=True, response_claimed_at__lt=get_stale_stream_claim_cutoff())
+
+
+def is_response_pending(prompt) -> bool:
+    # Waiting for a worker, or for a stream request that is still going
+    if prompt.response_claimed_at is None:
+        return prompt.response_pending
+    return prompt.response_pending and prompt.response_claimed_at >= get_stale_stream_claim_cutoff()
+
+
+def claim_prompt_for_streaming(prompt) -> bool:
+    """
+    Mark the prompt as pending, unless another request already has, so only one request gets its response.
+    Other requests see it pending and poll the chat status instead, until it is answered or the claim goes stale.
+    """
+    unanswered = models.Prompt.objects.filter(
+        Q(response_pending=False) | get_stale_stream_claims(), id=prompt.id, ai_response="", api_call_error=False
+    )
+    return bool(unanswered.update(response_pending=True, response_claimed_at=timezone.now()))
+
+
+def refresh_stream_claim(prompt) -> None:
+    models.Prompt.objects.filter(id=prompt.id, response_pending=True).update(response_claimed_at=timezone.now())
+
+
+def get_chat_stream_events(prompt):
+    # The prompt has been claimed by this request, and is released when saved with the response
+    prompt.response_pending = False
+    prompt.response_claimed_at = None
+    llm_model = models.Prompt.LLMModels(prompt.llm_model)
+    released = False
+    # Keep the claim fresh while chunks arrive, so a long response isn't taken to be abandoned
+    refresh_interval = settings.STREAM_CHAT_CLAIM_TIMEOUT_SECONDS / 3
+    last_refreshed = time.monotonic()
+    try:
+        chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(prompt.chat, llm_model)
+        for chunk in chat_gpt.stream_valid_chat_to_chatgpt35(prompt, chat_gpt_inputs):
+            if time.monotonic() - last_refreshed >= refresh_interval:
+                refresh_stream_claim(prompt)
+                last_refreshed = time.monotonic()
+            yield format_server_sent_event(chunk)
+        released = True
+    except chat_gpt.OPEN_AI_API_ERRORS:
+        prompt.api_call_error = True
+        prompt.save()
+        released = True
+        yield format_server_sent_event("", event="api-error")
+        return
+    finally:
+        if not released:
+            # Stopped part way, eg the browser went away, so let the next request stream it
+            models.Prompt.objects.filter(id=prompt.id).update(response_pending=False, response_claimed_at=None)
+    yield format_server_sent_event("", event="done")
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET"])
+def chat_status_view(request, chat_id):
+    # Polled by the chat page while a worker or another request gets the response
+    pending = (
+        models.Prompt.objects.filter(chat__id=chat_id, response_pending=True)
+        .exclude(get_stale_stream_claims())
+        .exists()
+    )
+    return JsonResponse({"pending": pending})
+
+
+@permissions.login_required_and_force_declaration
+@permissions.check_chat_permission
+@require_http_methods(["GET"])
+def chat_stream_view(request, chat_id):
+    latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+    if latest_prompt and latest_prompt.is_awaiting_response and claim_prompt_for_streaming(latest_prompt):
+        events = get_chat_stream_events(latest_prompt)
+    else:
+        events = iter([format_server_sent_event("", event="done")])
+    return make_event_stream_response(events)
+
+
+def make_event_stream_response(events) -> StreamingHttpResponse:
+    # events - an iterator of server-sent events, or an async iterator under ASGI so each is sent as it is yielded
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Stop proxies buffering the stream
+    return response
+
+
+def render_sensitivity_check_page(request, chat_id):
+    chat = models.Chat.objects.get(id=chat_id)
+    past_chats = get_past_chats_for_user(request.user)
+    all_prompts = models.Prompt.objects.filter(chat=chat).order_by("created_at")
+    latest_prompt = all_prompts.last()
+    existing_prompts = all_prompts.exclude(id=latest_prompt.id).order_by("created_at")
     return render(
         request,
         template_name="chat.html",
         context={
-            "prompts": prompts_list,
-            "errors": errors,
+            "prompts": existing_prompts,
+            "errors": {},
             "past_chats": past_chats,
-            "api_error": api_error,
-            "data": data,
+            "api_error": False,
+            "sensitive_prompt": latest_prompt,
+            "data": {},
         },
     )
 
@@ -154,25 +355,20 @@ def chat_view(request, chat_id=None, option=None):
 @permissions.check_chat_permission
 @require_http_methods(["GET", "POST"])
 def check_sensitivity_view(request, chat_id):
-    data = {}
-    api_error = False
-    chat = models.Chat.objects.get(id=chat_id)
-    past_chats = get_past_chats_for_user(request.user)
-    all_prompts = models.Prompt.objects.filter(chat=chat).order_by("created_at")
-    latest_prompt = all_prompts.last()
-    existing_prompts = all_prompts.exclude(id=latest_prompt.id).order_by("created_at")
-    llm_model = models.Prompt.LLMModels.GPT35_TURBO_0125
     if request.POST:
+        chat = models.Chat.objects.get(id=chat_id)
+        latest_prompt = models.Prompt.objects.filter(chat=chat).order_by("created_at").last()
         if "not-sensitive" in request.POST.dict():
             latest_prompt.user_confirmed_not_sensitive = True
             latest_prompt.save()
+            if hand_off_response(latest_prompt):
+                return redirect(reverse("chat", args=(chat.id,)))
             try:
-                chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(latest_prompt.chat, llm_model)
+                chat_gpt_inputs = chat_gpt.get_chat_gpt_inputs(latest_prompt.chat, LLM_MODEL)
                 latest_prompt = chat_gpt.submit_valid_chat_to_chatgpt35(latest_prompt, chat_gpt_inputs)
             except chat_gpt.OPEN_AI_API_ERRORS:
                 latest_prompt.api_call_error = True
                 latest_prompt.save()
-                data = {"user_prompt": latest_prompt.user_prompt}
             return redirect(reverse("chat", args=(chat.id,)))
         return redirect(
             reverse(
@@ -183,18 +379,7 @@ def check_sensitivity_view(request, chat_id):
                 ),
             )
         )  # populate text box for editing
-    return render(
-        request,
-        template_name="chat.html",
-        context={
-            "prompts": existing_prompts,
-            "errors": {},
-            "past_chats": past_chats,
-            "api_error": api_error,
-            "sensitive_prompt": latest_prompt,
-            "data": data,
-        },
-    )
+    return render_sensitivity_check_page(request, chat_id)
 
 
 @permissions.login_required_and_force_declaration
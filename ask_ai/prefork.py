@@ -0,0 +1,242 @@
+"""
+Pre-forking production web server, using waitress.
+
+The master process loads the application, the sensitivity check analyzer and the tiktoken encodings,
+then forks worker processes, each serving requests from a shared socket with a pool of threads.
+Memory loaded before forking is shared between the workers until written to (copy-on-write),
+and `gc.freeze()` stops the garbage collector writing to it.
+
+Signals to the master:
+- SIGTERM or SIGINT: stop the workers after their current requests, then exit
+- SIGHUP: graceful restart - start new workers, then stop the old ones after their current requests
+- SIGUSR1: log the memory of each worker
+
+A stopping worker stops accepting connections, and exits once its current requests have finished,
+or after `graceful_timeout` seconds.
+
+Workers that exit unexpectedly are replaced. Worker memory is also logged every `memory_log_interval` seconds.
+"""
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import time
+
+import waitress
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("application")
+
+# Fields of /proc/<pid>/smaps_rollup, in kB
+MEMORY_FIELDS = {"Rss": "rss_mb", "Pss": "pss_mb", "Private_Clean": "private_mb", "Private_Dirty": "private_mb"}
+# Workers stop themselves after the graceful timeout - any still running this much later are killed
+KILL_MARGIN_SECONDS = 5
+# How long a stopping worker waits for the requests of connections it has just accepted
+NEW_CONNECTION_WAIT_SECONDS = 1
+
+
+def get_process_memory_mb(pid: int) -> dict | None:
+    """
+    Memory of a process - rss is all its memory, including that shared with other workers,
+    pss counts shared memory divided between the processes sharing it, and private is memory only it uses.
+    Returns None where not available (needs Linux 4.14+).
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps_rollup:
+            lines = smaps_rollup.readlines()
+    except OSError:
+        return None
+    memory = {"rss_mb": 0.0, "pss_mb": 0.0, "private_mb": 0.0}
+    for line in lines:
+        field, _, value = line.partition(":")
+        if field in MEMORY_FIELDS:
+            memory[MEMORY_FIELDS[field]] += int(value.split()[0]) / 1024
+    return memory
+
+
+def preload() -> None:
+    # Load what the workers share, before forking
+    from ask_ai.conversation import chat_gpt, encodings, sensitivity_check
+
+    if not settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE:
+        sensitivity_check.get_ask_ai_analyzer_engine()
+    encodings.warm_up_encodings(chat_gpt.MODELS_WITH_TOKEN_COUNTS)
+
+
+def has_current_requests(server) -> bool:
+    # Requests being handled or queued, or responses still being sent
+    return any(channel.requests or channel.total_outbufs_len for channel in server.active_channels.values())
+
+
+class PreforkServer:
+    def __init__(
+        self,
+        application,
+        sock: socket.socket,
+        workers: int,
+        threads: int,
+        memory_log_interval: float = 0,
+        graceful_timeout: float = 30,
+    ):
+        self.application = application
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.memory_log_interval = memory_log_interval
+        self.graceful_timeout = graceful_timeout
+        self.worker_pids = set()
+        # Old workers finishing their requests after a restart
+        self.stopping_pids = set()
+        self._signals = []
+
+    def spawn_worker(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self.run_worker()
+            except Exception:
+                logger.exception("Web server worker failed")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.worker_pids.add(pid)
+        return pid
+
+    def run_worker(self) -> None:
+        # Otherwise every worker generates the same "random" numbers
+        random.seed()
+        server = waitress.create_server(self.application, sockets=[self.sock], threads=self.threads)
+        self._signals = []
+
+        def stop(signum, frame):
+            self._signals.append(signum)
+            # Wake the server loop, rather than waiting for it to time out
+            server.pull_trigger()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        self.serve_until_stopped(server)
+
+    def serve_until_stopped(self, server) -> None:
+        # Not waitress's `run`, which stops its loop on SystemExit and only waits 5 seconds for current requests
+        def serve():
+            server.asyncore.loop(
+                timeout=server.adj.asyncore_loop_timeout,
+                map=server._map,
+                use_poll=server.adj.asyncore_use_poll,
+                count=1,
+            )
+
+        while not self._signals:
+            serve()
+        # New connections are left to the other workers
+        server.accepting = False
+        stopped_at = time.monotonic()
+        while has_current_requests(server) or time.monotonic() - stopped_at < NEW_CONNECTION_WAIT_SECONDS:
+            if time.monotonic() - stopped_at >= self.graceful_timeout:
+                logger.warning("Web server worker %s stopped before its requests finished", os.getpid())
+                break
+            serve()
+        server.task_dispatcher.shutdown(timeout=0)
+
+    def prepare_to_fork(self) -> None:
+        # Connections can't be shared between processes, each worker opens its own
+        connections.close_all()
+        gc.collect()
+        gc.freeze()
+
+    def log_memory(self) -> None:
+        for pid in sorted(self.worker_pids):
+            memory = get_process_memory_mb(pid)
+            if memory is None:
+                logger.info("Web server worker %s memory not available", pid)
+                continue
+            logger.info(
+                "Web server worker %s memory: rss %.0f MB, pss %.0f MB, private %.0f MB",
+                pid,
+                memory["rss_mb"],
+                memory["pss_mb"],
+                memory["private_mb"],
+            )
+
+    def restart_workers(self) -> None:
+        old_pids = set(self.worker_pids)
+        for _ in range(self.workers):
+            self.spawn_worker()
+        for pid in old_pids:
+            self.stop_worker(pid)
+        logger.info("Restarted web server workers")
+
+    def stop_worker(self, pid: int) -> None:
+        self.worker_pids.discard(pid)
+        self.stopping_pids.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            self.stopping_pids.discard(pid)
+
+    def reap_workers(self) -> list[int]:
+        # Returns workers that exited unexpectedly
+        exited_pids = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in self.stopping_pids:
+                self.stopping_pids.discard(pid)
+            elif pid in self.worker_pids:
+                self.worker_pids.discard(pid)
+                logger.warning("Web server worker %s exited with status %s", pid, status)
+                exited_pids.append(pid)
+        return exited_pids
+
+    def stop(self) -> None:
+        for pid in list(self.worker_pids):
+            self.stop_worker(pid)
+        deadline = time.monotonic() + self.graceful_timeout + KILL_MARGIN_SECONDS
+        while self.stopping_pids and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in self.stopping_pids:
+            logger.warning("Web server worker %s didn't stop in time, killing it", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.stopping_pids.clear()
+
+    def _record_signal(self, signum, frame) -> None:
+        self._signals.append(signum)
+
+    def run(self) -> None:
+        self.prepare_to_fork()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, self._record_signal)
+        for _ in range(self.workers):
+            self.spawn_worker()
+        logger.info("Started %s web server workers with %s threads each", self.workers, self.threads)
+        last_memory_log = time.monotonic()
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    logger.info("Stopping web server workers")
+                    self.stop()
+                    return
+                if signum == signal.SIGHUP:
+                    self.restart_workers()
+                elif signum == signal.SIGUSR1:
+                    self.log_memory()
+            for _ in self.reap_workers():
+                self.spawn_worker()
+            if self.memory_log_interval and time.monotonic() - last_memory_log >= self.memory_log_interval:
+                self.log_memory()
+                last_memory_log = time.monotonic()
+            time.sleep(0.2)
@@ -6,6 +6,7 @@ from pathlib import Path
 
 import environ
 import sentry_sdk
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 from sentry_sdk.integrations.django import DjangoIntegration
 
@@ -253,6 +254,129 @@ CONTACT_EMAIL = env.str("CONTACT_EMAIL")
 LOGIN_FAILURE_TEMPLATE_PATH = "auth/login-error.html"
 
 OPENAI_KEY = env.str("OPENAI_KEY")
+# Stream responses from ChatGPT to the browser as they arrive, rather than waiting for the full response
+STREAM_CHAT_RESPONSES = env.bool("STREAM_CHAT_RESPONSES", default=False)
+# Use the async chat views - for running under ASGI (ask_ai.asgi)
+ASYNC_CHAT_VIEWS = env.bool("ASYNC_CHAT_VIEWS", default=False)
+# Older chats listed in the sidebar at a time, more are loaded as the user scrolls
+PAST_CHATS_PAGE_SIZE = env.int("PAST_CHATS_PAGE_SIZE", default=20)
+# Get responses from ChatGPT in separate worker processes (manage.py run_chat_completion_worker)
+LLM_JOB_QUEUE_ENABLED = env.bool("LLM_JOB_QUEUE_ENABLED", default=False)
+LLM_JOB_WORKER_CONCURRENCY = env.int("LLM_JOB_WORKER_CONCURRENCY", default=4)
+# Jobs whose lock hasn't been refreshed for this long are assumed abandoned by a crashed worker.
+# Workers refresh the lock of running jobs every third of this.
+LLM_JOB_LOCK_TIMEOUT_SECONDS = env.int("LLM_JOB_LOCK_TIMEOUT_SECONDS", default=300)
+LLM_JOB_MAX_ATTEMPTS = env.int("LLM_JOB_MAX_ATTEMPTS", default=3)
+# Load the sensitivity check analyzer in the background when the web server starts
+SENSITIVITY_CHECK_WARM_UP = env.bool("SENSITIVITY_CHECK_WARM_UP", default=True)
+# Remove the spaCy components the sensitivity check doesn't use (the parser), to save memory and time per prompt
+SENSITIVITY_CHECK_TRIMMED_PIPELINE = env.bool("SENSITIVITY_CHECK_TRIMMED_PIPELINE", default=False)
+# Long text is analysed in overlapping chunks, stopping at the first sensitive chunk.
+# The overlap must be longer than any entity plus the words before it that raise its score (eg "phone").
+SENSITIVITY_CHECK_CHUNK_CHARS = env.int("SENSITIVITY_CHECK_CHUNK_CHARS", default=2000)
+SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS = env.int("SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS", default=400)
+if not 0 <= SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS < SENSITIVITY_CHECK_CHUNK_CHARS:
+    raise ImproperlyConfigured("SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS must be at least 0 and less than the chunk size")
+# Run the analyzer in this many separate processes, rather than on the request thread (0 to turn off)
+SENSITIVITY_CHECK_PROCESS_POOL_SIZE = env.int("SENSITIVITY_CHECK_PROCESS_POOL_SIZE", default=0)
+# Text not checked by the process pool in this time is treated as potentially sensitive
+SENSITIVITY_CHECK_TIMEOUT_SECONDS = env.float("SENSITIVITY_CHECK_TIMEOUT_SECONDS", default=10)
+# Replace each pool process after this many checks, to limit memory growth (0 to keep them)
+SENSITIVITY_CHECK_MAX_TASKS_PER_CHILD = env.int("SENSITIVITY_CHECK_MAX_TASKS_PER_CHILD", default=1000)
+
+# tiktoken encodings are cached here (seed with manage.py seed_tiktoken_cache), tiktoken reads it from the environment
+TIKTOKEN_CACHE_DIR = env.str("TIKTOKEN_CACHE_DIR", default=str(BASE_DIR / "tiktoken_cache"))
+os.environ["TIKTOKEN_CACHE_DIR"] = TIKTOKEN_CACHE_DIR
+
+# Production web server (manage.py run_web_server), see ask_ai.prefork
+WEB_SERVER_WORKERS = env.int("WEB_SERVER_WORKERS", default=2)
+WEB_SERVER_THREADS = env.int("WEB_SERVER_THREADS", default=4)
+# How often to log the memory of each worker (0 to turn off)
+WEB_SERVER_MEMORY_LOG_INTERVAL_SECONDS = env.int("WEB_SERVER_MEMORY_LOG_INTERVAL_SECONDS", default=300)
+# Longest to wait for workers to finish their requests when stopping
+WEB_SERVER_GRACEFUL_TIMEOUT_SECONDS = env.int("WEB_SERVER_GRACEFUL_TIMEOUT_SECONDS", default=30)
+
+# Connections to the OpenAI API kept open per process (and per event loop for async calls)
+OPENAI_POOL_SIZE = env.int("OPENAI_POOL_SIZE", default=10)
+OPENAI_CONNECT_TIMEOUT_SECONDS = env.float("OPENAI_CONNECT_TIMEOUT_SECONDS", default=5)
+# Longest wait for data from the API - for streamed responses, the longest gap between chunks
+OPENAI_READ_TIMEOUT_SECONDS = env.float("OPENAI_READ_TIMEOUT_SECONDS", default=30)
+# Longest an async call can take, including reading a streamed response (sync calls have no overall limit)
+OPENAI_ASYNC_TOTAL_TIMEOUT_SECONDS = env.float("OPENAI_ASYNC_TOTAL_TIMEOUT_SECONDS", default=300)
+# How often to log connection pool usage (0 to turn off)
+OPENAI_POOL_STATS_LOG_INTERVAL_SECONDS = env.int("OPENAI_POOL_STATS_LOG_INTERVAL_SECONDS", default=300)
+# Retries of failed OpenAI calls, after the first attempt
+OPENAI_MAX_RETRIES = env.int("OPENAI_MAX_RETRIES", default=2)
+OPENAI_RETRY_BASE_DELAY_SECONDS = env.float("OPENAI_RETRY_BASE_DELAY_SECONDS", default=0.5)
+# Don't retry if the API asks us to wait longer than this
+OPENAI_RETRY_MAX_DELAY_SECONDS = env.float("OPENAI_RETRY_MAX_DELAY_SECONDS", default=10)
+# Fail OpenAI calls straight away for the cool-down once this share of recent calls (at least the minimum) failed
+OPENAI_CIRCUIT_FAILURE_RATE = env.float("OPENAI_CIRCUIT_FAILURE_RATE", default=0.5)
+OPENAI_CIRCUIT_MINIMUM_CALLS = env.int("OPENAI_CIRCUIT_MINIMUM_CALLS", default=10)
+OPENAI_CIRCUIT_WINDOW_SIZE = env.int("OPENAI_CIRCUIT_WINDOW_SIZE", default=20)
+OPENAI_CIRCUIT_COOLDOWN_SECONDS = env.float("OPENAI_CIRCUIT_COOLDOWN_SECONDS", default=30)
+# Moderation results are cached by model, so changing it doesn't reuse results from the old one
+OPENAI_MODERATION_MODEL = env.str("OPENAI_MODERATION_MODEL", default="text-moderation-latest")
+
+# Set MODERATION_CACHE_URL (eg redis://...) to share cached moderation results between processes.
+# The default in-process cache evicts least recently used entries once full - a shared store needs its own
+# eviction policy (eg Redis maxmemory-policy allkeys-lru).
+MODERATION_CACHE_ALIAS = "moderation"
+MODERATION_CACHE_TTL_SECONDS = env.int("MODERATION_CACHE_TTL_SECONDS", default=60 * 60 * 24)
+MODERATION_CACHE_MAX_ENTRIES = env.int("MODERATION_CACHE_MAX_ENTRIES", default=10000)
+moderation_cache = env.cache_url("MODERATION_CACHE_URL", default="locmemcache://moderation")
+moderation_cache["TIMEOUT"] = MODERATION_CACHE_TTL_SECONDS
+if moderation_cache["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache":
+    moderation_cache.setdefault("OPTIONS", {})["MAX_ENTRIES"] = MODERATION_CACHE_MAX_ENTRIES
+
+# Sensitivity check verdicts are cached by the exact text, and the versions and settings that affect them
+# (see ask_ai.conversation.sensitivity_check.get_verdict_cache_version)
+SENSITIVITY_CHECK_CACHE_ALIAS = "sensitivity_check"
+SENSITIVITY_CHECK_CACHE_TTL_SECONDS = env.int("SENSITIVITY_CHECK_CACHE_TTL_SECONDS", default=60 * 60 * 24)
+SENSITIVITY_CHECK_CACHE_MAX_ENTRIES = env.int("SENSITIVITY_CHECK_CACHE_MAX_ENTRIES", default=10000)
+sensitivity_check_cache = env.cache_url("SENSITIVITY_CHECK_CACHE_URL", default="locmemcache://sensitivity-check")
+sensitivity_check_cache["TIMEOUT"] = SENSITIVITY_CHECK_CACHE_TTL_SECONDS
+if sensitivity_check_cache["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache":
+    sensitivity_check_cache.setdefault("OPTIONS", {})["MAX_ENTRIES"] = SENSITIVITY_CHECK_CACHE_MAX_ENTRIES
+
+# Limits on ChatGPT calls shared by all processes (see ask_ai.conversation.llm_limiter).
+# The tokens per minute limit is counted in LLM_LIMITER_CACHE_URL, which must be shared between processes
+# when the limiter is enabled - Redis (redis://...) or memcached, which increment atomically.
+LLM_LIMITER_ENABLED = env.bool("LLM_LIMITER_ENABLED", default=False)
+LLM_LIMITER_MAX_IN_FLIGHT = env.int("LLM_LIMITER_MAX_IN_FLIGHT", default=8)
+LLM_LIMITER_TOKENS_PER_MINUTE = env.int("LLM_LIMITER_TOKENS_PER_MINUTE", default=80000)
+LLM_LIMITER_MAX_WAIT_SECONDS = env.float("LLM_LIMITER_MAX_WAIT_SECONDS", default=20)
+LLM_LIMITER_CACHE_ALIAS = "llm_limiter"
+# Share ChatGPT calls in each process fairly between users (see ask_ai.conversation.llm_scheduler)
+LLM_SCHEDULER_ENABLED = env.bool("LLM_SCHEDULER_ENABLED", default=False)
+# Calls at once in each process, not across processes - the total is this times the number of processes.
+# Only has an effect below the threads of the process, so the default leaves a thread free for other requests.
+LLM_SCHEDULER_CONCURRENCY = env.int(
+    "LLM_SCHEDULER_CONCURRENCY", default=max(min(WEB_SERVER_THREADS, LLM_JOB_WORKER_CONCURRENCY) - 1, 1)
+)
+LLM_SCHEDULER_MAX_WAIT_SECONDS = env.float("LLM_SCHEDULER_MAX_WAIT_SECONDS", default=30)
+# A streamed response claimed this long ago, and not refreshed as chunks arrive, is taken to be abandoned
+# (eg the process was restarted part way) and can be streamed again. Must be longer than the wait for the first chunk.
+STREAM_CHAT_CLAIM_TIMEOUT_SECONDS = env.float(
+    "STREAM_CHAT_CLAIM_TIMEOUT_SECONDS",
+    default=OPENAI_CONNECT_TIMEOUT_SECONDS
+    + OPENAI_READ_TIMEOUT_SECONDS
+    + LLM_SCHEDULER_MAX_WAIT_SECONDS
+    + LLM_LIMITER_MAX_WAIT_SECONDS
+    + 30,
+)
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    MODERATION_CACHE_ALIAS: moderation_cache,
+    SENSITIVITY_CHECK_CACHE_ALIAS: sensitivity_check_cache,
+    LLM_LIMITER_CACHE_ALIAS: env.cache_url("LLM_LIMITER_CACHE_URL", default="locmemcache://llm-limiter"),
+}
+if (
+    LLM_LIMITER_ENABLED
+    and CACHES[LLM_LIMITER_CACHE_ALIAS]["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache"
+):
+    raise ImproperlyConfigured("LLM_LIMITER_CACHE_URL must be a cache shared between processes to enable the limiter")
 
 LOGGING = {
     "version": 1,
@@ -1,10 +1,13 @@
 from automatilib.cola.views import ColaLogout
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 
-from ask_ai.conversation import data_download_views, login_views, views
+from ask_ai.conversation import async_views, data_download_views, login_views, views
 from ask_ai.hosting_environment import HostingEnvironment
 
+chat_views = async_views if settings.ASYNC_CHAT_VIEWS else views
+
 admin_urlpatterns = [
     path("admin/", admin.site.urls),
 ]
@@ -17,10 +20,17 @@ other_urlpatterns = [
     path("", views.index_view, name="index"),
     path("home/", views.index_view, name="homepage"),
     path("declaration/", views.declaration_view, name="declaration"),
-    path("chat/", views.chat_view, name="new-chat"),
-    path("chat/<uuid:chat_id>/", views.chat_view, name="chat"),
-    path("chat/<uuid:chat_id>/<str:option>/", views.chat_view, name="chat-option"),
-    path("chat-sensitivity-check/<uuid:chat_id>/", views.check_sensitivity_view, name="chat-sensitivity-check"),
+    path("chat/", chat_views.chat_view, name="new-chat"),
+    path("chat/<uuid:chat_id>/", chat_views.chat_view, name="chat"),
+    path("chat/<uuid:chat_id>/stream/", chat_views.chat_stream_view, name="chat-stream"),
+    path("chat/<uuid:chat_id>/status/", views.chat_status_view, name="chat-status"),
+    path("chat/<uuid:chat_id>/<str:option>/", chat_views.chat_view, name="chat-option"),
+    path(
+        "chat-sensitivity-check/<uuid:chat_id>/",
+        chat_views.check_sensitivity_view,
+        name="chat-sensitivity-check",
+    ),
+    path("past-chats/", views.past_chats_view, name="past-chats"),
     path("guidance/", views.guidance_view, name="guidance"),
     path("privacy/", views.privacy_view, name="privacy"),
     path("support/", views.support_view, name="support"),
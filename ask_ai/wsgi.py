@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ask_ai.settings")
 
 application = get_wsgi_application()
+
+# Load the sensitivity check analyzer and tiktoken encodings now rather than on the first request
+from ask_ai.conversation import chat_gpt, sensitivity_check  # noqa: E402
+
+sensitivity_check.warm_up_analyzer_engine_in_background()
+chat_gpt.warm_up_encodings_in_background()
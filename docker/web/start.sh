@@ -5,4 +5,5 @@ set -o nounset
 
 poetry run python manage.py migrate
 poetry run python manage.py collectstatic --noinput
-poetry run python manage.py runserver 0.0.0.0:8000
+# Workers and threads per worker are set by WEB_SERVER_WORKERS and WEB_SERVER_THREADS
+exec poetry run python manage.py run_web_server --host 0.0.0.0 --port 8000
@@ -43,4 +43,99 @@ askForm?.addEventListener("submit", () => {
 });
 confirmSafeYesButton?.addEventListener("click", () => {
     window.localStorage.setItem("question-asked", "true");
-});
\ No newline at end of file
+});
+
+// stream the AI response into the page as it arrives, then reload to show the final (moderated) response
+/** @type {HTMLElement | null} */
+const streamedResponse = document.querySelector(".js-streamed-response");
+const streamUrl = streamedResponse?.dataset.streamUrl;
+if (streamedResponse && streamUrl) {
+    const streamedText = streamedResponse.querySelector(".js-streamed-text");
+    const source = new EventSource(streamUrl);
+    const showFinalResponse = () => {
+        source.close();
+        window.location.reload();
+    };
+    source.addEventListener("message", (event) => {
+        if (streamedText) {
+            streamedText.textContent += JSON.parse(event.data);
+        }
+    });
+    source.addEventListener("done", showFinalResponse);
+    source.addEventListener("api-error", showFinalResponse);
+    // connection errors - stop EventSource reconnecting and starting another response
+    source.addEventListener("error", () => source.close());
+}
+
+
+// poll while a worker gets the AI response, then reload to show it
+/** @type {HTMLElement | null} */
+const pendingResponse = document.querySelector(".js-response-pending");
+const statusUrl = pendingResponse?.dataset.statusUrl;
+if (statusUrl) {
+    const checkStatus = async () => {
+        try {
+            const response = await fetch(statusUrl, { credentials: "same-origin" });
+            const status = await response.json();
+            if (!status.pending) {
+                window.location.reload();
+                return;
+            }
+        } catch (error) {
+            // try again on the next poll
+        }
+        window.setTimeout(checkStatus, 2000);
+    };
+    window.setTimeout(checkStatus, 2000);
+}
+
+
+// load older chats into the sidebar as the user scrolls to the end of the list
+/** @type {HTMLElement | null} */
+const previousChats = document.querySelector(".js-previous-chats");
+if (previousChats) {
+    // the page requires trusted types for HTML, the fragments come from our own server with escaped content
+    // @ts-ignore - trustedTypes isn't in the TypeScript DOM types yet
+    const pastChatsPolicy = window.trustedTypes?.createPolicy("past-chats", { createHTML: (html) => html });
+    let loadingChats = false;
+    const loadMoreChats = async () => {
+        /** @type {HTMLElement | null} */
+        const moreChats = previousChats.querySelector(".js-more-chats");
+        const nextPageUrl = moreChats?.dataset.nextPageUrl;
+        if (loadingChats || !moreChats || !nextPageUrl) {
+            return;
+        }
+        loadingChats = true;
+        try {
+            const response = await fetch(nextPageUrl, { credentials: "same-origin" });
+            if (response.ok) {
+                const html = await response.text();
+                const template = document.createElement("template");
+                template.innerHTML = pastChatsPolicy ? pastChatsPolicy.createHTML(html) : html;
+                observer.unobserve(moreChats);
+                moreChats.replaceWith(template.content);
+                observeMoreChats();
+            }
+        } catch (error) {
+            // the user can try again with the button
+        }
+        loadingChats = false;
+    };
+    const observer = new IntersectionObserver((entries) => {
+        if (entries.some((entry) => entry.isIntersecting)) {
+            loadMoreChats();
+        }
+    });
+    const observeMoreChats = () => {
+        const moreChats = previousChats.querySelector(".js-more-chats");
+        if (moreChats) {
+            observer.observe(moreChats);
+        }
+    };
+    previousChats.addEventListener("click", (event) => {
+        if (event.target instanceof Element && event.target.closest(".js-more-chats button")) {
+            loadMoreChats();
+        }
+    });
+    observeMoreChats();
+}
@@ -3,16 +3,35 @@ from unittest.mock import MagicMock
 
 import pytest
 import pytz
+from django.conf import settings
 from django.contrib.auth.models import Group
+from django.core.cache import caches
 from freezegun import freeze_time
 
-from ask_ai.conversation import models
+from ask_ai.conversation import chat_gpt, models, openai_client, sensitivity_check
 from ask_ai.conversation.login_views import ColaLoginForceDeclaration
 from ask_ai.conversation.models import User
 
 UTC = pytz.timezone("UTC")
 
 
+@pytest.fixture(autouse=True)
+def clear_moderation_cache():
+    caches[settings.MODERATION_CACHE_ALIAS].clear()
+    chat_gpt.moderation_cache.reset_stats()
+
+
+@pytest.fixture(autouse=True)
+def clear_sensitivity_check_cache():
+    caches[settings.SENSITIVITY_CHECK_CACHE_ALIAS].clear()
+    sensitivity_check.verdict_cache.reset_stats()
+
+
+@pytest.fixture(autouse=True)
+def reset_openai_circuit_breaker():
+    openai_client.circuit_breaker.reset()
+
+
 @pytest.fixture
 def create_user():
     def _create_user(email, date_joined_iso):
@@ -90,13 +109,16 @@ def mrs_tiggywinkle_chat(mrs_tiggywinkle):
 
 @pytest.fixture
 def peter_chat(peter_rabbit):
-    with freeze_time("2024-01-01 12:00:01"):
+    # A second between prompts, so they have an order
+    with freeze_time("2024-01-01 12:00:01") as frozen_time:
         chat = models.Chat(user=peter_rabbit)
         chat.save()
         prompt = models.Prompt(chat=chat, user_prompt="What is the capital of Spain?", ai_response="Madrid")
         prompt.save()
+        frozen_time.tick()
         prompt = models.Prompt(chat=chat, user_prompt="Moderated prompt", user_prompt_moderated=True)
         prompt.save()
+        frozen_time.tick()
         prompt = models.Prompt(
             chat=chat,
             user_prompt="Flagged sensitive prompt, shouldn't be blocked",
@@ -105,6 +127,7 @@ def peter_chat(peter_rabbit):
             ai_response="Some response",
         )
         prompt.save()
+        frozen_time.tick()
         prompt = models.Prompt(
             chat=chat,
             user_prompt="User confirmed sensitive prompt",
@@ -112,10 +135,12 @@ def peter_chat(peter_rabbit):
             user_confirmed_not_sensitive=False,
         )
         prompt.save()
+        frozen_time.tick()
         prompt = models.Prompt(
             chat=chat, user_prompt="Response moderated", ai_response="Bad AI response", ai_response_moderated=True
         )
         prompt.save()
+        frozen_time.tick()
         prompt = models.Prompt(chat=chat, user_prompt="Error getting response from API", api_call_error=True)
         prompt.save()
     yield chat
@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils import timezone
+
+from ask_ai.conversation import async_views, chat_gpt, models
+from tests.test_chat_gpt import (
+    mock_chat_completion_gpt35_stream,
+    mock_chat_gpt_moderation_false,
+    mock_chat_gpt_moderation_true,
+    mock_get_gpt35_turbo_response,
+)
+
+
+async def mock_achat_gpt_moderation_false(input, **kwargs):
+    return mock_chat_gpt_moderation_false(input)
+
+
+async def mock_achat_gpt_moderation_true(input, **kwargs):
+    return mock_chat_gpt_moderation_true(input)
+
+
+async def mock_aget_gpt35_turbo_response(raw_inputs):
+    return mock_get_gpt35_turbo_response(raw_inputs)
+
+
+async def mock_achat_completion_gpt35_stream(**inputs):
+    async def chunks():
+        for chunk in mock_chat_completion_gpt35_stream(**inputs):
+            yield chunk
+
+    return chunks()
+
+
+def post_to_async_view(view, user, url, data, **kwargs):
+    request = RequestFactory().post(url, data)
+    request.user = user
+    return async_to_sync(view)(request, **kwargs)
+
+
+def get_async_stream_events(view, user, url, **kwargs):
+    request = RequestFactory().get(url)
+    request.user = user
+
+    async def read_events():
+        response = await view(request, **kwargs)
+        # Sent as each event is yielded, not read to the end first
+        assert response.is_async
+        return [event.decode() async for event in response.streaming_content]
+
+    return async_to_sync(read_events)()
+
+
+def test_check_user_prompt_runs_checks_concurrently(monkeypatch):
+    async def slow_moderation(input_text):
+        await asyncio.sleep(0.5)
+        return False
+
+    def slow_sensitivity_check(input_text):
+        time.sleep(0.5)
+        return True
+
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.achat_gpt_moderated", slow_moderation)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.is_text_potentially_sensitive", slow_sensitivity_check)
+    start = time.monotonic()
+    moderated, potentially_sensitive = asyncio.run(async_views.check_user_prompt("Some text"))
+    elapsed = time.monotonic() - start
+    assert not moderated
+    assert potentially_sensitive
+    assert elapsed < 0.9, elapsed  # Slower of the two checks, not their sum
+
+
+@pytest.mark.django_db
+def test_async_chat_view_post_ok(mrs_tiggywinkle, mrs_tiggywinkle_chat, monkeypatch):
+    mrs_tiggywinkle.completed_declaration = True
+    mrs_tiggywinkle.save()
+    chat_id = mrs_tiggywinkle_chat[0].id
+    monkeypatch.setattr("openai.Moderation.acreate", mock_achat_gpt_moderation_false)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.is_text_potentially_sensitive", lambda text: False)
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.aget_gpt35_turbo_response", mock_aget_gpt35_turbo_response)
+    url = reverse("chat", args=(chat_id,))
+    response = post_to_async_view(
+        async_views.chat_view, mrs_tiggywinkle, url, {"user_prompt": "This prompt is acceptable"}, chat_id=chat_id
+    )
+    assert response.status_code == 302, response.status_code
+    assert response.url == url, response.url
+    latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+    assert latest_prompt.user_prompt == "This prompt is acceptable"
+    assert latest_prompt.ai_response == "Mocked response"
+    assert latest_prompt.tokens_input == 57
+    assert latest_prompt.tokens_user_prompt == chat_gpt.num_tokens_from_string(
+        "This prompt is acceptable", models.Prompt.LLMModels.GPT35_TURBO_0125.label
+    )
+    assert not latest_prompt.potentially_sensitive
+
+
+@pytest.mark.django_db
+def test_async_chat_view_post_moderated(mrs_tiggywinkle, mrs_tiggywinkle_chat, monkeypatch):
+    mrs_tiggywinkle.completed_declaration = True
+    mrs_tiggywinkle.save()
+    chat_id = mrs_tiggywinkle_chat[0].id
+    monkeypatch.setattr("openai.Moderation.acreate", mock_achat_gpt_moderation_true)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.is_text_potentially_sensitive", lambda text: True)
+    url = reverse("chat", args=(chat_id,))
+    response = post_to_async_view(
+        async_views.chat_view, mrs_tiggywinkle, url, {"user_prompt": "Dodgy chat to be moderated"}, chat_id=chat_id
+    )
+    assert response.status_code == 302, response.status_code
+    assert response.url == url, response.url
+    latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+    assert latest_prompt.user_prompt_moderated
+    assert not latest_prompt.potentially_sensitive  # Only recorded for prompts that aren't moderated
+
+
+@pytest.mark.django_db
+def test_async_chat_view_other_user_chat(peter_rabbit, jemima_chat):
+    peter_rabbit.completed_declaration = True
+    peter_rabbit.last_login = timezone.now()
+    peter_rabbit.save()
+    url = reverse("chat", args=(jemima_chat.id,))
+    response = post_to_async_view(
+        async_views.chat_view, peter_rabbit, url, {"user_prompt": "Not my chat"}, chat_id=jemima_chat.id
+    )
+    assert "Chat could not be found." in response.content.decode()
+    assert not models.Prompt.objects.filter(chat=jemima_chat).exists()
+
+
+@pytest.mark.django_db
+def test_async_chat_stream_view(mrs_tiggywinkle, mrs_tiggywinkle_chat, monkeypatch):
+    mrs_tiggywinkle.completed_declaration = True
+    mrs_tiggywinkle.save()
+    chat_id = mrs_tiggywinkle_chat[0].id
+    latest_prompt = models.Prompt.objects.create(
+        chat_id=chat_id, llm_model=models.Prompt.LLMModels.GPT35_TURBO_0125, user_prompt="To be streamed"
+    )
+    monkeypatch.setattr("openai.ChatCompletion.acreate", mock_achat_completion_gpt35_stream)
+    monkeypatch.setattr("openai.Moderation.acreate", mock_achat_gpt_moderation_false)
+    url = reverse("chat-stream", args=(chat_id,))
+    events = get_async_stream_events(async_views.chat_stream_view, mrs_tiggywinkle, url, chat_id=chat_id)
+    assert events == [
+        'data: "This is "\n\n',
+        'data: "some streamed "\n\n',
+        'data: "content."\n\n',
+        'event: done\ndata: ""\n\n',
+    ], events
+    latest_prompt.refresh_from_db()
+    assert latest_prompt.ai_response == "This is some streamed content."
+    assert latest_prompt.tokens_output == latest_prompt.tokens_ai_response > 0
+    assert not latest_prompt.response_pending
+    # Nothing left to stream
+    events = get_async_stream_events(async_views.chat_stream_view, mrs_tiggywinkle, url, chat_id=chat_id)
+    assert events == ['event: done\ndata: ""\n\n'], events
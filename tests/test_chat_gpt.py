@@ -1,9 +1,11 @@
 import pytest
+from asgiref.sync import async_to_sync
+from freezegun import freeze_time
 
 from ask_ai.conversation import chat_gpt, constants, models
 
 
-def mock_chat_gpt_moderation_true(input):
+def mock_chat_gpt_moderation_true(input, **kwargs):
     response = {
         "id": "modr-XXXXX",
         "model": "text-moderation-005",
@@ -42,7 +44,7 @@ def mock_chat_gpt_moderation_true(input):
     return response
 
 
-def mock_chat_gpt_moderation_false(input):
+def mock_chat_gpt_moderation_false(input, **kwargs):
     response = {
         "id": "modr-XXXXX",
         "model": "text-moderation-005",
@@ -72,6 +74,13 @@ def mock_chat_completion_gpt35_response(**inputs):
     return output
 
 
+def mock_chat_completion_gpt35_stream(**inputs):
+    assert inputs["stream"]
+    for content in ["This is ", "some streamed ", "content."]:
+        yield {"choices": [{"delta": {"content": content}, "finish_reason": None, "index": 0}]}
+    yield {"choices": [{"delta": {}, "finish_reason": "stop", "index": 0}]}
+
+
 def mock_get_gpt35_turbo_response(raw_inputs):
     outputs = {
         "ai_response": "Mocked response",
@@ -89,10 +98,71 @@ def test_chat_gpt_moderated(monkeypatch):
     output = chat_gpt.chat_gpt_moderated("test input")
     assert output, output
     monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_false)
-    output = chat_gpt.chat_gpt_moderated("test input")
+    output = chat_gpt.chat_gpt_moderated("other test input")
     assert not output, output
 
 
+def test_chat_gpt_moderated_cached(monkeypatch):
+    calls = []
+
+    def mock_moderation(input, **kwargs):
+        calls.append(input)
+        return mock_chat_gpt_moderation_true(input)
+
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    assert chat_gpt.chat_gpt_moderated("test input")
+    assert chat_gpt.chat_gpt_moderated("  test\ninput ")
+    assert calls == ["test input"]
+    assert chat_gpt.moderation_cache.get_stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_chat_gpt_moderated_cached_by_model(monkeypatch, settings):
+    calls = []
+
+    def mock_moderation(input, **kwargs):
+        calls.append(kwargs["model"])
+        return mock_chat_gpt_moderation_false(input)
+
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    chat_gpt.chat_gpt_moderated("test input")
+    settings.OPENAI_MODERATION_MODEL = "text-moderation-stable"
+    chat_gpt.chat_gpt_moderated("test input")
+    chat_gpt.chat_gpt_moderated("test input")
+    assert calls == ["text-moderation-latest", "text-moderation-stable"]
+
+
+def test_achat_gpt_moderated_cached(monkeypatch):
+    calls = []
+
+    async def mock_moderation(input, **kwargs):
+        calls.append(input)
+        return mock_chat_gpt_moderation_false(input)
+
+    monkeypatch.setattr("openai.Moderation.acreate", mock_moderation)
+    assert not async_to_sync(chat_gpt.achat_gpt_moderated)("test input")
+    # Results are shared with the sync version
+    assert not chat_gpt.chat_gpt_moderated("test input")
+    assert calls == ["test input"]
+
+
+def test_chat_gpt_moderated_batch(monkeypatch):
+    batches = []
+
+    def mock_moderation(input, **kwargs):
+        batches.append(input)
+        return {"results": [{"flagged": "bad" in text} for text in input]}
+
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.MODERATION_BATCH_SIZE", 2)
+    chat_gpt.moderation_cache.set("cached bad text", "text-moderation-latest", False)
+    texts = ["fine", "bad", "cached bad text", "fine", "also bad", "also fine"]
+    output = chat_gpt.chat_gpt_moderated_batch(texts)
+    assert output == [False, True, False, False, True, False], output
+    assert batches == [["fine", "bad"], ["also bad", "also fine"]], batches
+    assert chat_gpt.chat_gpt_moderated("also bad")
+    assert len(batches) == 2
+
+
 @pytest.mark.django_db
 def test_get_valid_messages_for_chat(peter_chat):
     expected_messages = [
@@ -231,6 +301,81 @@ def test_get_latest_messages_to_token_limit():
     assert num_tokens <= (constants.TOKEN_LIMITS[models.Prompt.LLMModels.GPT35_TURBO_1106] - 10), output_messages
 
 
+def test_get_latest_messages_to_token_limit_with_message_tokens():
+    messages = [
+        {"role": "user", "content": "Oldest question"},
+        {"role": "assistant", "content": "Oldest answer"},
+        {"role": "user", "content": "Newer question"},
+        {"role": "assistant", "content": "Newer answer"},
+        {"role": "user", "content": "Latest question"},
+    ]
+    message_tokens = [2000, 1500, 200, 300, 100]
+    num_tokens, output_messages = chat_gpt.get_latest_messages_to_token_limit(
+        messages, models.Prompt.LLMModels.GPT35_TURBO_0125, buffer=200, message_tokens=message_tokens
+    )
+    # 3 + 100 + 300 + 200 + 1500 = 2103 fits in 4096 - 200, adding the oldest message doesn't
+    assert output_messages == messages[1:], output_messages
+    assert num_tokens == 2103, num_tokens
+    assert len(messages) == 5  # original list not altered
+
+
+@pytest.fixture
+def long_chat(peter_rabbit):
+    # 30 prompts a minute apart, each message stored as 100 tokens
+    with freeze_time("2024-01-01 12:00:01") as frozen_time:
+        chat = models.Chat.objects.create(user=peter_rabbit)
+        for i in range(30):
+            models.Prompt.objects.create(
+                chat=chat,
+                user_prompt=f"Question {i}",
+                ai_response=f"Answer {i}",
+                tokens_user_prompt=100,
+                tokens_ai_response=100,
+                user_prompt_moderated=i % 7 == 0,
+            )
+            frozen_time.tick(60)
+    return chat
+
+
+@pytest.mark.parametrize("token_limit", [10000, 1000])
+@pytest.mark.django_db
+def test_get_latest_valid_messages_to_token_limit(monkeypatch, long_chat, token_limit):
+    model = models.Prompt.LLMModels.GPT35_TURBO_0125
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.HISTORY_BATCH_SIZE", 4)
+    monkeypatch.setitem(chat_gpt.TOKEN_LIMITS, model, token_limit)
+    all_messages = chat_gpt.get_valid_messages_for_chat(long_chat)
+    # Stored content tokens, the role and TOKENS_PER_MESSAGE
+    message_tokens = [104] * len(all_messages)
+    expected = chat_gpt.get_latest_messages_to_token_limit(all_messages, model, 200, message_tokens)
+    actual = chat_gpt.get_latest_valid_messages_to_token_limit(long_chat, model, buffer=200)
+    assert actual == expected, actual
+    assert (len(actual[1]) < len(all_messages)) == (token_limit == 1000)
+
+
+@pytest.mark.django_db
+def test_get_latest_valid_messages_to_token_limit_stops_reading(monkeypatch, long_chat, django_assert_num_queries):
+    model = models.Prompt.LLMModels.GPT35_TURBO_0125
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.HISTORY_BATCH_SIZE", 4)
+    monkeypatch.setitem(chat_gpt.TOKEN_LIMITS, model, 1000)
+    # 7 messages fit, from the latest 4 valid prompts (28 was moderated), so one batch
+    with django_assert_num_queries(1):
+        num_tokens, messages = chat_gpt.get_latest_valid_messages_to_token_limit(long_chat, model, buffer=200)
+    assert num_tokens == 3 + 7 * 104
+    assert messages[0] == {"role": "assistant", "content": "Answer 25"}
+    assert messages[-1] == {"role": "assistant", "content": "Answer 29"}
+
+
+@pytest.mark.django_db
+def test_get_chat_gpt_inputs_uses_stored_token_counts(peter_chat):
+    expected = chat_gpt.get_chat_gpt_inputs(peter_chat, models.Prompt.LLMModels.GPT35_TURBO_0125)
+    models.Prompt.objects.filter(chat=peter_chat, user_prompt="What is the capital of Spain?").update(
+        tokens_user_prompt=1000, tokens_ai_response=1000
+    )
+    actual = chat_gpt.get_chat_gpt_inputs(peter_chat, models.Prompt.LLMModels.GPT35_TURBO_0125)
+    assert actual["messages"] == expected["messages"], actual["messages"]
+    assert actual["max_tokens"] < expected["max_tokens"] - 1900, actual["max_tokens"]
+
+
 @pytest.mark.django_db
 def test_submit_valid_chat_to_chatgpt35(monkeypatch, peter_chat, peter_rabbit_prompt):
     inputs = chat_gpt.get_chat_gpt_inputs(chat=peter_chat, model=models.Prompt.LLMModels.GPT35_TURBO_1106)
@@ -242,3 +387,28 @@ def test_submit_valid_chat_to_chatgpt35(monkeypatch, peter_chat, peter_rabbit_pr
     assert latest_prompt.tokens_output == 17
     assert latest_prompt.cost_input_dollars == 0.05
     assert latest_prompt.cost_output_dollars == 0.9
+    assert latest_prompt.tokens_ai_response == 3  # "Mocked response"
+
+
+def test_stream_gpt35_turbo_response(monkeypatch):
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    inputs = {"model": models.Prompt.LLMModels.GPT35_TURBO_0125.label, "messages": []}
+    chunks = list(chat_gpt.stream_gpt35_turbo_response(inputs))
+    assert chunks == ["This is ", "some streamed ", "content."], chunks
+
+
+@pytest.mark.django_db
+def test_stream_valid_chat_to_chatgpt35(monkeypatch, peter_chat, peter_rabbit_prompt):
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_true)
+    inputs = chat_gpt.get_chat_gpt_inputs(chat=peter_chat, model=models.Prompt.LLMModels.GPT35_TURBO_0125)
+    stream = chat_gpt.stream_valid_chat_to_chatgpt35(peter_rabbit_prompt, inputs)
+    assert next(stream) == "This is "
+    peter_rabbit_prompt.refresh_from_db()
+    assert not peter_rabbit_prompt.ai_response  # Only saved once the response is complete and moderated
+    assert list(stream) == ["some streamed ", "content."]
+    peter_rabbit_prompt.refresh_from_db()
+    assert peter_rabbit_prompt.ai_response == "This is some streamed content.", peter_rabbit_prompt.ai_response
+    assert peter_rabbit_prompt.ai_response_moderated
+    assert peter_rabbit_prompt.tokens_output == peter_rabbit_prompt.tokens_ai_response > 0
+    assert peter_rabbit_prompt.cost_output_dollars > 0
@@ -0,0 +1,149 @@
+import csv
+import io
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+
+from ask_ai.conversation import chat_gpt, models, utils
+
+
+@pytest.mark.django_db
+def test_backfill_prompt_tokens(peter_chat):
+    models.Prompt.objects.filter(chat=peter_chat).update(tokens_user_prompt=None, tokens_ai_response=None)
+    already_counted = models.Prompt(chat=peter_chat, user_prompt="Counted", tokens_user_prompt=99, tokens_ai_response=0)
+    already_counted.save()
+    call_command("backfill_prompt_tokens", batch_size=2)
+    assert not models.Prompt.objects.filter(tokens_user_prompt__isnull=True).exists()
+    assert not models.Prompt.objects.filter(tokens_ai_response__isnull=True).exists()
+    prompt = models.Prompt.objects.get(chat=peter_chat, user_prompt="What is the capital of Spain?")
+    assert prompt.tokens_user_prompt == 7, prompt.tokens_user_prompt
+    assert prompt.tokens_ai_response == 2, prompt.tokens_ai_response
+    already_counted.refresh_from_db()
+    assert already_counted.tokens_user_prompt == 99, already_counted.tokens_user_prompt
+
+
+def mock_moderation_flag_capitals(input, **kwargs):
+    return {"results": [{"flagged": "capital" in text or text == "Madrid"} for text in input]}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("update", [False, True])
+def test_remoderate_prompts(monkeypatch, peter_chat, update):
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation_flag_capitals)
+    call_command("remoderate_prompts", batch_size=4, update=update)
+    capital_prompt = models.Prompt.objects.get(chat=peter_chat, user_prompt="What is the capital of Spain?")
+    previously_moderated = models.Prompt.objects.get(chat=peter_chat, user_prompt="Response moderated")
+    assert capital_prompt.user_prompt_moderated == update
+    assert capital_prompt.ai_response_moderated == update
+    assert previously_moderated.ai_response_moderated != update
+
+
+@pytest.mark.django_db
+def test_remoderate_prompts_after_id(monkeypatch, peter_chat):
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation_flag_capitals)
+    prompts = list(models.Prompt.objects.order_by("id"))
+    output = io.StringIO()
+    # Ids are UUIDs
+    call_command("remoderate_prompts", f"--after-id={prompts[-2].id}", stdout=output)
+    assert "checked 1 prompts" in output.getvalue()
+
+
+@pytest.mark.django_db
+def test_remoderate_prompts_no_cache(monkeypatch, peter_chat):
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation_flag_capitals)
+    chat_gpt.moderation_cache.set("Madrid", "text-moderation-latest", False)
+    call_command("remoderate_prompts", update=True)
+    capital_prompt = models.Prompt.objects.get(chat=peter_chat, user_prompt="What is the capital of Spain?")
+    assert not capital_prompt.ai_response_moderated  # Cached result used
+    call_command("remoderate_prompts", "--no-cache", update=True)
+    capital_prompt.refresh_from_db()
+    assert capital_prompt.ai_response_moderated
+    assert chat_gpt.moderation_cache.get("Madrid", "text-moderation-latest")  # Fresh result cached
+
+
+def read_report(report_path):
+    with open(report_path, newline="") as report_file:
+        return list(csv.DictReader(report_file))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("update", [False, True])
+def test_rescan_sensitivity(peter_chat, tmp_path, update):
+    postcode_prompt = models.Prompt(chat=peter_chat, user_prompt="I live at SW1A 2AS")
+    postcode_prompt.save()
+    report_path = tmp_path / "report.csv"
+    call_command("rescan_sensitivity", batch_size=3, report=str(report_path), update=update)
+    rows = {row["prompt_id"]: row for row in read_report(report_path)}
+    assert len(rows) == models.Prompt.objects.count()
+    assert rows[str(postcode_prompt.id)]["potentially_sensitive"] == "True"
+    assert rows[str(postcode_prompt.id)]["entity_types"] == "UK_POSTCODE"
+    confirmed_prompt = models.Prompt.objects.get(user_prompt="User confirmed sensitive prompt")
+    assert rows[str(confirmed_prompt.id)]["was_potentially_sensitive"] == "True"
+    assert rows[str(confirmed_prompt.id)]["potentially_sensitive"] == "False"
+    postcode_prompt.refresh_from_db()
+    confirmed_prompt.refresh_from_db()
+    assert postcode_prompt.potentially_sensitive == update
+    assert confirmed_prompt.potentially_sensitive != update
+
+
+@pytest.mark.django_db
+def test_rescan_sensitivity_resume(peter_chat, tmp_path):
+    report_path = tmp_path / "report.csv"
+    with pytest.raises(CommandError):
+        call_command("rescan_sensitivity", report=str(report_path), resume=True)
+    prompt_ids = [str(prompt_id) for prompt_id in models.Prompt.objects.order_by("id").values_list("id", flat=True)]
+    call_command("rescan_sensitivity", report=str(report_path))
+    # Stopped after the first two prompts
+    rows = read_report(report_path)
+    report_path.write_text("".join(line + "\n" for line in report_path.read_text().splitlines()[:3]))
+    call_command("rescan_sensitivity", report=str(report_path), resume=True)
+    assert read_report(report_path) == rows
+    assert [row["prompt_id"] for row in rows] == prompt_ids
+    with pytest.raises(CommandError):
+        call_command("rescan_sensitivity", report=str(report_path))
+
+
+@pytest.mark.django_db
+def test_rescan_sensitivity_resume_after_failed_update(peter_chat, tmp_path, monkeypatch):
+    report_path = tmp_path / "report.csv"
+    bulk_update = models.Prompt.objects.bulk_update
+    updated_batches = []
+
+    def fail_second_update(prompts, fields):
+        if updated_batches:
+            raise KeyboardInterrupt
+        updated_batches.append(prompts)
+        return bulk_update(prompts, fields)
+
+    monkeypatch.setattr(models.Prompt.objects, "bulk_update", fail_second_update)
+    with pytest.raises(KeyboardInterrupt):
+        call_command("rescan_sensitivity", batch_size=2, report=str(report_path), update=True)
+    # Only the batch that was saved is reported
+    assert len(read_report(report_path)) == 2
+    monkeypatch.undo()
+    call_command("rescan_sensitivity", batch_size=2, report=str(report_path), update=True, resume=True)
+    prompt_ids = [str(prompt_id) for prompt_id in models.Prompt.objects.order_by("id").values_list("id", flat=True)]
+    assert [row["prompt_id"] for row in read_report(report_path)] == prompt_ids
+    confirmed_prompt = models.Prompt.objects.get(user_prompt="User confirmed sensitive prompt")
+    assert not confirmed_prompt.potentially_sensitive
+
+
+@pytest.mark.django_db
+def test_explain_conversation_queries():
+    out = io.StringIO()
+    call_command(
+        "explain_conversation_queries", seed_users=2, chats_per_user=3, prompts_per_chat=10, compare=True, stdout=out
+    )
+    seeded_chats = models.Chat.objects.filter(user__email__endswith="@seed.example.com")
+    assert seeded_chats.count() == 6
+    assert models.Prompt.objects.filter(chat__in=seeded_chats).count() == 60
+    # Every tenth prompt is flagged sensitive, so not history
+    assert utils.get_all_valid_prompts_from_chat(seeded_chats.first()).count() == 9
+    output = out.getvalue()
+    assert output.count("Chat history (ChatGPT inputs)") == 2
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, models.Prompt._meta.db_table)
+    # Put back after comparing
+    assert "prompt_valid_history_idx" in constraints
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+import tiktoken
+from django.conf import settings
+from django.core.management import call_command
+
+from ask_ai.conversation import chat_gpt, encodings
+
+
+@pytest.fixture
+def loaded_models(monkeypatch):
+    loaded_models = []
+    encoding_for_model = tiktoken.encoding_for_model
+
+    def mock_encoding_for_model(model_name):
+        loaded_models.append(model_name)
+        return encoding_for_model(model_name)
+
+    monkeypatch.setattr("ask_ai.conversation.encodings._encodings", {})
+    monkeypatch.setattr("tiktoken.encoding_for_model", mock_encoding_for_model)
+    return loaded_models
+
+
+def test_tiktoken_cache_dir():
+    assert os.environ["TIKTOKEN_CACHE_DIR"] == settings.TIKTOKEN_CACHE_DIR
+
+
+def test_encodings_loaded_once(loaded_models):
+    encoding = encodings.get_encoding_for_model("gpt-3.5-turbo")
+    assert encodings.get_encoding_for_model("gpt-3.5-turbo") is encoding
+    chat_gpt.num_tokens_from_string("Some text", "gpt-3.5-turbo")
+    assert loaded_models == ["gpt-3.5-turbo"]
+
+
+def test_warm_up_encodings_in_background(loaded_models):
+    chat_gpt.warm_up_encodings_in_background().join()
+    assert loaded_models == list(chat_gpt.MODELS_WITH_TOKEN_COUNTS)
+    chat_gpt.get_encoding_for_model("gpt-4")
+    assert len(loaded_models) == len(chat_gpt.MODELS_WITH_TOKEN_COUNTS)
+
+
+def test_seed_tiktoken_cache(loaded_models, capsys):
+    call_command("seed_tiktoken_cache")
+    assert loaded_models == list(chat_gpt.MODELS_WITH_TOKEN_COUNTS)
+    assert settings.TIKTOKEN_CACHE_DIR in capsys.readouterr().out
@@ -0,0 +1,162 @@
+import datetime
+import io
+
+import openai
+import pytest
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from ask_ai.conversation import job_queue, models
+from tests.test_chat_gpt import mock_chat_gpt_moderation_false, mock_get_gpt35_turbo_response
+
+from . import utils
+
+Status = models.ChatCompletionJob.Status
+
+
+def mock_get_gpt35_turbo_response_error(raw_inputs):
+    raise openai.error.Timeout("Request timed out")
+
+
+@pytest.fixture
+def queued_prompt(peter_chat):
+    prompt = models.Prompt(
+        chat=peter_chat, llm_model=models.Prompt.LLMModels.GPT35_TURBO_0125, user_prompt="Queued prompt"
+    )
+    prompt.save()
+    job_queue.enqueue_chat_completion(prompt)
+    yield prompt
+
+
+@pytest.mark.django_db
+def test_enqueue_chat_completion(queued_prompt):
+    queued_prompt.refresh_from_db()
+    assert queued_prompt.response_pending
+    job = models.ChatCompletionJob.objects.get(prompt=queued_prompt)
+    assert job.status == Status.PENDING
+
+
+@pytest.mark.django_db
+def test_process_next_job(monkeypatch, queued_prompt):
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.get_gpt35_turbo_response", mock_get_gpt35_turbo_response)
+    assert job_queue.process_next_job("test-worker")
+    queued_prompt.refresh_from_db()
+    assert not queued_prompt.response_pending
+    assert queued_prompt.ai_response == "Mocked response"
+    job = models.ChatCompletionJob.objects.get(prompt=queued_prompt)
+    assert job.status == Status.DONE
+    assert job.attempts == 1
+    assert job.locked_by == "test-worker"
+    assert not job_queue.process_next_job("test-worker")  # Queue now empty
+
+
+@pytest.mark.django_db
+def test_process_next_job_api_error(monkeypatch, queued_prompt):
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.get_gpt35_turbo_response", mock_get_gpt35_turbo_response_error)
+    assert job_queue.process_next_job("test-worker")
+    queued_prompt.refresh_from_db()
+    assert not queued_prompt.response_pending
+    assert queued_prompt.api_call_error
+    assert models.ChatCompletionJob.objects.get(prompt=queued_prompt).status == Status.FAILED
+
+
+@pytest.mark.django_db
+def test_recover_abandoned_jobs(queued_prompt, settings):
+    settings.LLM_JOB_MAX_ATTEMPTS = 2
+    job = job_queue.claim_next_job("crashed-worker")
+    assert job_queue.recover_abandoned_jobs() == 0  # Lock hasn't timed out yet
+    job.locked_at = timezone.now() - datetime.timedelta(seconds=settings.LLM_JOB_LOCK_TIMEOUT_SECONDS + 1)
+    job.save()
+    assert job_queue.recover_abandoned_jobs() == 1
+    job.refresh_from_db()
+    assert job.status == Status.PENDING
+    assert not job.locked_by
+    job = job_queue.claim_next_job("crashed-worker")
+    job.locked_at = timezone.now() - datetime.timedelta(seconds=settings.LLM_JOB_LOCK_TIMEOUT_SECONDS + 1)
+    job.save()
+    assert job_queue.recover_abandoned_jobs() == 1
+    job.refresh_from_db()
+    assert job.status == Status.FAILED  # Used up its attempts
+    queued_prompt.refresh_from_db()
+    assert queued_prompt.api_call_error
+    assert not queued_prompt.response_pending
+
+
+@pytest.mark.django_db
+def test_chat_view_post_queued(mrs_tiggywinkle, mrs_tiggywinkle_chat, client, monkeypatch, settings):
+    settings.LLM_JOB_QUEUE_ENABLED = True
+    client.force_login(mrs_tiggywinkle)
+    utils.complete_declaration(client)
+    chat_id = mrs_tiggywinkle_chat[0].id
+    monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_false)
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.get_gpt35_turbo_response", mock_get_gpt35_turbo_response)
+    response = client.post(reverse("chat", args=(chat_id,)), {"user_prompt": "This prompt is acceptable"})
+    assert response.status_code == 302, response.status_code
+    latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+    assert latest_prompt.response_pending
+    assert not latest_prompt.ai_response  # Not called in the request
+    status_url = reverse("chat-status", args=(chat_id,))
+    response = client.get(reverse("chat", args=(chat_id,)))
+    assert f'data-status-url="{status_url}"' in response.content.decode()
+    assert client.get(status_url).json() == {"pending": True}
+    job_queue.process_next_job("test-worker")
+    assert client.get(status_url).json() == {"pending": False}
+    latest_prompt.refresh_from_db()
+    assert latest_prompt.ai_response == "Mocked response"
+
+
+@pytest.mark.django_db
+def test_claim_next_job_fair_between_users(peter_chat, alice):
+    alice_chat = models.Chat.objects.create(user=alice)
+    peter_jobs = []
+    for i in range(3):
+        prompt = models.Prompt.objects.create(chat=peter_chat, user_prompt=f"Peter prompt {i}")
+        peter_jobs.append(job_queue.enqueue_chat_completion(prompt))
+    alice_prompt = models.Prompt.objects.create(chat=alice_chat, user_prompt="Alice prompt")
+    alice_job = job_queue.enqueue_chat_completion(alice_prompt)
+    assert job_queue.claim_next_job("test-worker") == peter_jobs[0]
+    # Peter has a job running, so Alice goes next despite queueing later
+    assert job_queue.claim_next_job("test-worker") == alice_job
+    assert job_queue.claim_next_job("test-worker") == peter_jobs[1]
+    assert job_queue.count_jobs_by_user(Status.RUNNING) == {peter_chat.user_id: 2, alice.id: 1}
+    assert job_queue.count_jobs_by_user(Status.PENDING) == {peter_chat.user_id: 1}
+
+
+@pytest.mark.django_db
+def test_llm_queue_status_command(queued_prompt):
+    output = io.StringIO()
+    call_command("llm_queue_status", stdout=output)
+    lines = output.getvalue().splitlines()
+    assert lines[1].split() == ["peter.rabbit@example.com", "1", "0"]
+    assert lines[2].split() == ["Total", "1", "0"]
+
+
+@pytest.mark.django_db
+def test_refresh_lock(queued_prompt, settings):
+    job = job_queue.claim_next_job("slow-worker")
+    job.locked_at = timezone.now() - datetime.timedelta(seconds=settings.LLM_JOB_LOCK_TIMEOUT_SECONDS + 1)
+    job.save()
+    assert job_queue.refresh_lock(job)
+    assert job_queue.recover_abandoned_jobs() == 0  # Still running
+    job.refresh_from_db()
+    assert job.status == Status.RUNNING
+
+
+@pytest.mark.django_db
+def test_run_job_drops_result_after_recovery(monkeypatch, queued_prompt):
+    job = job_queue.claim_next_job("slow-worker")
+
+    def mock_response_after_recovery(raw_inputs):
+        # The lock timed out during the call and another worker took the job
+        models.ChatCompletionJob.objects.filter(id=job.id).update(status=Status.RUNNING, locked_by="other-worker")
+        assert not job_queue.refresh_lock(job)
+        return mock_get_gpt35_turbo_response(raw_inputs)
+
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.get_gpt35_turbo_response", mock_response_after_recovery)
+    job_queue.run_job(job)
+    queued_prompt.refresh_from_db()
+    assert queued_prompt.response_pending  # Left for the other worker
+    assert not queued_prompt.ai_response
+    job.refresh_from_db()
+    assert job.locked_by == "other-worker"
@@ -0,0 +1,201 @@
+import threading
+
+import openai
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from freezegun import freeze_time
+
+from ask_ai.conversation import chat_gpt, llm_limiter
+from tests.test_chat_gpt import mock_chat_completion_gpt35_stream
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch, settings):
+    settings.LLM_LIMITER_ENABLED = True
+    llm_limiter.get_cache().clear()
+    monkeypatch.setattr("ask_ai.conversation.llm_limiter.stats", llm_limiter.LimiterStats())
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    # Slots returned by successive tries, then None (all in use)
+    slots = []
+    released = []
+    monkeypatch.setattr("ask_ai.conversation.llm_limiter.try_acquire_slot", lambda: slots.pop(0) if slots else None)
+    monkeypatch.setattr("ask_ai.conversation.llm_limiter.release_slot", released.append)
+    return slots, released
+
+
+def test_limiter_disabled(settings, slots):
+    settings.LLM_LIMITER_ENABLED = False
+    with llm_limiter.limit_chat_completion(100):
+        pass
+    assert llm_limiter.stats.calls == 0
+
+
+def test_try_reserve_tokens(settings):
+    settings.LLM_LIMITER_TOKENS_PER_MINUTE = 100
+    with freeze_time("2024-01-01 12:00:01"):
+        assert llm_limiter.try_reserve_tokens(80)
+        assert not llm_limiter.try_reserve_tokens(30)
+        assert llm_limiter.try_reserve_tokens(20)
+    with freeze_time("2024-01-01 12:01:01"):
+        # Allowed on its own in a new minute, even if over the limit
+        assert llm_limiter.try_reserve_tokens(500)
+        assert not llm_limiter.try_reserve_tokens(1)
+
+
+def test_reservation_moves_to_new_window(settings, slots):
+    settings.LLM_LIMITER_TOKENS_PER_MINUTE = 100
+    with freeze_time("2024-01-01 12:00:01"):
+        tokens_key, slot = llm_limiter._try_acquire(60, None)
+        assert tokens_key
+        assert slot is None
+    with freeze_time("2024-01-01 12:01:01"):
+        new_tokens_key, slot = llm_limiter._try_acquire(60, tokens_key)
+        assert new_tokens_key != tokens_key
+        # Counted in the new window
+        assert not llm_limiter.try_reserve_tokens(50)
+        # Window gone from the cache, giving up still times out cleanly
+        llm_limiter.get_cache().delete(new_tokens_key)
+        assert isinstance(llm_limiter._give_up(60, new_tokens_key, 1), llm_limiter.LimiterTimeoutError)
+
+
+def test_limit_chat_completion_waits_for_slot(slots):
+    slots_, released = slots
+    slots_.extend([None, None, 3])
+    with llm_limiter.limit_chat_completion(100):
+        assert released == []
+    assert released == [3]
+    stats = llm_limiter.get_stats()
+    assert stats["calls"] == 1
+    assert stats["waited_calls"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_limit_chat_completion_times_out(settings, slots):
+    settings.LLM_LIMITER_MAX_WAIT_SECONDS = 0
+    settings.LLM_LIMITER_TOKENS_PER_MINUTE = 1000
+    with freeze_time("2024-01-01 12:00:01"):
+        with pytest.raises(chat_gpt.OPEN_AI_API_ERRORS):
+            with llm_limiter.limit_chat_completion(600):
+                pass
+        # Tokens given back
+        assert llm_limiter.try_reserve_tokens(600)
+    assert llm_limiter.get_stats()["timed_out_calls"] == 1
+    assert llm_limiter.get_queue_depth() == 0
+
+
+def test_alimit_chat_completion_waits_for_slot(monkeypatch, slots):
+    slots_, released = slots
+    slots_.extend([None, 1])
+
+    async def mock_sleep(delay):
+        pass
+
+    async def limited_call():
+        async with llm_limiter.alimit_chat_completion(100):
+            return list(released)
+
+    monkeypatch.setattr("asyncio.sleep", mock_sleep)
+    assert async_to_sync(limited_call)() == []
+    assert released == [1]
+    assert llm_limiter.get_stats()["waited_calls"] == 1
+
+
+def test_get_gpt35_turbo_response_limited(monkeypatch, slots):
+    slots_, released = slots
+    slots_.append(2)
+
+    def mock_chat_completion(**inputs):
+        assert released == []
+        return {
+            "choices": [{"message": {"content": "Madrid"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 1},
+        }
+
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion)
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.chat_gpt_moderated", lambda text: False)
+    raw_inputs = {
+        "model": "gpt-3.5-turbo-0125",
+        "messages": [{"role": "user", "content": "Capital?"}],
+        "max_tokens": 50,
+    }
+    outputs = chat_gpt.get_gpt35_turbo_response(raw_inputs)
+    assert outputs["ai_response"] == "Madrid"
+    assert released == [2]
+
+
+def test_slot_given_up_while_waiting_to_retry(monkeypatch, slots):
+    slots_, released = slots
+    slots_.extend([1, 2])
+    released_at_calls = []
+    released_at_sleeps = []
+
+    def flaky_chat_completion(**inputs):
+        released_at_calls.append(list(released))
+        if len(released_at_calls) == 1:
+            raise openai.error.RateLimitError("Rate limit reached")
+        return {
+            "choices": [{"message": {"content": "Madrid"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 1},
+        }
+
+    monkeypatch.setattr("openai.ChatCompletion.create", flaky_chat_completion)
+    monkeypatch.setattr("time.sleep", lambda seconds: released_at_sleeps.append(list(released)))
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.chat_gpt_moderated", lambda text: False)
+    raw_inputs = {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "user", "content": "Capital?"}]}
+    outputs = chat_gpt.get_gpt35_turbo_response(raw_inputs)
+    assert outputs["ai_response"] == "Madrid"
+    # Each attempt takes its own slot, and the first is released before waiting to retry
+    assert released_at_calls == [[], [1]]
+    assert released_at_sleeps == [[1]]
+    assert released == [1, 2]
+    assert llm_limiter.get_stats()["calls"] == 2
+
+
+def test_slot_held_while_streaming(monkeypatch, slots):
+    slots_, released = slots
+    slots_.extend([1, 2])
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    raw_inputs = {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "user", "content": "Stream"}]}
+    chunks = chat_gpt.stream_gpt35_turbo_response(raw_inputs)
+    assert next(chunks) == "This is "
+    assert released == []
+    assert list(chunks) == ["some streamed ", "content."]
+    assert released == [1]
+    # Stopped part way
+    chunks = chat_gpt.stream_gpt35_turbo_response(raw_inputs)
+    next(chunks)
+    chunks.close()
+    assert released == [1, 2]
+
+
+def test_estimate_request_tokens():
+    raw_inputs = {"messages": [{"role": "user", "content": "x" * 40}], "max_tokens": 100}
+    assert chat_gpt.estimate_request_tokens(raw_inputs) == 110
+
+
+@pytest.mark.django_db
+def test_advisory_lock_slots(settings):
+    settings.LLM_LIMITER_MAX_IN_FLIGHT = 1
+    other_connection_slots = []
+
+    def try_from_other_connection():
+        other_connection_slots.append(llm_limiter.try_acquire_slot())
+        if other_connection_slots[-1] is not None:
+            llm_limiter.release_slot(other_connection_slots[-1])
+        connection.close()
+
+    slot = llm_limiter.try_acquire_slot()
+    assert slot == 0
+    thread = threading.Thread(target=try_from_other_connection)
+    thread.start()
+    thread.join()
+    llm_limiter.release_slot(slot)
+    thread = threading.Thread(target=try_from_other_connection)
+    thread.start()
+    thread.join()
+    assert other_connection_slots == [None, 0]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from asgiref.sync import async_to_sync
+
+from ask_ai.conversation import chat_gpt, health_checks, llm_scheduler, models
+from tests.test_chat_gpt import mock_get_gpt35_turbo_response
+
+
+def test_fair_scheduler_round_robin():
+    scheduler = llm_scheduler.FairScheduler(concurrency=1)
+    scheduler.acquire("alice")
+    granted = []
+    for user_id, request in [("alice", 1), ("alice", 2), ("alice", 3), ("bob", 1), ("chris", 1)]:
+        waiter = llm_scheduler.Waiter(lambda user_id=user_id, request=request: granted.append((user_id, request)))
+        assert not scheduler._try_acquire_or_wait(user_id, waiter)
+    assert scheduler.get_queue_lengths() == {"alice": 3, "bob": 1, "chris": 1}
+    for _ in range(5):
+        scheduler.release()
+    assert granted == [("alice", 1), ("bob", 1), ("chris", 1), ("alice", 2), ("alice", 3)]
+    assert scheduler.running == 1
+    scheduler.release()
+    assert scheduler.running == 0
+
+
+def test_fair_scheduler_timeout():
+    scheduler = llm_scheduler.FairScheduler(concurrency=1)
+    scheduler.acquire("alice")
+    with pytest.raises(chat_gpt.OPEN_AI_API_ERRORS):
+        scheduler.acquire("bob", timeout=0.01)
+    assert scheduler.get_queue_lengths() == {}
+    scheduler.release()
+    scheduler.acquire("bob", timeout=0.01)
+
+
+def test_fair_scheduler_async():
+    scheduler = llm_scheduler.FairScheduler(concurrency=1)
+
+    async def wait_for_turn():
+        await scheduler.aacquire("alice")
+        waiting = asyncio.ensure_future(scheduler.aacquire("bob", timeout=1))
+        await asyncio.sleep(0)
+        assert scheduler.get_queue_lengths() == {"bob": 1}
+        scheduler.release()
+        await waiting
+
+    async_to_sync(wait_for_turn)()
+    assert scheduler.running == 1
+
+
+def test_fair_scheduler_async_granted_at_timeout():
+    scheduler = llm_scheduler.FairScheduler(concurrency=1)
+    give_up = scheduler._give_up
+
+    def release_then_give_up(user_id, waiter):
+        # The slot is granted after the wait timed out, before the waiter is taken out of the queue
+        scheduler.release()
+        return give_up(user_id, waiter)
+
+    scheduler._give_up = release_then_give_up
+    loop_errors = []
+
+    async def wait_for_turn():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: loop_errors.append(context))
+        await scheduler.aacquire("alice")
+        await scheduler.aacquire("bob", timeout=0.01)
+        await asyncio.sleep(0)  # Let the notification run
+
+    async_to_sync(wait_for_turn)()
+    assert loop_errors == []
+    assert scheduler.running == 1
+
+
+def test_llm_scheduler_health_check(monkeypatch):
+    scheduler = llm_scheduler.FairScheduler(concurrency=1)
+    monkeypatch.setattr("ask_ai.conversation.llm_scheduler.scheduler", scheduler)
+    check = health_checks.LLMSchedulerHealthCheck()
+    check.check_status()
+    assert not check.errors
+    scheduler.acquire("alice")
+    for user_id in ["alice", "bob", "alice"]:
+        scheduler._try_acquire_or_wait(user_id, llm_scheduler.Waiter(lambda: None))
+    check.check_status()
+    assert [str(error) for error in check.errors] == ["warning: 3 LLM calls waiting, by user: 2, 1"]
+
+
+@pytest.mark.django_db
+def test_submit_valid_chat_to_chatgpt35_scheduled(monkeypatch, settings, peter_chat):
+    settings.LLM_SCHEDULER_ENABLED = True
+    monkeypatch.setattr("ask_ai.conversation.llm_scheduler.scheduler", llm_scheduler.FairScheduler(concurrency=1))
+
+    def mock_response(raw_inputs):
+        assert llm_scheduler.scheduler.running == 1
+        return mock_get_gpt35_turbo_response(raw_inputs)
+
+    monkeypatch.setattr("ask_ai.conversation.chat_gpt.get_gpt35_turbo_response", mock_response)
+    prompt = models.Prompt.objects.create(chat=peter_chat, user_prompt="Scheduled prompt")
+    chat_gpt.submit_valid_chat_to_chatgpt35(prompt, {"model": "gpt-3.5-turbo-0125", "messages": []})
+    assert llm_scheduler.scheduler.running == 0
+    assert prompt.ai_response == "Mocked response"
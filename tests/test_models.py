@@ -1,4 +1,5 @@
 import pytest
+from freezegun import freeze_time
 
 from ask_ai.conversation import models
 
@@ -38,3 +39,35 @@ def test_assign_features_to_user_removes_groups(user_with_a_group):
     user_with_a_group.assign_features_to_user(features)
     new_groups_for_user = user_with_a_group.groups.all()
     assert new_groups_for_user.count() == 0
+
+
+@pytest.mark.django_db
+def test_prompt_updates_chat(mrs_tiggywinkle):
+    with freeze_time("2020-12-01 12:00:01"):
+        chat = models.Chat.objects.create(user=mrs_tiggywinkle)
+    with freeze_time("2020-12-02 12:00:01"):
+        first_prompt = models.Prompt.objects.create(chat=chat, user_prompt="x" * 150)
+    with freeze_time("2020-12-03 12:00:01"):
+        second_prompt = models.Prompt.objects.create(chat=chat, user_prompt="Another question")
+    # Saving again doesn't count the prompt twice
+    first_prompt.ai_response = "An answer"
+    first_prompt.save()
+    chat.refresh_from_db()
+    assert chat.title == "x" * models.Chat.TITLE_LENGTH
+    assert chat.last_activity_at == second_prompt.created_at
+    assert chat.prompt_count == 2
+
+
+@pytest.mark.django_db
+def test_prompt_created_earlier_saved_later(mrs_tiggywinkle):
+    # eg two prompts saved at the same time
+    with freeze_time("2020-12-01 12:00:01"):
+        chat = models.Chat.objects.create(user=mrs_tiggywinkle)
+    with freeze_time("2020-12-03 12:00:01"):
+        later_prompt = models.Prompt.objects.create(chat=chat, user_prompt="Later question")
+    with freeze_time("2020-12-02 12:00:01"):
+        models.Prompt.objects.create(chat=chat, user_prompt="Earlier question")
+    assert chat.last_activity_at == later_prompt.created_at
+    chat.refresh_from_db()
+    assert chat.last_activity_at == later_prompt.created_at
+    assert chat.prompt_count == 2
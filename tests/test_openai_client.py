@@ -0,0 +1,266 @@
+import asyncio
+import json
+import threading
+
+import aiohttp
+import aiohttp.web
+import openai
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+
+from ask_ai.conversation import chat_gpt, openai_client
+
+
+def test_openai_uses_shared_session():
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(openai.api_requestor._make_session()))
+    thread.start()
+    thread.join()
+    sessions.append(openai.api_requestor._make_session())
+    assert sessions[0] is sessions[1]
+    adapter = sessions[0].get_adapter("https://api.openai.com/v1/moderations")
+    assert isinstance(adapter, openai_client.MeteredHTTPAdapter)
+    assert adapter._pool_maxsize == 10
+
+
+def test_shared_session_not_closed():
+    session = openai_client.get_session()
+    adapter = session.get_adapter("https://api.openai.com/v1/moderations")
+    pool = adapter.poolmanager.connection_from_url("https://api.openai.com")
+    session.close()
+    assert adapter.poolmanager.connection_from_url("https://api.openai.com") is pool
+
+
+def test_shared_aio_session_per_loop():
+    async def get_sessions():
+        first, second = openai.aiosession.get(), openai.aiosession.get()
+        return first, second, first.session.connector.limit
+
+    first, second, limit = async_to_sync(get_sessions)()
+    assert first is second
+    assert limit == 10
+    # Closed with its event loop
+    assert first.closed
+    assert async_to_sync(get_sessions)()[0] is not first
+
+
+async def stream_chunks_slowly(request):
+    response = aiohttp.web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for word in ["Longer", " than", " the", " read", " timeout"]:
+        await asyncio.sleep(0.2)
+        chunk = {"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def test_async_stream_read_timeout_between_chunks(settings):
+    # Slower overall than the read timeout, but with shorter gaps between chunks
+    settings.OPENAI_READ_TIMEOUT_SECONDS = 0.5
+
+    async def stream():
+        app = aiohttp.web.Application()
+        app.router.add_post("/v1/chat/completions", stream_chunks_slowly)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            response = await openai_client.acreate_chat_completion(
+                stream=True, api_base=f"http://127.0.0.1:{port}/v1", model="gpt-3.5-turbo", messages=[]
+            )
+            return "".join([chunk["choices"][0]["delta"]["content"] async for chunk in response])
+        finally:
+            await runner.cleanup()
+
+    assert async_to_sync(stream)() == "Longer than the read timeout"
+
+
+def test_pool_stats_saturation():
+    stats = openai_client.PoolStats(pool_size=2, log_interval_seconds=0)
+    for _ in range(3):
+        stats.request_started()
+    stats.request_finished()
+    stats.request_started()
+    assert stats.as_dict() == {
+        "pool_size": 2,
+        "in_flight": 3,
+        "peak_in_flight": 3,
+        "total_requests": 4,
+        "saturated_requests": 2,
+    }
+
+
+def test_adapter_counts_requests(monkeypatch):
+    def mock_send(self, request, **kwargs):
+        assert openai_client.pool_stats.in_flight == in_flight_before + 1
+        return requests.Response()
+
+    monkeypatch.setattr("requests.adapters.HTTPAdapter.send", mock_send)
+    in_flight_before = openai_client.pool_stats.in_flight
+    total_before = openai_client.pool_stats.total_requests
+    openai_client.get_session().get("https://api.openai.com/v1/models")
+    assert openai_client.pool_stats.in_flight == in_flight_before
+    assert openai_client.pool_stats.total_requests == total_before + 1
+
+
+def test_create_moderation_timeout(monkeypatch, settings):
+    calls = []
+    monkeypatch.setattr("openai.Moderation.create", lambda **kwargs: calls.append(kwargs))
+    settings.OPENAI_CONNECT_TIMEOUT_SECONDS = 2
+    settings.OPENAI_READ_TIMEOUT_SECONDS = 20
+    openai_client.create_moderation("test input")
+    assert calls == [{"input": "test input", "model": "text-moderation-latest", "request_timeout": (2, 20)}]
+
+
+def make_flaky_moderation(errors):
+    calls = []
+
+    def mock_moderation(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return {"results": [{"flagged": False}]}
+
+    return mock_moderation, calls
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    return sleeps
+
+
+def test_create_moderation_retries(monkeypatch, sleeps):
+    mock_moderation, calls = make_flaky_moderation(
+        [openai.error.Timeout("Request timed out"), openai.error.APIConnectionError("Error communicating")]
+    )
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    openai_client.create_moderation("test input")
+    assert len(calls) == 3
+    assert 0.25 <= sleeps[0] <= 0.5
+    assert 0.5 <= sleeps[1] <= 1
+
+
+def test_create_moderation_gives_up(monkeypatch, sleeps):
+    mock_moderation, calls = make_flaky_moderation([openai.error.APIError("Server error")] * 3)
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    with pytest.raises(openai.error.APIError):
+        openai_client.create_moderation("test input")
+    assert len(calls) == 3
+
+
+def test_create_moderation_no_retry_for_invalid_request(monkeypatch, sleeps):
+    mock_moderation, calls = make_flaky_moderation([openai.error.InvalidRequestError("Bad request", param=None)])
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    with pytest.raises(openai.error.InvalidRequestError):
+        openai_client.create_moderation("test input")
+    assert len(calls) == 1
+    assert openai_client.circuit_breaker.get_status()["recent_failures"] == 0
+
+
+@pytest.mark.parametrize(
+    "headers, expected_sleeps",
+    [({"retry-after": "3"}, [3.0]), ({"retry-after-ms": "1500"}, [1.5]), ({"retry-after": "60"}, [])],
+)
+def test_create_moderation_retry_after(monkeypatch, sleeps, headers, expected_sleeps):
+    mock_moderation, calls = make_flaky_moderation([openai.error.RateLimitError("Rate limit", headers=headers)])
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    try:
+        openai_client.create_moderation("test input")
+    except openai.error.RateLimitError:
+        pass
+    assert sleeps == expected_sleeps
+
+
+def test_acreate_moderation_retries(monkeypatch):
+    sleeps = []
+    errors = [openai.error.ServiceUnavailableError("Unavailable")]
+
+    async def mock_sleep(delay):
+        sleeps.append(delay)
+
+    async def mock_moderation(**kwargs):
+        if errors:
+            raise errors.pop(0)
+        return {"results": [{"flagged": True}]}
+
+    monkeypatch.setattr("asyncio.sleep", mock_sleep)
+    monkeypatch.setattr("openai.Moderation.acreate", mock_moderation)
+    response = async_to_sync(openai_client.acreate_moderation)("test input")
+    assert response["results"][0]["flagged"]
+    assert len(sleeps) == 1
+
+
+def test_circuit_breaker_opens_and_fails_fast():
+    breaker = openai_client.CircuitBreaker(
+        failure_rate_threshold=0.5, minimum_calls=4, window_size=10, cooldown_seconds=30
+    )
+    for failed in [False, True, False, True]:
+        breaker.before_call()
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    assert breaker.get_status()["state"] == "open"
+    with pytest.raises(openai_client.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_circuit_breaker_trial_call():
+    breaker = openai_client.CircuitBreaker(
+        failure_rate_threshold=0.5, minimum_calls=1, window_size=10, cooldown_seconds=0
+    )
+    breaker.record_failure()
+    assert breaker.state == "open"
+    breaker.before_call()
+    assert breaker.state == "half-open"
+    # Only one trial call at a time
+    with pytest.raises(openai_client.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_interrupted_trial_call_records_nothing(monkeypatch):
+    breaker = openai_client.CircuitBreaker(
+        failure_rate_threshold=0.5, minimum_calls=1, window_size=10, cooldown_seconds=0
+    )
+    monkeypatch.setattr("ask_ai.conversation.openai_client.circuit_breaker", breaker)
+    breaker.record_failure()
+
+    def interrupted_call():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        openai_client.call_with_retries(interrupted_call)
+    # Not closed by the interrupted trial call, but another can be made
+    assert breaker.state == "half-open"
+    assert breaker.get_status()["recent_calls"] == 0
+    breaker.before_call()
+
+
+def test_circuit_open_error_is_handled_as_api_error(monkeypatch, settings, sleeps):
+    mock_moderation, calls = make_flaky_moderation([openai.error.Timeout("Request timed out")] * 20)
+    monkeypatch.setattr("openai.Moderation.create", mock_moderation)
+    for _ in range(4):
+        with pytest.raises(chat_gpt.OPEN_AI_API_ERRORS):
+            openai_client.create_moderation("test input")
+    # Opens after 10 failed calls (3 per create_moderation), then fails fast
+    assert len(calls) == 10
+    assert openai_client.circuit_breaker.get_status()["state"] == "open"
+
+
+@pytest.mark.django_db
+def test_health_check_shows_open_circuit(client):
+    response = client.get("/health/?format=json")
+    assert response.json()["OpenAICircuitBreaker"] == "working"
+    for _ in range(10):
+        openai_client.circuit_breaker.record_failure()
+    response = client.get("/health/?format=json")
+    assert response.json()["OpenAICircuitBreaker"] == "unavailable: OpenAI circuit breaker open"
@@ -26,6 +26,8 @@ NAMES_TO_IGNORE = [
     "new-chat",
     "chat-option",
     "chat-sensitivity-check",
+    "chat-stream",
+    "chat-status",
     "health",
     "login",
     "index",
@@ -80,7 +82,7 @@ def test_access_new_chat(client, peter_rabbit):
     assert response.status_code == 200, response.status_code
 
 
-@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check"])
+@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check", "chat-stream", "chat-status"])
 @pytest.mark.django_db
 def test_access_chat(client, peter_rabbit, peter_chat, url_name):
     client.force_login(peter_rabbit)
@@ -121,7 +123,7 @@ def test_cant_access_chat_option(client, peter_rabbit, jemima_chat):
     assert "Chat could not be found." in response.content.decode(), response.content.decode()
 
 
-@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check"])
+@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check", "chat-stream", "chat-status"])
 @pytest.mark.django_db
 def test_cant_access_other_user_chat(client, peter_rabbit, jemima_chat, url_name):
     client.force_login(peter_rabbit)
@@ -132,7 +134,7 @@ def test_cant_access_other_user_chat(client, peter_rabbit, jemima_chat, url_name
     assert "Chat could not be found." in response.content.decode(), response.content.decode()
 
 
-@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check"])
+@pytest.mark.parametrize("url_name", ["chat", "chat-sensitivity-check", "chat-stream", "chat-status"])
 @pytest.mark.django_db
 def test_cant_access_chat(client, jemima_chat, url_name):
     url = reverse(url_name, args=(jemima_chat.id,))
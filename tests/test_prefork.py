@@ -0,0 +1,92 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+from ask_ai import prefork
+
+SERVER_CODE = """
+import os, socket, time, django
+django.setup()
+from ask_ai import prefork
+
+def slow_response():
+    # Longer than waitress's own wait for current requests when stopped
+    yield b"started"
+    time.sleep(6)
+    yield b" finished"
+
+def application(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    if environ["PATH_INFO"] == "/slow/":
+        return slow_response()
+    return [str(os.getpid()).encode()]
+
+sock = socket.create_server(("127.0.0.1", 0))
+print(sock.getsockname()[1], flush=True)
+prefork.PreforkServer(application, sock, workers=2, threads=2).run()
+"""
+
+
+@pytest.fixture
+def server():
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": "ask_ai.settings", "ENVIRONMENT": "TEST"}
+    process = subprocess.Popen([sys.executable, "-c", SERVER_CODE], env=env, stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    yield process, port
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def get_worker_pid(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5) as response:
+        return int(response.read())
+
+
+def wait_for_worker_pid(port, condition):
+    for _ in range(100):
+        pid = get_worker_pid(port)
+        if condition(pid):
+            return pid
+        time.sleep(0.05)
+    raise AssertionError("No worker matched")
+
+
+def test_prefork_server_restarts_and_replaces_workers(server):
+    process, port = server
+    first_pid = get_worker_pid(port)
+    assert first_pid != process.pid
+    # Graceful restart, the old workers stop once new ones have started
+    process.send_signal(signal.SIGHUP)
+    time.sleep(1)
+    new_pids = {get_worker_pid(port) for _ in range(10)}
+    assert first_pid not in new_pids
+    new_pid = new_pids.pop()
+    # A worker that dies is replaced
+    os.kill(new_pid, signal.SIGKILL)
+    wait_for_worker_pid(port, lambda pid: pid != new_pid)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=10) == 0
+
+
+def test_prefork_server_finishes_requests_when_stopped(server):
+    process, port = server
+    get_worker_pid(port)
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/slow/", timeout=10) as response:
+        process.send_signal(signal.SIGTERM)
+        assert response.read() == b"started finished"
+    assert process.wait(timeout=10) == 0
+
+
+def test_get_process_memory_mb():
+    memory = prefork.get_process_memory_mb(os.getpid())
+    if memory is None:
+        pytest.skip("Needs /proc/<pid>/smaps_rollup")
+    assert memory["rss_mb"] >= memory["pss_mb"] > 0
+    assert memory["private_mb"] > 0
+    assert prefork.get_process_memory_mb(-1) is None
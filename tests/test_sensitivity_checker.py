@@ -1,7 +1,20 @@
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
 import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from presidio_analyzer import RecognizerResult
 
-from ask_ai.conversation import sensitivity_check
+from ask_ai.conversation import encodings, sensitivity_check
+from ask_ai.conversation.management.commands import benchmark_sensitivity_suite
+from ask_ai.conversation.management.commands.benchmark_sensitivity_check import SAMPLE_PROMPTS
 
 
 @pytest.mark.parametrize(
@@ -27,6 +40,23 @@ def test_analyze_text():
     assert len(results) >= 5, len(results)  # Should pick up name, postcode, phone number, email
 
 
+def test_analyze_texts_same_as_analyze_text():
+    texts = [
+        "Mickey Mouse: BL9 3TF, phone number 0131 887449, mobile 07777 888888, mr@example.com",
+        "Can you explain what a linear regression is?",
+        "Please email Jane Smith at jane@example.com",
+    ]
+
+    def get_found(results):
+        return sorted((result.entity_type, result.start, result.end, result.score) for result in results)
+
+    # In two processes, with texts split across batches
+    batch_results = sensitivity_check.analyze_texts(texts, n_process=2, batch_size=2)
+    assert [get_found(results) for results in batch_results] == [
+        get_found(sensitivity_check.analyze_text(text)) for text in texts
+    ]
+
+
 def test_get_analyzer_results_above_thresholds():
     sensitive_result1 = RecognizerResult(entity_type="UK_POSTCODE", start=1, end=4, score=1.0)
     sensitive_result2 = RecognizerResult(entity_type="PHONE_NUMBER", start=3, end=42, score=0.6)
@@ -76,3 +106,336 @@ def test_named_entity(pattern):
 )
 def test_not_sensitive(pattern):
     assert not sensitivity_check.is_text_potentially_sensitive(pattern), pattern
+
+
+def test_analyzer_engine_not_loaded_on_startup():
+    # eg for management commands
+    code = (
+        "import sys, django; django.setup(); import ask_ai.urls; "
+        "from django.core.management import call_command; call_command('check'); "
+        "assert 'spacy' not in sys.modules"
+    )
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": "ask_ai.settings", "ENVIRONMENT": "TEST"}
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_warm_up_analyzer_engine_in_background(monkeypatch, settings):
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._analyzer_engine", None)
+    assert not sensitivity_check.is_analyzer_engine_ready()
+    settings.SENSITIVITY_CHECK_WARM_UP = False
+    assert sensitivity_check.warm_up_analyzer_engine_in_background() is None
+    settings.SENSITIVITY_CHECK_WARM_UP = True
+    sensitivity_check.warm_up_analyzer_engine_in_background().join()
+    assert sensitivity_check.is_analyzer_engine_ready()
+
+
+@pytest.mark.django_db
+def test_health_check_reports_analyzer_ready(monkeypatch, client):
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._analyzer_engine", None)
+    response = client.get("/health/?format=json")
+    assert response.status_code == 200
+    assert response.json()["SensitivityCheckAnalyzer"] == "warning: Analyzer not loaded yet"
+    sensitivity_check.get_ask_ai_analyzer_engine()
+    response = client.get("/health/?format=json")
+    assert response.json()["SensitivityCheckAnalyzer"] == "working"
+
+
+FAST_CHECK_ENTITIES = ["SENSITIVITY_MARKINGS", "UK_POSTCODE", "UK_MOBILE_PHONE_REGEX", "UK_LANDLINE_REGEX"]
+FAST_CHECK_FRAGMENTS = [
+    "SECRET",
+    "secret",
+    "Secretary",
+    "top-secret",
+    "OFFICIAL SENSITIVE",
+    "official-sensitive",
+    "SW1A 2AS",
+    "sw1a2as",
+    "BL9 3TF",
+    "07777 888888",
+    "+447777888888",
+    "(0)7777 888 888",
+    "0131 887449",
+    "+44 20 7946 0958",
+    "020 79460958",
+    "12345",
+    "the",
+    "capital",
+    " ",
+    "\n",
+    ",",
+    "(",
+    ")",
+    "_",
+]
+
+
+def analyzer_finds_fast_check_entity(text):
+    engine = sensitivity_check.get_ask_ai_analyzer_engine()
+    return len(engine.analyze(text=text, language="en", entities=FAST_CHECK_ENTITIES)) > 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fast_check_matches_analyzer_recognizers(seed):
+    generator = random.Random(seed)
+    for _ in range(100):
+        text = "".join(generator.choices(FAST_CHECK_FRAGMENTS, k=generator.randint(1, 8)))
+        assert sensitivity_check.has_fast_check_match(text) == analyzer_finds_fast_check_entity(text), repr(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Can you please tell me about this top secret document?",
+        "OFFICIAL-SENSITIVE: budget",
+        "Call 07777 888888",
+        "I live at 70 Whitehall,  SW1A 2AS",
+        "Can you explain what a linear regression is?",
+        "Who was the Secretary of State in 2010?",
+        "Can you tell me about Winston Churchill?",
+        "Email mr@example.com",
+    ],
+)
+def test_tiered_check_same_as_analyzer(text):
+    assert sensitivity_check.is_text_potentially_sensitive(
+        text
+    ) == sensitivity_check.is_text_potentially_sensitive_by_analyzer(text)
+
+
+def test_fast_check_skips_analyzer(monkeypatch):
+    def fail_analyze_text(input_text):
+        raise AssertionError("Analyzer should not run")
+
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.analyze_text", fail_analyze_text)
+    assert sensitivity_check.is_text_potentially_sensitive("Postcode SW1A 2AS")
+
+
+def test_benchmark_sensitivity_check_command():
+    output = io.StringIO()
+    call_command("benchmark_sensitivity_check", repeat=2, stdout=output)
+    assert "Tiered" in output.getvalue()
+    assert "spaCy pipeline (full)" in output.getvalue()
+    assert "Verdict cache hit rate" in output.getvalue()
+    assert "Verdicts are the same" in output.getvalue()
+
+
+def test_trimmed_pipeline_components():
+    engine = sensitivity_check.get_analyzer_engine(trimmed_pipeline=True)
+    component_names = engine.nlp_engine.nlp["en"].component_names
+    assert "parser" not in component_names
+    assert "senter" not in component_names
+    assert {"tagger", "attribute_ruler", "lemmatizer", "ner"} <= set(component_names)
+
+
+def get_analyzer_results(engine, text):
+    results = engine.analyze(text=text, language="en", entities=sensitivity_check.SCORE_THRESHOLDS.keys())
+    return sorted((result.entity_type, result.start, result.end, result.score) for result in results)
+
+
+def test_trimmed_pipeline_same_results():
+    full_engine = sensitivity_check.get_analyzer_engine(trimmed_pipeline=False)
+    trimmed_engine = sensitivity_check.get_analyzer_engine(trimmed_pipeline=True)
+    texts = [
+        *SAMPLE_PROMPTS,
+        "Mickey Mouse: BL9 3TF, phone number 0131 887449, mobile 07777 888888, mr@example.com",
+        "My phone number is 212-555-5555, or try my email jane.doe@example.org",
+        "Margaret Thatcher and Tony Blair both lived at 10 Downing Street",
+        "How do I write 99879987 in words",
+    ]
+    for text in texts:
+        assert get_analyzer_results(trimmed_engine, text) == get_analyzer_results(full_engine, text), text
+
+
+class MockProcessPool:
+    def __init__(self, future):
+        self.future = future
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        return self.future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+@pytest.fixture
+def process_pool_enabled(settings):
+    settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE = 1
+    settings.SENSITIVITY_CHECK_TIMEOUT_SECONDS = 0.01
+
+
+def test_process_pool_timeout_fails_closed(monkeypatch, process_pool_enabled):
+    # The future never completes
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool", MockProcessPool(Future()))
+    assert sensitivity_check.is_text_potentially_sensitive("Can you explain what a linear regression is?")
+
+
+def test_broken_process_pool_fails_closed_and_is_replaced(monkeypatch, process_pool_enabled):
+    future = Future()
+    future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+    process_pool = MockProcessPool(future)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool", process_pool)
+    assert sensitivity_check.is_text_potentially_sensitive("Can you explain what a linear regression is?")
+    assert process_pool.shut_down
+    assert sensitivity_check._process_pool is None
+
+
+def test_process_pool_error_fails_closed(monkeypatch, process_pool_enabled):
+    future = Future()
+    future.set_exception(ValueError("Analyzer failed"))
+    process_pool = MockProcessPool(future)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool", process_pool)
+    assert sensitivity_check.is_text_potentially_sensitive("Can you explain what a linear regression is?")
+    # The pool itself is still usable
+    assert sensitivity_check._process_pool is process_pool
+
+
+def test_process_pool_check(monkeypatch, settings):
+    settings.SENSITIVITY_CHECK_PROCESS_POOL_SIZE = 1
+    settings.SENSITIVITY_CHECK_TIMEOUT_SECONDS = 60
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool", None)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool_ready", False)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.warm_up_error", None)
+    try:
+        sensitivity_check.warm_up_analyzer_engine()
+        assert sensitivity_check.is_analyzer_engine_ready()
+        assert not sensitivity_check.is_text_potentially_sensitive("Can you explain what a linear regression is?")
+        assert sensitivity_check.is_text_potentially_sensitive("Can you tell me about Winston Churchill?")
+    finally:
+        sensitivity_check.get_process_pool().shutdown()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_get_text_chunks(seed):
+    generator = random.Random(seed)
+    words = ["a", "word", "longerword", "x" * 30, "\n"]
+    text = " ".join(generator.choices(words, k=generator.randint(1, 400)))
+    chunk_size, overlap = 200, 50
+    chunks = list(sensitivity_check.get_text_chunks(text, chunk_size, overlap))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    # Anything up to the overlap long is all in one chunk
+    for start in range(len(text)):
+        assert any(text[start : start + overlap] in chunk for chunk in chunks), start
+
+
+@pytest.mark.parametrize("chunk_size,overlap", [(10, 10), (10, 20), (10, -1)])
+def test_get_text_chunks_invalid_overlap(chunk_size, overlap):
+    with pytest.raises(ValueError):
+        next(sensitivity_check.get_text_chunks("word " * 20, chunk_size, overlap))
+
+
+def test_get_text_chunks_small_overlap():
+    text = "abcdefghij" * 5
+    chunks = list(sensitivity_check.get_text_chunks(text, 10, 9))
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert chunks[-1] == text[-10:]
+
+
+def test_short_text_one_chunk():
+    assert list(sensitivity_check.get_text_chunks("Short text", 200, 50)) == ["Short text"]
+
+
+def test_entity_across_chunk_boundary_found(settings):
+    settings.SENSITIVITY_CHECK_CHUNK_CHARS = 200
+    settings.SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS = 50
+    text = "word " * 38 + "please email mr@example.com about it " + "word " * 40
+    first_chunk = next(sensitivity_check.get_chunks_to_analyze(text))
+    assert "mr@example.com" not in first_chunk
+    assert sensitivity_check.is_text_potentially_sensitive_by_chunks(text)
+
+
+def test_chunks_analysed_until_sensitive(monkeypatch, settings):
+    settings.SENSITIVITY_CHECK_CHUNK_CHARS = 200
+    settings.SENSITIVITY_CHECK_CHUNK_OVERLAP_CHARS = 50
+    analysed_chunks = []
+
+    def mock_is_text_potentially_sensitive_by_analyzer(chunk):
+        analysed_chunks.append(chunk)
+        return "sensitive" in chunk
+
+    monkeypatch.setattr(
+        "ask_ai.conversation.sensitivity_check.is_text_potentially_sensitive_by_analyzer",
+        mock_is_text_potentially_sensitive_by_analyzer,
+    )
+    assert sensitivity_check.is_text_potentially_sensitive("sensitive " + "word " * 200)
+    assert len(analysed_chunks) == 1
+    assert not sensitivity_check.is_text_potentially_sensitive("word " * 200)
+    assert len(analysed_chunks) > 2
+
+
+@pytest.fixture
+def analysed_texts(monkeypatch):
+    texts = []
+
+    def mock_is_text_potentially_sensitive_by_analyzer_tier(input_text):
+        texts.append(input_text)
+        return "Churchill" in input_text
+
+    monkeypatch.setattr(
+        "ask_ai.conversation.sensitivity_check.is_text_potentially_sensitive_by_analyzer_tier",
+        mock_is_text_potentially_sensitive_by_analyzer_tier,
+    )
+    return texts
+
+
+def test_verdicts_cached(analysed_texts):
+    assert sensitivity_check.is_text_potentially_sensitive("Can you tell me about Winston Churchill?")
+    assert sensitivity_check.is_text_potentially_sensitive("Can you tell me about Winston Churchill?")
+    assert not sensitivity_check.is_text_potentially_sensitive("What is a linear regression?")
+    assert not sensitivity_check.is_text_potentially_sensitive("What is a linear regression?")
+    # Whitespace can change a verdict, so isn't normalised
+    assert not sensitivity_check.is_text_potentially_sensitive("What is a  linear regression?")
+    assert analysed_texts == [
+        "Can you tell me about Winston Churchill?",
+        "What is a linear regression?",
+        "What is a  linear regression?",
+    ]
+    assert sensitivity_check.get_verdict_cache_stats() == {"hits": 2, "misses": 3, "hit_rate": 0.4}
+
+
+def test_verdict_cache_invalidated_by_configuration(monkeypatch, settings, analysed_texts):
+    text = "What is a linear regression?"
+    sensitivity_check.is_text_potentially_sensitive(text)
+    settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE = not settings.SENSITIVITY_CHECK_TRIMMED_PIPELINE
+    sensitivity_check.is_text_potentially_sensitive(text)
+    monkeypatch.setitem(sensitivity_check.SCORE_THRESHOLDS, "PERSON", 0.5)
+    sensitivity_check.is_text_potentially_sensitive(text)
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check.get_package_version", lambda name: "99.0")
+    sensitivity_check.is_text_potentially_sensitive(text)
+    sensitivity_check.is_text_potentially_sensitive(text)
+    assert analysed_texts == [text] * 4
+
+
+def test_failed_check_not_cached(monkeypatch, process_pool_enabled):
+    monkeypatch.setattr("ask_ai.conversation.sensitivity_check._process_pool", MockProcessPool(Future()))
+    assert sensitivity_check.is_text_potentially_sensitive("What is a linear regression?")
+    assert sensitivity_check.get_verdict_cache_stats()["misses"] == 1
+    assert sensitivity_check.is_text_potentially_sensitive("What is a linear regression?")
+    assert sensitivity_check.get_verdict_cache_stats()["hits"] == 0
+
+
+def test_generate_corpus():
+    corpus = benchmark_sensitivity_suite.generate_corpus([10, 400], prompts_per_case=2)
+    assert len(corpus) == 2 * len(benchmark_sensitivity_suite.DENSITIES)
+    prompt = corpus[(400, "none")][0]
+    encoding = encodings.get_encoding_for_model(benchmark_sensitivity_suite.TOKEN_MODEL)
+    assert 400 <= len(encoding.encode(prompt)) < 410
+    assert not sensitivity_check.has_fast_check_match(prompt)
+    assert any(entity in corpus[(400, "many")][0] for entity in benchmark_sensitivity_suite.ENTITIES)
+    assert corpus == benchmark_sensitivity_suite.generate_corpus([10, 400], prompts_per_case=2)
+
+
+def test_benchmark_sensitivity_suite_command(tmp_path):
+    baseline_path = tmp_path / "baseline.json"
+    options = {"lengths": [10, 50], "prompts": 2, "repeat": 1, "baseline": str(baseline_path)}
+    output = io.StringIO()
+    call_command("benchmark_sensitivity_suite", save_baseline=True, stdout=output, **options)
+    assert "analyze_text/50/many" in output.getvalue()
+    assert "Peak memory" in output.getvalue()
+    baseline = json.loads(baseline_path.read_text())
+    assert set(baseline["cases"]["is_text_potentially_sensitive/10/none"]) == {"p50_ms", "p95_ms", "per_second"}
+    # Much faster baseline
+    for timings in baseline["cases"].values():
+        timings["p95_ms"] = 0
+    baseline_path.write_text(json.dumps(baseline))
+    with pytest.raises(CommandError):
+        call_command("benchmark_sensitivity_suite", stdout=io.StringIO(), **options)
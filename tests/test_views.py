@@ -1,8 +1,15 @@
+import datetime
+import html
+import re
+
 import pytest
 from django.urls import reverse
+from django.utils import timezone
+from freezegun import freeze_time
 
-from ask_ai.conversation import models
+from ask_ai.conversation import models, views
 from tests.test_chat_gpt import (
+    mock_chat_completion_gpt35_stream,
     mock_chat_gpt_moderation_false,
     mock_chat_gpt_moderation_true,
     mock_get_gpt35_turbo_response,
@@ -213,3 +220,171 @@ def test_create_chat(alice, client, monkeypatch):
     client.post(reverse("new-chat"), {"user_prompt": "My prompt"})
     new_number_chats = models.Chat.objects.filter(user=alice).count()
     assert new_number_chats > initial_number_chats, new_number_chats
+
+
+@pytest.mark.django_db
+def test_chat_view_post_streamed(mrs_tiggywinkle, mrs_tiggywinkle_chat, client, monkeypatch, settings):
+    settings.STREAM_CHAT_RESPONSES = True
+    client.force_login(mrs_tiggywinkle)
+    utils.complete_declaration(client)
+    chat_id = mrs_tiggywinkle_chat[0].id
+    monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_false)
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    response = client.post(reverse("chat", args=(chat_id,)), {"user_prompt": "This prompt is acceptable"})
+    assert response.status_code == 302, response.status_code
+    assert response.url == reverse("chat", args=(chat_id,)), response.url
+    response = client.get(response.url)
+    stream_url = reverse("chat-stream", args=(chat_id,))
+    assert f'data-stream-url="{stream_url}"' in response.content.decode()
+    response = client.get(stream_url)
+    assert response["Content-Type"] == "text/event-stream"
+    events = b"".join(response.streaming_content).decode()
+    assert events == (
+        'data: "This is "\n\n' 'data: "some streamed "\n\n' 'data: "content."\n\n' 'event: done\ndata: ""\n\n'
+    ), events
+    latest_prompt = models.Prompt.objects.filter(chat__id=chat_id).order_by("created_at").last()
+    assert latest_prompt.ai_response == "This is some streamed content."
+    assert not latest_prompt.is_awaiting_response
+    response = client.get(reverse("chat", args=(chat_id,)))
+    assert "data-stream-url" not in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_chat_stream_view_nothing_to_stream(peter_rabbit, peter_chat, client):
+    client.force_login(peter_rabbit)
+    utils.complete_declaration(client)
+    response = client.get(reverse("chat-stream", args=(peter_chat.id,)))
+    events = b"".join(response.streaming_content).decode()
+    assert events == 'event: done\ndata: ""\n\n', events
+
+
+# Closing the response closes the database connection, as at the end of a request
+@pytest.mark.django_db(transaction=True)
+def test_chat_stream_view_claimed(mrs_tiggywinkle, mrs_tiggywinkle_chat, client, monkeypatch):
+    client.force_login(mrs_tiggywinkle)
+    utils.complete_declaration(client)
+    chat_id = mrs_tiggywinkle_chat[0].id
+    latest_prompt = models.Prompt.objects.create(
+        chat_id=chat_id, llm_model=models.Prompt.LLMModels.GPT35_TURBO_0125, user_prompt="Being streamed"
+    )
+    monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_false)
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    first_response = client.get(reverse("chat-stream", args=(chat_id,)))
+    assert next(first_response.streaming_content) == b'data: "This is "\n\n'
+    latest_prompt.refresh_from_db()
+    assert latest_prompt.response_pending
+    # Another request while it streams doesn't call the API again, the page polls the status instead
+    response = client.get(reverse("chat-stream", args=(chat_id,)))
+    assert b"".join(response.streaming_content).decode() == 'event: done\ndata: ""\n\n'
+    assert client.get(reverse("chat-status", args=(chat_id,))).json() == {"pending": True}
+    # The browser going away part way lets the next request stream it
+    first_response.close()
+    latest_prompt.refresh_from_db()
+    assert not latest_prompt.response_pending
+    response = client.get(reverse("chat-stream", args=(chat_id,)))
+    assert b"".join(response.streaming_content).decode().endswith('event: done\ndata: ""\n\n')
+    latest_prompt.refresh_from_db()
+    assert latest_prompt.ai_response == "This is some streamed content."
+    assert not latest_prompt.response_pending
+
+
+@pytest.mark.django_db
+def test_chat_stream_view_stale_claim(mrs_tiggywinkle, mrs_tiggywinkle_chat, client, monkeypatch, settings):
+    settings.STREAM_CHAT_RESPONSES = True
+    client.force_login(mrs_tiggywinkle)
+    utils.complete_declaration(client)
+    chat_id = mrs_tiggywinkle_chat[0].id
+    # Claimed by a request whose process was killed part way, so it was never released
+    latest_prompt = models.Prompt.objects.create(
+        chat_id=chat_id,
+        llm_model=models.Prompt.LLMModels.GPT35_TURBO_0125,
+        user_prompt="Abandoned part way",
+        response_pending=True,
+        response_claimed_at=timezone.now() - datetime.timedelta(seconds=settings.STREAM_CHAT_CLAIM_TIMEOUT_SECONDS + 1),
+    )
+    monkeypatch.setattr("openai.Moderation.create", mock_chat_gpt_moderation_false)
+    monkeypatch.setattr("openai.ChatCompletion.create", mock_chat_completion_gpt35_stream)
+    assert client.get(reverse("chat-status", args=(chat_id,))).json() == {"pending": False}
+    stream_url = reverse("chat-stream", args=(chat_id,))
+    response = client.get(reverse("chat", args=(chat_id,)))
+    assert f'data-stream-url="{stream_url}"' in response.content.decode()
+    response = client.get(stream_url)
+    assert b"".join(response.streaming_content).decode().startswith('data: "This is "\n\n')
+    latest_prompt.refresh_from_db()
+    assert latest_prompt.ai_response == "This is some streamed content."
+    assert not latest_prompt.response_pending
+
+
+@pytest.mark.django_db
+def test_get_past_chats_for_user(mrs_tiggywinkle, mrs_tiggywinkle_chat, django_assert_num_queries):
+    with freeze_time("2020-12-01 12:00:01"):
+        old_chat = models.Chat(user=mrs_tiggywinkle)
+        old_chat.save()
+        models.Prompt(chat=old_chat, user_prompt="An old question").save()
+    for i in range(5):
+        chat = models.Chat(user=mrs_tiggywinkle)
+        chat.save()
+        models.Prompt(chat=chat, user_prompt=f"First question {i}").save()
+        models.Prompt(chat=chat, user_prompt=f"Second question {i}").save()
+    with django_assert_num_queries(1):
+        past_chats = views.get_past_chats_for_user(mrs_tiggywinkle)
+    today_names = [chat["name"] for chat in past_chats["today"]]
+    assert today_names[:5] == [f"First question {i}" for i in reversed(range(5))]
+    chat1, chat2 = mrs_tiggywinkle_chat
+    # A truncated prompt, added after the chat with no prompts yet was created
+    assert today_names[5:] == [
+        chat1.prompt_set.get().user_prompt[:40] + "...",
+        chat2.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+    ]
+    assert past_chats["previous"] == [{"name": "An old question", "id": old_chat.id}]
+    assert past_chats["next_page_url"] is None
+
+
+@pytest.mark.django_db
+def test_past_chats_view_pages(peter_rabbit, client, settings):
+    settings.PAST_CHATS_PAGE_SIZE = 2
+    client.force_login(peter_rabbit)
+    utils.complete_declaration(client)
+    with freeze_time("2020-12-01 12:00:01"):
+        old_chats = [models.Chat.objects.create(user=peter_rabbit) for _ in range(5)]
+        # Some used at the same time, ordered by id
+        old_chats.sort(key=lambda chat: chat.id, reverse=True)
+        for i, chat in enumerate(old_chats):
+            models.Prompt.objects.create(chat=chat, user_prompt=f"Old question {i}")
+    models.Chat.objects.filter(id=old_chats[0].id).update(last_activity_at="2020-12-02T12:00:01Z")
+    models.Chat.objects.create(user=peter_rabbit)
+    past_chats = views.get_past_chats_for_user(peter_rabbit)
+    assert len(past_chats["today"]) == 1
+    names = [chat["name"] for chat in past_chats["previous"]]
+    next_page_url = past_chats["next_page_url"]
+    while next_page_url:
+        response = client.get(next_page_url)
+        assert response.status_code == 200, response.status_code
+        content = response.content.decode()
+        names.extend(name for i in range(5) if (name := f"Old question {i}") in content)
+        next_page = re.search('data-next-page-url="([^"]+)"', content)
+        next_page_url = next_page and html.unescape(next_page.group(1))
+    assert names == [f"Old question {i}" for i in range(5)]
+
+
+@pytest.mark.django_db
+def test_past_chats_view_first_page(peter_rabbit, client, settings):
+    settings.PAST_CHATS_PAGE_SIZE = 2
+    client.force_login(peter_rabbit)
+    utils.complete_declaration(client)
+    with freeze_time("2020-12-01 12:00:01"):
+        models.Prompt.objects.create(chat=models.Chat.objects.create(user=peter_rabbit), user_prompt="Old question")
+    models.Prompt.objects.create(chat=models.Chat.objects.create(user=peter_rabbit), user_prompt="New question")
+    response = client.get(reverse("past-chats"))
+    content = response.content.decode()
+    assert "Old question" in content
+    assert "New question" not in content
+    assert "js-more-chats" not in content
+
+
+@pytest.mark.django_db
+def test_past_chats_view_invalid_page(peter_rabbit, client):
+    client.force_login(peter_rabbit)
+    utils.complete_declaration(client)
+    response = client.get(reverse("past-chats"), {"before": "yesterday", "before_id": "1"})
+    assert response.status_code == 400, response.status_code